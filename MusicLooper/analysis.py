@@ -1,16 +1,47 @@
 import logging
 import time
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Dict
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import librosa
 import numpy as np
-from numba import njit
+import scipy.signal
+import scipy.sparse
+from numba import config as numba_config
+from numba import get_num_threads, njit, prange, set_num_threads
 
 from audio import MLAudio
 from exceptions import LoopNotFoundError
 
 
+# Sample rate the chroma bins and the beat tracker assume, whatever the analysis rate (librosa's default).
+# The note deviation/loudness thresholds and the 12-beat test window were tuned with these features, so they are
+# kept as is; the tempo the beat tracker works with (`AudioFeatures.bpm`) is scaled by FEATURE_SAMPLE_RATE / analysis rate
+FEATURE_SAMPLE_RATE = 22050
+
+# Length of the audio compared on each side of the loop points by the seam score
+SEAM_WINDOW_SECONDS = 0.01
+
+# Range searched on each side of the approximate loop points (in seconds)
+APPROX_SEARCH_SECONDS = 2
+# Audio needed beyond the searched range when scoring the loop points in approximate mode (in seconds):
+# 12 beats at the assumed 120 bpm, with some headroom for the STFT/MFCC frames at the window edges
+APPROX_SCORING_MARGIN_SECONDS = 7
+
+# Distance from a segment boundary within which a loop point scores as structurally aligned (in seconds);
+# the former fixed 1000 frames at the default 44.1 kHz analysis rate and 512 hop length
+STRUCTURE_BOUNDARY_SECONDS = 11.6
+# Default number of segments found by the structure analysis
+STRUCTURE_SEGMENTS = 8
+# Length of the blocks the structure analysis averages the features over when the beats are unknown (in seconds)
+SEGMENTATION_BLOCK_SECONDS = 0.5
+# Frames averaged before the loop start and after the loop end by the MFCC (timbre) score;
+# the cost of the score does not depend on it
+MFCC_WINDOW_FRAMES = 4
+# Loop lengths within this distance of a dominant repetition lag are searched, when the search is seeded with them (in seconds)
+REPETITION_LAG_TOLERANCE_SECONDS = 0.25
+
+
 @dataclass
 class LoopPair:
     """A data class that encapsulates the loop point related data.
@@ -23,6 +54,8 @@ class LoopPair:
         chord_score: float
         mfcc_score: float
         score: float. Defaults to 0.
+        seam_score: float (sample-domain cross-correlation of the audio around loop_end and loop_start, from -1 to 1)
+        finalized: bool (False while the structure/chord/MFCC scores and the zero-crossing refinement are deferred, see `LoopPairList`)
     """
 
     _loop_start_frame_idx: int
@@ -36,6 +69,48 @@ class LoopPair:
     loop_start: int = 0
     loop_end: int = 0
     original_score: float = 0
+    seam_score: float = 0
+    finalized: bool = True
+
+
+class LoopPairList(list):
+    """A ranked list of `LoopPair` objects, of which only the first ones may be finalized.
+
+    Candidates are ranked by their chroma similarity score, which is cheap to compute for all of them.
+    The structure, chord and MFCC scores and the zero-crossing refinement of the loop points are only
+    computed for the pairs that are actually used, through `finalize`. Until then, a pair's loop points
+    are its unrefined beat positions (in samples).
+    """
+
+    def __init__(
+        self,
+        pairs: List[LoopPair],
+        mlaudio: MLAudio,
+        structure_info: Optional[Dict] = None,
+        features: Optional["AudioFeatures"] = None,
+        n_segments: int = STRUCTURE_SEGMENTS,
+    ):
+        super().__init__(pairs)
+        self.mlaudio = mlaudio
+        self.structure_info = structure_info
+        # Features of the search, reused by the structure analysis
+        self.features = features
+        self.n_segments = n_segments
+
+    def finalize(self, count: Optional[int] = None) -> "LoopPairList":
+        """Finalizes the first `count` pairs (all of them if None), in their current order.
+
+        Returns:
+            LoopPairList: the list itself
+        """
+        pending = [pair for pair in self[:count] if not pair.finalized]
+        if pending:
+            if self.structure_info is None:
+                # 結構分析只在第一次需要時進行
+                self.structure_info = analyze_music_structure(self.mlaudio, self.features, self.n_segments)
+                self.features = None
+            _finalize_loop_pairs(self.mlaudio, pending, self.structure_info)
+        return self
 
 
 def find_best_loop_points(
@@ -48,7 +123,14 @@ def find_best_loop_points(
     brute_force: bool = False,
     disable_pruning: bool = False,
     score_weights: dict = None,
-) -> List[LoopPair]:
+    top_k: Optional[int] = None,
+    bpm: Optional[float] = None,
+    beat_times: Optional[Sequence[float]] = None,
+    n_segments: int = STRUCTURE_SEGMENTS,
+    beat_sync: bool = False,
+    repetition_lags: int = 0,
+    duplicate_tolerance: float = 0,
+) -> LoopPairList:
     """Finds the best loop points for a given audio track, given the constraints specified
 
     Args:
@@ -61,11 +143,18 @@ def find_best_loop_points(
         brute_force (bool, optional): Checks the entire track instead of the detected beats (disclaimer: runtime may be significantly longer). Defaults to False.
         disable_pruning (bool, optional): Returns all the candidate loop points without filtering. Defaults to False.
         score_weights (dict, optional): The weights for the advanced scoring. Defaults to None.
+        top_k (int, optional): Only finalize (see `LoopPairList`) the best `top_k` loop pairs; the rest can be finalized on demand. Defaults to None (all loop pairs are finalized).
+        bpm (float, optional): The known tempo of the track, which skips the tempo estimation and beat tracking. Defaults to None.
+        beat_times (Sequence[float], optional): The known beat positions of the track (in seconds), which skip the beat tracking entirely. Defaults to None.
+        n_segments (int, optional): Number of segments found by the structure analysis, which the structure score compares the loop points to. Defaults to STRUCTURE_SEGMENTS.
+        beat_sync (bool, optional): Searches and scores the candidates on features averaged between beats instead of on every frame, which is faster and uses less memory; the finalized scores and loop points remain frame/sample accurate. Only applies when the beats are analyzed (i.e. not with approx_loop_start/approx_loop_end or brute_force). Defaults to False.
+        repetition_lags (int, optional): If greater than 0, only the loop lengths near the `repetition_lags` dominant repetition lags of the track are searched (see `_repetition_lags`), falling back to all the loop lengths if none of them yields a loop. Does not apply with approx_loop_start/approx_loop_end. Defaults to 0.
+        duplicate_tolerance (float, optional): Grid size of the suppression of near-duplicate candidates before scoring (in seconds, see `_suppress_near_duplicates`), e.g. 0.1. Does not apply with disable_pruning or approx_loop_start/approx_loop_end, whose search is meant to rank the neighbouring frames. Defaults to 0 (all the candidates are kept).
     Raises:
         LoopNotFoundError: raised in case no loops were found
 
     Returns:
-        List[LoopPair]: A list of `LoopPair` objects containing the loop points related data. See the `LoopPair` class for more info.
+        LoopPairList: A list of `LoopPair` objects containing the loop points related data. See the `LoopPair` class for more info.
     """
     runtime_start = time.perf_counter()
     min_loop_duration = (
@@ -84,13 +173,11 @@ def find_best_loop_points(
     # Loop points must be at least 1 frame apart
     min_loop_duration = max(1, min_loop_duration)
 
-    # 進行音樂結構分析
-    structure_info = analyze_music_structure(mlaudio)
-
     if approx_loop_start is not None and approx_loop_end is not None:
         # Skipping the unnecessary beat analysis (in this case) speeds up the analysis runtime by ~2x
         # and significantly reduces the total memory consumption
-        chroma, power_db, _, _ = _analyze_audio(mlaudio, skip_beat_analysis=True)
+        features = _analyze_audio(mlaudio, skip_beat_analysis=True)
+        chroma, power_db = features.chroma, features.power_db
         # Set bpm to a general average of 120
         bpm = 120.0
 
@@ -101,7 +188,7 @@ def find_best_loop_points(
             approx_loop_end, apply_trim_offset=True
         )
 
-        n_frames_to_check = mlaudio.seconds_to_frames(2)
+        n_frames_to_check = mlaudio.seconds_to_frames(APPROX_SEARCH_SECONDS)
 
         # Adjust min and max loop duration checks to the specified range
         min_loop_duration = (
@@ -116,35 +203,47 @@ def find_best_loop_points(
         )
 
         # Override the beats to check with the specified approx points +/- 2 seconds
-        beats = np.concatenate(
-            [
-                np.arange(
-                    start=max(0, approx_loop_start - n_frames_to_check),
-                    stop=min(
-                        mlaudio.seconds_to_frames(mlaudio.total_duration),
-                        approx_loop_start + n_frames_to_check,
-                    ),
+        # (sorted, without duplicates if both windows overlap)
+        beats = np.union1d(
+            np.arange(
+                start=max(0, approx_loop_start - n_frames_to_check),
+                stop=min(
+                    mlaudio.seconds_to_frames(mlaudio.total_duration),
+                    approx_loop_start + n_frames_to_check,
                 ),
-                np.arange(
-                    start=max(0, approx_loop_end - n_frames_to_check),
-                    stop=min(
-                        mlaudio.seconds_to_frames(mlaudio.total_duration),
-                        approx_loop_end + n_frames_to_check,
-                    ),
+            ),
+            np.arange(
+                start=max(0, approx_loop_end - n_frames_to_check),
+                stop=min(
+                    mlaudio.seconds_to_frames(mlaudio.total_duration),
+                    approx_loop_end + n_frames_to_check,
                 ),
-            ]
+            ),
         )
     elif brute_force:
         # Similarly skip beat analysis, as the results will not be used
-        chroma, power_db, _, _ = _analyze_audio(mlaudio, skip_beat_analysis=True)
+        features = _analyze_audio(mlaudio, skip_beat_analysis=True)
+        chroma, power_db = features.chroma, features.power_db
         bpm = 120.0
         beats = np.arange(start=0, stop=chroma.shape[-1], step=1, dtype=int)
         logging.info(f"Overriding number of frames to check with: {beats.size}")
-        logging.info(f"Estimated iterations required using brute force: {int(beats.size*beats.size*(1-(min_loop_duration/chroma.shape[-1])))}")
+        logging.info(f"Estimated iterations required using brute force: {beats.size * max(0, min(max_loop_duration, beats.size) - min_loop_duration + 1)}")
         logging.info("**NOTICE** The program may appear frozen, but processing will continue in the background. This operation may take several minutes to complete.")
     else: # normal mode of operation
-        chroma, power_db, bpm, beats = _analyze_audio(mlaudio)
-        logging.info(f"Detected {beats.size} beats at {bpm:.0f} bpm")
+        features = _analyze_audio(mlaudio, bpm=bpm, beat_times=beat_times)
+        chroma, power_db, bpm, beats = features.chroma, features.power_db, features.bpm, features.beats
+        if features.tempogram is not None:
+            logging.info(f"Detected {beats.size} beats at {bpm:.0f} bpm")
+        else:
+            # Known tempos are reported in real bpm rather than in the time base of the beat tracker
+            logging.info(f"Using {beats.size} beats at {bpm * mlaudio.analysis_rate / FEATURE_SAMPLE_RATE:.0f} bpm")
+
+    column_frames = None
+    beat_frames = None
+    if beat_sync and features.beats is not None:
+        column_frames, chroma, power_db, beat_columns = _beat_synchronous_features(features)
+        beats, beat_frames = beat_columns, column_frames[beat_columns]
+        logging.info(f"Using beat-synchronous features ({chroma.shape[-1]} columns)")
 
     logging.info(
         "Finished initial audio processing in {:.3f}s".format(
@@ -156,9 +255,26 @@ def find_best_loop_points(
 
     # Since numba jitclass cannot be cached, the pair data must be stored temporarily in a list of tuple
     # (instead of a list of LoopPairs directly) and then loaded into a list of LoopPair objects using list comprehension
+    loop_durations = None
+    if repetition_lags > 0 and approx_loop_start is None:
+        tolerance = mlaudio.seconds_to_frames(REPETITION_LAG_TOLERANCE_SECONDS)
+        # On the frame-level chroma, whose frames are evenly spaced in time (unlike beats)
+        lags = _repetition_lags(
+            features.chroma, min_loop_duration, max_loop_duration, n_lags=repetition_lags, tolerance=tolerance
+        )
+        if lags is not None:
+            logging.info(
+                f"Dominant repetition lags: {', '.join(f'{mlaudio.frames_to_samples(lag) / mlaudio.rate:.2f}s' for lag in lags)}"
+            )
+            loop_durations = np.stack([lags - tolerance, lags + tolerance], axis=-1)
     unproc_candidate_pairs = _find_candidate_pairs(
-        chroma, power_db, beats, min_loop_duration, max_loop_duration
+        chroma, power_db, beats, min_loop_duration, max_loop_duration, beat_frames=beat_frames, loop_durations=loop_durations
     )
+    if loop_durations is not None and not unproc_candidate_pairs:
+        logging.info("No loop points found near the dominant repetition lags, searching all the loop lengths")
+        unproc_candidate_pairs = _find_candidate_pairs(
+            chroma, power_db, beats, min_loop_duration, max_loop_duration, beat_frames=beat_frames
+        )
     candidate_pairs = [
         LoopPair(
             _loop_start_frame_idx=tup[0],
@@ -181,34 +297,28 @@ def find_best_loop_points(
         )
 
     filtered_candidate_pairs = _assess_and_filter_loop_pairs(
-        mlaudio, chroma, bpm, candidate_pairs, structure_info, disable_pruning, score_weights
+        mlaudio,
+        chroma,
+        bpm,
+        candidate_pairs,
+        disable_pruning,
+        score_weights,
+        column_frames=column_frames,
+        duplicate_tolerance=mlaudio.seconds_to_frames(duplicate_tolerance) if approx_loop_start is None else 0,
     )
+    # Only the features needed by the structure analysis are kept for the finalization
+    features.chroma = features.power_db = None
+    del chroma, power_db
 
     # prefer longer loops for highly similar sequences
     if len(filtered_candidate_pairs) > 1:
         _prioritize_duration(filtered_candidate_pairs)
 
-    # Set the exact loop start and end in samples and adjust them
-    # to the nearest zero crossing. Avoids audio popping/clicking while looping
-    # as much as possible.
-    for pair in filtered_candidate_pairs:
-        if mlaudio.trim_offset > 0:
-            pair._loop_start_frame_idx = int(
-                mlaudio.apply_trim_offset(pair._loop_start_frame_idx)
-            )
-            pair._loop_end_frame_idx = int(
-                mlaudio.apply_trim_offset(pair._loop_end_frame_idx)
-            )
-        pair.loop_start = nearest_zero_crossing(
-            mlaudio.playback_audio,
-            mlaudio.rate,
-            mlaudio.frames_to_samples(pair._loop_start_frame_idx)
-        )
-        pair.loop_end = nearest_zero_crossing(
-            mlaudio.playback_audio,
-            mlaudio.rate,
-            mlaudio.frames_to_samples(pair._loop_end_frame_idx)
-        )
+    # The structure/chord/MFCC scores and the zero-crossing refinement of the loop points
+    # are deferred until the pairs are needed, which is usually only the best few
+    filtered_candidate_pairs = LoopPairList(filtered_candidate_pairs, mlaudio, features=features, n_segments=n_segments)
+    _set_unrefined_loop_points(mlaudio, filtered_candidate_pairs)
+    filtered_candidate_pairs.finalize(top_k)
 
     if not filtered_candidate_pairs:
         raise LoopNotFoundError(
@@ -225,53 +335,288 @@ def find_best_loop_points(
     return filtered_candidate_pairs
 
 
+@dataclass
+class PrecisionReport:
+    """Comparison of the best loop pairs found with the analysis dtype against a float64 run.
+    Contains:
+        top_n: int (number of loop pairs compared)
+        mismatches: List[Tuple[int, Tuple[int, int], Tuple[int, int]]] (rank, (loop_start, loop_end) with the analysis dtype, (loop_start, loop_end) in float64) of every differing pair
+        max_score_difference: float (largest absolute score difference of the compared pairs)
+    """
+
+    top_n: int
+    mismatches: List[Tuple[int, Tuple[int, int], Tuple[int, int]]]
+    max_score_difference: float
+
+    @property
+    def matches(self) -> bool:
+        return not self.mismatches
+
+
+def verify_precision(
+    mlaudio: MLAudio,
+    loop_pairs: List[LoopPair],
+    top_n: int = 5,
+    **search_kwargs,
+) -> PrecisionReport:
+    """Repeats the loop search of `loop_pairs` with a float64 analysis and compares their `top_n` best loop points.
+
+    Args:
+        mlaudio (MLAudio): The audio `loop_pairs` were found on.
+        loop_pairs (List[LoopPair]): The result of `find_best_loop_points` for `mlaudio`.
+        top_n (int, optional): Number of loop pairs to compare. Defaults to 5.
+        **search_kwargs: The other arguments `loop_pairs` were found with, passed on to `find_best_loop_points`.
+
+    Returns:
+        PrecisionReport: the differences between both runs
+    """
+    if isinstance(loop_pairs, LoopPairList):
+        loop_pairs.finalize(top_n)
+    search_kwargs["top_k"] = top_n
+    try:
+        reference_pairs = find_best_loop_points(mlaudio.with_dtype(np.float64), **search_kwargs)
+    except LoopNotFoundError:
+        reference_pairs = []
+
+    n_compared = max(len(loop_pairs[:top_n]), len(reference_pairs[:top_n]))
+    mismatches = []
+    max_score_difference = 0.0
+    for rank in range(n_compared):
+        pair = loop_pairs[rank] if rank < len(loop_pairs) else None
+        reference = reference_pairs[rank] if rank < len(reference_pairs) else None
+        points = (pair.loop_start, pair.loop_end) if pair is not None else None
+        reference_points = (reference.loop_start, reference.loop_end) if reference is not None else None
+        if points != reference_points:
+            mismatches.append((rank, points, reference_points))
+        if pair is not None and reference is not None:
+            max_score_difference = max(max_score_difference, abs(pair.score - reference.score))
+    return PrecisionReport(top_n=n_compared, mismatches=mismatches, max_score_difference=max_score_difference)
+
+
+def approx_search_windows(approx_loop_start: float, approx_loop_end: float) -> List[Tuple[float, float]]:
+    """Returns the time ranges of the track (in seconds) that the loop search around approximate loop points needs,
+    i.e. the searched range around each point plus the audio its scoring looks at.
+    Used to decode only these parts of the track, see `WindowedMLAudio`.
+    """
+    margin = APPROX_SEARCH_SECONDS + APPROX_SCORING_MARGIN_SECONDS
+    return [(point - margin, point + margin) for point in (approx_loop_start, approx_loop_end)]
+
+
+def _set_unrefined_loop_points(mlaudio: MLAudio, pair_list: List[LoopPair]):
+    """Marks the pairs as not finalized, with their loop points set to the (unrefined) sample positions of their beats."""
+    if not pair_list:
+        return
+    start_frames = np.array([pair._loop_start_frame_idx for pair in pair_list], dtype=np.int64)
+    end_frames = np.array([pair._loop_end_frame_idx for pair in pair_list], dtype=np.int64)
+    if mlaudio.trim_offset > 0:
+        start_frames = mlaudio.apply_trim_offset(start_frames)
+        end_frames = mlaudio.apply_trim_offset(end_frames)
+    loop_starts = mlaudio.track_samples(mlaudio.frames_to_samples(start_frames))
+    loop_ends = mlaudio.track_samples(mlaudio.frames_to_samples(end_frames))
+    for idx, pair in enumerate(pair_list):
+        pair.loop_start = int(loop_starts[idx])
+        pair.loop_end = int(loop_ends[idx])
+        pair.finalized = False
+
+
+def _finalize_loop_pairs(mlaudio: MLAudio, pair_list: List[LoopPair], structure_info: Dict):
+    """Computes the structure, chord and MFCC scores of the pairs and refines their loop points."""
+    start_frames = np.array([pair._loop_start_frame_idx for pair in pair_list], dtype=np.int64)
+    end_frames = np.array([pair._loop_end_frame_idx for pair in pair_list], dtype=np.int64)
+    # 結構、和弦與 MFCC 分數（所有迴圈點一次計算）
+    structure_scores = _evaluate_structure_similarities(
+        start_frames,
+        end_frames,
+        structure_info['segments'],
+        threshold=STRUCTURE_BOUNDARY_SECONDS * mlaudio.analysis_rate / mlaudio.hop_length,
+    )
+    chord_scores = _evaluate_chord_progressions(start_frames, end_frames, structure_info['chord_ids'])
+    mfcc_scores = _evaluate_mfcc_similarities(start_frames, end_frames, structure_info['mfcc'], window_size=MFCC_WINDOW_FRAMES)
+    for pair, structure_score, chord_score, mfcc_score in zip(
+        pair_list, structure_scores.tolist(), chord_scores.tolist(), mfcc_scores.tolist()
+    ):
+        pair.structure_score = structure_score
+        pair.chord_score = chord_score
+        pair.mfcc_score = mfcc_score
+
+    # Set the exact loop start and end in samples and adjust them
+    # to the nearest zero crossing. Avoids audio popping/clicking while looping
+    # as much as possible.
+    _refine_loop_pairs(mlaudio, pair_list)
+    for pair in pair_list:
+        pair.finalized = True
+
+
+def _refine_loop_pairs(mlaudio: MLAudio, pair_list: List[LoopPair]):
+    """Sets the exact loop start and end (in samples) of every pair, snapped to the nearest zero crossings,
+    along with their seam scores; all pairs are refined at once by `refine_loop_points`."""
+    if not pair_list:
+        return
+    start_frames = np.array([pair._loop_start_frame_idx for pair in pair_list], dtype=np.int64)
+    end_frames = np.array([pair._loop_end_frame_idx for pair in pair_list], dtype=np.int64)
+    if mlaudio.trim_offset > 0:
+        start_frames = mlaudio.apply_trim_offset(start_frames)
+        end_frames = mlaudio.apply_trim_offset(end_frames)
+
+    loop_starts, loop_ends, seam_scores = refine_loop_points(
+        mlaudio.playback_audio,
+        mlaudio.rate,
+        mlaudio.frames_to_samples(start_frames),
+        mlaudio.frames_to_samples(end_frames),
+        seam_window=int(mlaudio.rate * SEAM_WINDOW_SECONDS),
+    )
+    loop_starts = mlaudio.track_samples(loop_starts)
+    loop_ends = mlaudio.track_samples(loop_ends)
+    for idx, pair in enumerate(pair_list):
+        pair._loop_start_frame_idx = int(start_frames[idx])
+        pair._loop_end_frame_idx = int(end_frames[idx])
+        pair.loop_start = int(loop_starts[idx])
+        pair.loop_end = int(loop_ends[idx])
+        pair.seam_score = float(seam_scores[idx])
+
+
+@dataclass
+class AudioFeatures:
+    """The features computed once by `_analyze_audio` and shared by the later analysis stages.
+    Contains:
+        chroma: np.ndarray (chroma spectrogram; released once the candidates are scored)
+        power_db: np.ndarray (perceptually weighted power spectrogram in dB; released once the candidates are scored)
+        mel_spectrogram: np.ndarray (power mel spectrogram, reused by the structure analysis)
+        onset_envelope: np.ndarray (onset strength of each frame; None if the beat analysis was skipped)
+        tempogram: np.ndarray (autocorrelation tempogram; None unless the beats were tracked)
+        bpm: float (tempo in the time base of FEATURE_SAMPLE_RATE, as the beat tracker reports it; None if the beat analysis was skipped)
+        beats: np.ndarray (frame indices of the beats; None if the beat analysis was skipped)
+    """
+
+    chroma: Optional[np.ndarray]
+    power_db: Optional[np.ndarray]
+    mel_spectrogram: np.ndarray
+    onset_envelope: Optional[np.ndarray] = None
+    tempogram: Optional[np.ndarray] = None
+    bpm: Optional[float] = None
+    beats: Optional[np.ndarray] = None
+
+
 def _analyze_audio(
-    mlaudio: MLAudio, skip_beat_analysis=False
-) -> Tuple[np.ndarray, np.ndarray, float, np.ndarray]:
+    mlaudio: MLAudio,
+    skip_beat_analysis=False,
+    bpm: Optional[float] = None,
+    beat_times: Optional[np.ndarray] = None,
+) -> AudioFeatures:
     """Performs the main audio analysis required
 
     Args:
         mlaudio (MLAudio): the MLAudio object to perform analysis on
-        skip_beat_analysis (bool, optional): Skips beat analysis if true and returns None for bpm and beats. Defaults to False.
+        skip_beat_analysis (bool, optional): Skips beat analysis if true, leaving the onset envelope, bpm and beats to None. Defaults to False.
+        bpm (float, optional): The known tempo of the track. Skips the tempo estimation and beat tracking: the beats are laid on a grid at this tempo, aligned with the onsets. Defaults to None.
+        beat_times (np.ndarray, optional): The known beat positions (in seconds). Skips the beat tracking entirely. Defaults to None.
 
     Returns:
-        Tuple[np.ndarray, np.ndarray, float, np.ndarray]: a tuple containing the (chroma spectrogram, power spectrogram in dB, tempo/bpm, frame indices of detected beats)
+        AudioFeatures: the chroma spectrogram, power spectrogram in dB, mel spectrogram and the rhythm features (see `AudioFeatures`)
     """
-    S = librosa.core.stft(y=mlaudio.audio)
-    S_power = np.abs(S) ** 2
+    # All features stay in `mlaudio.dtype`: the STFT of a float32 signal is complex64,
+    # and a float64 frequency axis would otherwise promote the weighted spectrogram to float64
+    S = librosa.core.stft(y=mlaudio.audio, n_fft=mlaudio.n_fft, hop_length=mlaudio.hop_length)
+    S_power = np.abs(S)
+    del S
+    S_power **= 2
     S_weighed = librosa.core.perceptual_weighting(
-        S=S_power, frequencies=librosa.fft_frequencies(sr=mlaudio.rate)
+        S=S_power,
+        frequencies=librosa.fft_frequencies(sr=mlaudio.analysis_rate, n_fft=mlaudio.n_fft).astype(mlaudio.dtype),
     )
-    mel_spectrogram = librosa.feature.melspectrogram(
-        S=S_weighed, sr=mlaudio.rate, n_mels=128, fmax=8000
+    features = AudioFeatures(
+        chroma=librosa.feature.chroma_stft(S=S_power, sr=FEATURE_SAMPLE_RATE, n_fft=mlaudio.n_fft).astype(mlaudio.dtype, copy=False),
+        power_db=librosa.power_to_db(S_weighed, ref=np.median).astype(mlaudio.dtype, copy=False),
+        mel_spectrogram=librosa.feature.melspectrogram(
+            S=S_power, sr=mlaudio.analysis_rate, n_fft=mlaudio.n_fft, n_mels=128, fmax=8000
+        ),
     )
-    chroma = librosa.feature.chroma_stft(S=S_power)
-    power_db = librosa.power_to_db(S_weighed, ref=np.median)
 
     if skip_beat_analysis:
-        return chroma, power_db, None, None
+        return features
 
     try:
-        onset_env = librosa.onset.onset_strength(S=mel_spectrogram)
+        weighted_mel_spectrogram = librosa.feature.melspectrogram(
+            S=S_weighed, sr=mlaudio.analysis_rate, n_fft=mlaudio.n_fft, n_mels=128, fmax=8000
+        )
+        del S_power, S_weighed
+        _analyze_beats(mlaudio, features, weighted_mel_spectrogram, bpm=bpm, beat_times=beat_times)
+    except Exception as e:
+        raise LoopNotFoundError(f"Beat analysis failed for \"{mlaudio.filename}\". Cannot continue.") from e
 
-        pulse = librosa.beat.plp(onset_envelope=onset_env)
-        beats_plp = np.flatnonzero(librosa.util.localmax(pulse))
-        bpm, beats = librosa.beat.beat_track(onset_envelope=onset_env)
+    return features
 
-        beats = np.union1d(beats, beats_plp)
-        beats = np.sort(beats)
 
-        if isinstance(bpm, np.ndarray):
-            bpm = bpm[0]
-    except Exception as e:
-        raise LoopNotFoundError(f"Beat analysis failed for \"{mlaudio.filename}\". Cannot continue.") from e
+def _analyze_beats(
+    mlaudio: MLAudio,
+    features: AudioFeatures,
+    mel_spectrogram: np.ndarray,
+    bpm: Optional[float] = None,
+    beat_times: Optional[np.ndarray] = None,
+):
+    """Fills in the rhythm features of `features`, computing the onset envelope (and tempogram) only once for every stage."""
+    sr, hop_length = FEATURE_SAMPLE_RATE, mlaudio.hop_length
+    # Known tempos (in real bpm) are converted to the time base of the beat tracker
+    tempo_scale = FEATURE_SAMPLE_RATE / mlaudio.analysis_rate
+    onset_env = librosa.onset.onset_strength(S=mel_spectrogram, sr=sr)
+    features.onset_envelope = onset_env
+
+    if beat_times is not None:
+        beat_times = np.sort(np.asarray(beat_times, dtype=np.float64))
+        beats = np.unique(mlaudio.seconds_to_frames(beat_times, apply_trim_offset=True))
+        features.beats = beats[(beats >= 0) & (beats < onset_env.shape[-1])]
+        if bpm is None and beat_times.size > 1:
+            bpm = 60 / np.median(np.diff(beat_times))
+        features.bpm = (float(bpm) if bpm is not None else 120.0) * tempo_scale
+        return
+
+    if bpm is not None:
+        features.beats = _beat_grid(onset_env, float(bpm), mlaudio.analysis_rate, hop_length)
+        features.bpm = float(bpm) * tempo_scale
+        return
+
+    # The tempo estimate and the beat tracker share the same tempogram,
+    # with the window beat_track would otherwise compute it with
+    features.tempogram = librosa.feature.tempogram(
+        onset_envelope=onset_env,
+        sr=sr,
+        hop_length=hop_length,
+        win_length=librosa.time_to_frames(8.0, sr=sr, hop_length=hop_length).item(),
+    )
+    features.bpm = float(librosa.feature.tempo(onset_envelope=onset_env, tg=features.tempogram, sr=sr, hop_length=hop_length)[0])
+    _, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length, bpm=features.bpm)
 
-    return chroma, power_db, bpm, beats
+    pulse = librosa.beat.plp(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    beats_plp = np.flatnonzero(librosa.util.localmax(pulse))
 
+    # union1d returns the sorted union
+    features.beats = np.union1d(beats, beats_plp)
 
-@njit
-def _db_diff(power_db_f1: np.ndarray, power_db_f2: np.ndarray) -> float:
-    return np.abs(np.max(power_db_f1) - np.max(power_db_f2))
+
+def _beat_grid(onset_env: np.ndarray, bpm: float, sr: int, hop_length: int) -> np.ndarray:
+    """Returns the frames of a beat grid at `bpm`, with the phase that best aligns it to the onsets."""
+    n_frames = onset_env.shape[-1]
+    period = 60 * sr / (hop_length * bpm)
+    offsets = np.arange(max(1, int(np.ceil(period))))
+    positions = np.rint(offsets[:, np.newaxis] + np.arange(0, n_frames, period)).astype(np.int64)
+    in_track = positions < n_frames
+    strength = np.where(in_track, onset_env[np.minimum(positions, n_frames - 1)], 0).sum(axis=1)
+    best = int(np.argmax(strength))
+    return positions[best][in_track[best]]
+
+
+def _beat_synchronous_features(features: AudioFeatures) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Averages the chroma and power spectrograms between consecutive beats (one column per beat, plus the frames before the first beat).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: the (first frame of each column, beat-synchronous chroma, beat-synchronous power spectrogram in dB, column index of each beat)
+    """
+    n_frames = features.chroma.shape[-1]
+    beats = features.beats[features.beats < n_frames]
+    column_frames = librosa.util.fix_frames(beats, x_min=0, x_max=n_frames)[:-1]
+    chroma = librosa.util.sync(features.chroma, beats, aggregate=np.mean)
+    power_db = librosa.util.sync(features.power_db, beats, aggregate=np.mean)
+    return column_frames, chroma, power_db, np.searchsorted(column_frames, beats)
 
 
 @njit
@@ -279,64 +624,219 @@ def _norm(a: np.ndarray) -> float:
     return np.sqrt(np.sum(np.abs(a) ** 2, axis=0))
 
 
-@njit(cache=True)
+# Magic constants of the candidate search
+## Mainly found through trial and error,
+## higher values typically result in the inclusion of musically unrelated beats/notes
+ACCEPTABLE_NOTE_DEVIATION = 0.0875
+## Since the loudness comparison takes a perceptually weighted power_db frame,
+## the difference should be imperceptible (ideally, close to 0)
+## Based on trial and error, values higher than ~0.5 have a perceptible
+## difference in loudness
+ACCEPTABLE_LOUDNESS_DIFFERENCE = 0.5
+
+
+def set_analysis_threads(n_threads: Optional[int]):
+    """Sets the number of threads used by the parallel analysis kernels of the calling thread.
+
+    Useful to avoid oversubscribing the CPU when several tracks are analyzed in parallel (e.g. several processes or server jobs).
+
+    Args:
+        n_threads (int, optional): Number of threads, capped at the number of threads numba was started with (NUMBA_NUM_THREADS). None keeps the current setting.
+    """
+    if n_threads is not None:
+        set_num_threads(max(1, min(n_threads, numba_config.NUMBA_NUM_THREADS)))
+
+
+def _repetition_lags(
+    chroma: np.ndarray,
+    min_loop_duration: int,
+    max_loop_duration: int,
+    n_lags: int,
+    tolerance: int,
+) -> Optional[np.ndarray]:
+    """Finds the lags (in frames) at which the track repeats itself, to seed the candidate search.
+
+    The chroma is averaged over fixed blocks of half the tolerance, so that the lags are evenly spaced in time,
+    and the mean cosine similarity of the blocks that are `lag` blocks apart is computed for every lag at once
+    by FFT-based autocorrelation. The `n_lags` highest peaks among the lags within the loop duration bounds are kept.
+
+    Args:
+        chroma (np.ndarray): The (frame-level) chroma spectrogram
+        min_loop_duration (int): Minimum loop duration (in frames)
+        max_loop_duration (int): Maximum loop duration (in frames)
+        n_lags (int): Number of dominant lags to keep
+        tolerance (int): Minimum distance between two dominant lags (in frames)
+
+    Returns:
+        Optional[np.ndarray]: The dominant lags (in frames), highest peak first, or None if no lag is within the loop duration bounds.
+    """
+    block_size = max(1, tolerance // 2)
+    n_blocks = chroma.shape[-1] // block_size
+    if n_blocks < 3:
+        return None
+    blocks = chroma[..., : n_blocks * block_size].reshape(chroma.shape[0], n_blocks, block_size).mean(axis=-1)
+    blocks = librosa.util.normalize(blocks, norm=2, axis=0)
+    # Zero-padded to twice the length, so that the autocorrelation is linear instead of circular
+    spectrum = np.fft.rfft(blocks, n=2 * n_blocks, axis=-1)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2, n=2 * n_blocks, axis=-1)[..., :n_blocks].sum(axis=0)
+    similarity = autocorrelation / np.arange(n_blocks, 0, -1)
+
+    min_lag = max(1, (min_loop_duration - tolerance) // block_size)
+    max_lag = min(n_blocks - 1, -(-(max_loop_duration + tolerance) // block_size))
+    if min_lag > max_lag:
+        return None
+
+    # Padded so that a maximum at either end of the lag range is reported as a peak too;
+    # peaks closer than the tolerance to a higher one would search the same loop lengths
+    padded = np.concatenate([[-np.inf], similarity[min_lag : max_lag + 1], [-np.inf]])
+    peaks, _ = scipy.signal.find_peaks(padded, distance=max(1, 2 * tolerance // block_size))
+    peaks = peaks - 1 if peaks.size else np.array([np.argmax(similarity[min_lag : max_lag + 1])])
+    peaks += min_lag
+    dominant = peaks[np.argsort(similarity[peaks])[::-1][:n_lags]]
+    return dominant * block_size
+
+
 def _find_candidate_pairs(
     chroma: np.ndarray,
     power_db: np.ndarray,
     beats: np.ndarray,
     min_loop_duration: int,
     max_loop_duration: int,
+    beat_frames: Optional[np.ndarray] = None,
+    loop_durations: Optional[np.ndarray] = None,
 ) -> List[Tuple[int, int, float, float]]:
     """Generates a list of all valid candidate loop pairs using combinations of beat indices,
     by comparing the notes using the chroma spectrogram and their loudness difference
 
+    For each loop end, only the starts within [end - max_loop_duration, end - min_loop_duration] are
+    compared, which are found by binary search in the (sorted) beat positions. If `loop_durations`
+    are given, only the starts within those ranges of loop durations (and the bounds) are compared.
+    The loop ends are split across the analysis threads (see `set_analysis_threads`); the pairs are
+    returned in the same order regardless of the number of threads.
+
     Args:
         chroma (np.ndarray): The chroma spectrogram
         power_db (np.ndarray): The power spectrogram in dB
-        beats (np.ndarray): The frame indices of detected beats
+        beats (np.ndarray): The frame indices of detected beats in ascending order (column indices of `chroma` and `power_db`)
         min_loop_duration (int): Minimum loop duration (in frames)
         max_loop_duration (int): Maximum loop duration (in frames)
+        beat_frames (np.ndarray, optional): The frame positions of `beats`, if the spectrograms are beat-synchronous (see `_beat_synchronous_features`). Defaults to None (`beats` are frames).
+        loop_durations (np.ndarray, optional): The (lowest, highest) loop durations to compare (in frames), one range per row, e.g. around the lags from `_repetition_lags`. Defaults to None (all the loop durations within the bounds).
 
     Returns:
         List[Tuple[int, int, float, float]]: A list of tuples containing each candidate loop pair data in the following format (loop_start, loop_end, note_distance, loudness_difference)
     """
-    candidate_pairs = []
-
-    # Magic constants
-    ## Mainly found through trial and error,
-    ## higher values typically result in the inclusion of musically unrelated beats/notes
-    ACCEPTABLE_NOTE_DEVIATION = 0.0875
-    ## Since the _db_diff comparison is takes a perceptually weighted power_db frame,
-    ## the difference should be imperceptible (ideally, close to 0)
-    ## Based on trial and error, values higher than ~0.5 have a perceptible
-    ## difference in loudness
-    ACCEPTABLE_LOUDNESS_DIFFERENCE = 0.5
-
+    beats = np.asarray(beats, dtype=np.int64)
+    beat_frames = beats if beat_frames is None else np.asarray(beat_frames, dtype=np.int64)
+    if beats.size == 0:
+        return []
+    # Only the beat frames are compared: gathering them once keeps the comparisons in contiguous memory,
+    # and the loudness of a frame (its maximum in dB) is computed once per beat instead of once per pair
+    beat_chroma = np.ascontiguousarray(chroma[..., beats].T)
+    beat_loudness = np.max(power_db[..., beats], axis=0)
     deviation = _norm(chroma[..., beats] * ACCEPTABLE_NOTE_DEVIATION)
 
-    for idx, loop_end in enumerate(beats):
-        for loop_start in beats:
-            loop_length = loop_end - loop_start
-            if loop_length < min_loop_duration:
-                break
-            if loop_length > max_loop_duration:
-                continue
-            note_distance = _norm(chroma[..., loop_end] - chroma[..., loop_start])
-
-            if note_distance <= deviation[idx]:
-                loudness_difference = _db_diff(
-                    power_db[..., loop_end], power_db[..., loop_start]
-                )
-                loop_pair = (
-                    int(loop_start),
-                    int(loop_end),
-                    note_distance,
-                    loudness_difference,
-                )
-                if loudness_difference <= ACCEPTABLE_LOUDNESS_DIFFERENCE:
-                    candidate_pairs.append(loop_pair)
-
-    return candidate_pairs
+    bands = _loop_duration_bands(loop_durations, min_loop_duration, max_loop_duration)
+    # Ranges [first_start, stop_start) of the starts within each band of loop durations of each loop end
+    # (one column per band, in ascending order of the starts)
+    first_start = np.searchsorted(beat_frames, beat_frames[:, None] - bands[:, 1], side="left")
+    stop_start = np.searchsorted(beat_frames, beat_frames[:, None] - bands[:, 0], side="right")
+
+    counts = _count_candidate_pairs(beat_chroma, beat_loudness, deviation, first_start, stop_start)
+    # Each loop end writes its pairs at its own offset, in the serial order
+    offsets = np.zeros(beats.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    starts, ends, note_distances, loudness_differences = _fill_candidate_pairs(
+        beat_chroma, beat_loudness, deviation, beat_frames, first_start, stop_start, offsets
+    )
+    return list(zip(starts.tolist(), ends.tolist(), note_distances.tolist(), loudness_differences.tolist()))
+
+
+def _loop_duration_bands(
+    loop_durations: Optional[np.ndarray], min_loop_duration: int, max_loop_duration: int
+) -> np.ndarray:
+    """Returns the ranges of loop durations to search (within the bounds, without overlaps), longest first, as (lowest, highest) rows."""
+    if loop_durations is None:
+        return np.array([[min_loop_duration, max_loop_duration]], dtype=np.int64)
+    bands = []
+    for lowest, highest in sorted((max(int(lo), min_loop_duration), min(int(hi), max_loop_duration)) for lo, hi in loop_durations):
+        if lowest > highest:
+            continue
+        if bands and lowest <= bands[-1][1] + 1:
+            bands[-1][1] = max(bands[-1][1], highest)
+        else:
+            bands.append([lowest, highest])
+    return np.array(bands[::-1], dtype=np.int64).reshape(-1, 2)
+
+
+@njit(cache=True)
+def _is_candidate_pair(beat_chroma, beat_loudness, deviation, start_idx, end_idx):
+    """Returns the (note distance, loudness difference) of the pair of beats, with a negative note distance if it is not a candidate."""
+    note_distance = _norm(beat_chroma[end_idx] - beat_chroma[start_idx])
+    if note_distance <= deviation[end_idx]:
+        loudness_difference = np.abs(beat_loudness[end_idx] - beat_loudness[start_idx])
+        if loudness_difference <= ACCEPTABLE_LOUDNESS_DIFFERENCE:
+            return note_distance, loudness_difference
+    return -1.0, 0.0
+
+
+@njit(cache=True, parallel=True)
+def _count_candidate_pairs(beat_chroma, beat_loudness, deviation, first_start, stop_start):
+    counts = np.zeros(first_start.shape[0], dtype=np.int64)
+    for end_idx in prange(first_start.shape[0]):
+        for band in range(first_start.shape[1]):
+            for start_idx in range(first_start[end_idx, band], stop_start[end_idx, band]):
+                note_distance, _ = _is_candidate_pair(beat_chroma, beat_loudness, deviation, start_idx, end_idx)
+                if note_distance >= 0:
+                    counts[end_idx] += 1
+    return counts
+
+
+@njit(cache=True, parallel=True)
+def _fill_candidate_pairs(beat_chroma, beat_loudness, deviation, beats, first_start, stop_start, offsets):
+    n_pairs = offsets[-1]
+    starts = np.empty(n_pairs, dtype=np.int64)
+    ends = np.empty(n_pairs, dtype=np.int64)
+    note_distances = np.empty(n_pairs, dtype=beat_chroma.dtype)
+    loudness_differences = np.empty(n_pairs, dtype=beat_loudness.dtype)
+    for end_idx in prange(beats.size):
+        pos = offsets[end_idx]
+        for band in range(first_start.shape[1]):
+            for start_idx in range(first_start[end_idx, band], stop_start[end_idx, band]):
+                note_distance, loudness_difference = _is_candidate_pair(beat_chroma, beat_loudness, deviation, start_idx, end_idx)
+                if note_distance >= 0:
+                    starts[pos] = beats[start_idx]
+                    ends[pos] = beats[end_idx]
+                    note_distances[pos] = note_distance
+                    loudness_differences[pos] = loudness_difference
+                    pos += 1
+    return starts, ends, note_distances, loudness_differences
+
+
+def _suppress_near_duplicates(candidate_pairs: List[LoopPair], tolerance: int) -> List[LoopPair]:
+    """Keeps a single candidate of each cluster of candidates around the same loop points (non-maximum suppression).
+
+    The candidates are bucketed by (loop start, loop end) in a grid of `tolerance` frames, and only the one with the
+    lowest note distance (then loudness difference) of each bucket is kept.
+
+    Args:
+        candidate_pairs (List[LoopPair]): The candidate loop pairs
+        tolerance (int): Size of the grid cells (in frames)
+
+    Returns:
+        List[LoopPair]: The remaining candidates, in their original order
+    """
+    if tolerance <= 1 or len(candidate_pairs) < 2:
+        return candidate_pairs
+    starts = np.fromiter((pair._loop_start_frame_idx for pair in candidate_pairs), dtype=np.int64, count=len(candidate_pairs))
+    ends = np.fromiter((pair._loop_end_frame_idx for pair in candidate_pairs), dtype=np.int64, count=len(candidate_pairs))
+    note_distances = np.fromiter((pair.note_distance for pair in candidate_pairs), dtype=np.float64, count=len(candidate_pairs))
+    loudness_differences = np.fromiter((pair.loudness_difference for pair in candidate_pairs), dtype=np.float64, count=len(candidate_pairs))
+    start_cells, end_cells = starts // tolerance, ends // tolerance
+    buckets = start_cells * (end_cells.max() + 1) + end_cells
+    order = np.lexsort((loudness_differences, note_distances, buckets))
+    _, best = np.unique(buckets[order], return_index=True)
+    return [candidate_pairs[i] for i in np.sort(order[best])]
 
 
 def _assess_and_filter_loop_pairs(
@@ -344,28 +844,35 @@ def _assess_and_filter_loop_pairs(
     chroma: np.ndarray,
     bpm: float,
     candidate_pairs: List[LoopPair],
-    structure_info: Dict,
     disable_pruning: bool = False,
     score_weights: dict = None,
+    column_frames: Optional[np.ndarray] = None,
+    duplicate_tolerance: int = 0,
 ) -> List[LoopPair]:
-    """Assigns the scores to each loop pair and prunes the list of candidate loop pairs
+    """Assigns the (chroma similarity) scores to each loop pair and prunes the list of candidate loop pairs.
+    The remaining score components are computed when the pairs are finalized (see `LoopPairList`).
 
     Args:
         mlaudio (MLAudio): MLAudio object of the track being analyzed
         chroma (np.ndarray): The chroma spectrogram
         bpm (float): The estimated bpm/tempo of the track
         candidate_pairs (List[LoopPair]): The list of candidate loop pairs found
-        structure_info (Dict): The music structure analysis information
         disable_pruning (bool, optional): Returns all the candidate loop points without filtering. Defaults to False.
         score_weights (dict, optional): The weights for the advanced scoring. Defaults to None.
+        column_frames (np.ndarray, optional): The first frame of each column, if `chroma` is beat-synchronous (see `_beat_synchronous_features`). Defaults to None.
+        duplicate_tolerance (int, optional): Grid size of the suppression of near-duplicate candidates after pruning (in frames, see `_suppress_near_duplicates`); not applied with disable_pruning. Defaults to 0 (all the candidates are kept).
 
     Returns:
         List[LoopPair]: A scored and filtered list of valid loop candidate pairs
     """
-    beats_per_second = bpm / 60
     num_test_beats = 12
-    seconds_to_test = num_test_beats / beats_per_second
-    test_offset = mlaudio.samples_to_frames(int(seconds_to_test * mlaudio.rate))
+    if column_frames is not None:
+        # Each column of beat-synchronous features is a beat
+        test_offset = num_test_beats
+    else:
+        beats_per_second = bpm / 60
+        seconds_to_test = num_test_beats / beats_per_second
+        test_offset = mlaudio.samples_to_frames(int(seconds_to_test * mlaudio.rate))
 
     if test_offset > chroma.shape[-1]:
         test_offset = chroma.shape[-1] // 4
@@ -375,40 +882,27 @@ def _assess_and_filter_loop_pairs(
     else:
         pruned_candidate_pairs = candidate_pairs
 
+    if duplicate_tolerance > 0 and not disable_pruning:
+        n_pruned = len(pruned_candidate_pairs)
+        pruned_candidate_pairs = _suppress_near_duplicates(pruned_candidate_pairs, duplicate_tolerance)
+        logging.info(f"Suppressed {n_pruned - len(pruned_candidate_pairs)} near-duplicate loop points")
+
     weights = _weights(test_offset, start=max(2, test_offset // num_test_beats), stop=1)
 
+    def chroma_index(frame: int) -> int:
+        return frame if column_frames is None else int(np.searchsorted(column_frames, frame))
+
     # 預先計算所有分數
     for pair in pruned_candidate_pairs:
         # 原始分數
         original_score = _calculate_loop_score(
-            int(pair._loop_start_frame_idx),
-            int(pair._loop_end_frame_idx),
+            chroma_index(int(pair._loop_start_frame_idx)),
+            chroma_index(int(pair._loop_end_frame_idx)),
             chroma,
             test_duration=test_offset,
             weights=weights,
         )
         pair.original_score = original_score
-        # 結構分數
-        structure_score = _evaluate_structure_similarity(
-            int(pair._loop_start_frame_idx),
-            int(pair._loop_end_frame_idx),
-            structure_info['segments']
-        )
-        pair.structure_score = structure_score
-        # 和弦分數
-        chord_score = _evaluate_chord_progression(
-            int(pair._loop_start_frame_idx),
-            int(pair._loop_end_frame_idx),
-            structure_info['chord_labels'],
-        )
-        pair.chord_score = chord_score
-        # MFCC分數
-        mfcc_score = _evaluate_mfcc_similarity(
-            int(pair._loop_start_frame_idx),
-            int(pair._loop_end_frame_idx),
-            structure_info['mfcc']
-        )
-        pair.mfcc_score = mfcc_score
         # 預設分數為原始分數
         pair.score = original_score
     # 預設排序為原始分數
@@ -568,69 +1062,102 @@ def _weights(length: int, start: int = 100, stop: int = 1):
     return np.geomspace(start, stop, num=length)
 
 
-def analyze_music_structure(mlaudio: MLAudio) -> Dict:
+def analyze_music_structure(
+    mlaudio: MLAudio,
+    features: Optional[AudioFeatures] = None,
+    n_segments: int = STRUCTURE_SEGMENTS,
+) -> Dict:
     """分析音樂的基本結構，找出重複段落和主題部分
 
+    段落分割與自相似矩陣以節拍同步的特徵計算（沒有節拍時以固定長度的區塊取平均），
+    記憶體與時間隨曲長近似線性成長，邊界再對應回幀索引。
+
     Args:
         mlaudio (MLAudio): MLAudio 物件，包含音訊數據
+        features (AudioFeatures, optional): 搜尋時已計算的特徵（梅爾頻譜圖、起音包絡、節拍），提供時直接重用
+        n_segments (int, optional): 段落數量. Defaults to STRUCTURE_SEGMENTS.
 
     Returns:
         Dict: 包含音樂結構分析結果的字典，包括：
-            - segments: 音樂段落的邊界點
-            - similarity_matrix: 自相似矩陣
+            - segments: 音樂段落的邊界點（幀）
+            - similarity_matrix: 節拍同步特徵的稀疏自相似矩陣（scipy.sparse）
             - chord_features: 和弦特徵
-            - chord_labels: 和弦標籤序列
+            - chord_ids: 每幀的和弦 id 序列（int8，標籤見 `_chord_templates`）
             - mfcc: MFCC特徵
+            - onset_envelope: 起音包絡（未進行節拍分析時為 None）
+            - beats: 節拍的幀索引（未進行節拍分析時為 None）
     """
-    # 計算梅爾頻譜圖
-    S = librosa.feature.melspectrogram(
-        y=mlaudio.audio, 
-        sr=mlaudio.rate,
-        n_mels=128,
-        fmax=8000
-    )
-    
-    # 計算音樂的自相似矩陣
-    similarity_matrix = librosa.segment.recurrence_matrix(
-        S,
-        mode='affinity',
-        sym=True
-    )
-    
-    # 使用 librosa 的 laplacian segmentation 找出段落
-    segments = librosa.segment.agglomerative(S, k=8)
+    # 計算梅爾頻譜圖（搜尋時已計算則重用）
+    if features is not None:
+        S = features.mel_spectrogram
+    else:
+        S = librosa.feature.melspectrogram(
+            y=mlaudio.audio, 
+            sr=mlaudio.analysis_rate,
+            n_fft=mlaudio.n_fft,
+            hop_length=mlaudio.hop_length,
+            n_mels=128,
+            fmax=8000
+        )
     
+    # 節拍同步（或固定區塊）的特徵：每欄為 [column_frames[i], column_frames[i + 1]) 的平均
+    beats = features.beats if features is not None else None
+    if beats is None or beats.size == 0:
+        block_frames = max(1, int(round(SEGMENTATION_BLOCK_SECONDS * mlaudio.analysis_rate / mlaudio.hop_length)))
+        beats = np.arange(block_frames, S.shape[-1], block_frames)
+    column_frames = librosa.util.fix_frames(beats, x_min=0, x_max=S.shape[-1])[:-1]
+    S_sync = librosa.util.sync(S, beats, aggregate=np.mean)
+
+    # 計算音樂的自相似矩陣（稀疏，scipy.sparse 不支援 float16）
+    if S_sync.shape[-1] > 2:
+        similarity_matrix = librosa.segment.recurrence_matrix(
+            S_sync,
+            mode='affinity',
+            sym=True,
+            sparse=True
+        ).astype(np.result_type(mlaudio.cache_dtype, np.float32))
+    else:
+        similarity_matrix = scipy.sparse.csr_matrix((S_sync.shape[-1], S_sync.shape[-1]), dtype=np.float32)
+
+    # 使用 librosa 的 agglomerative segmentation 找出段落，再將欄索引對應回幀
+    segments = column_frames[librosa.segment.agglomerative(S_sync, k=max(1, min(n_segments, S_sync.shape[-1])))]
+
     # 計算和弦特徵
     chromagram = librosa.feature.chroma_cqt(
         y=mlaudio.audio, 
-        sr=mlaudio.rate
+        sr=mlaudio.analysis_rate,
+        hop_length=mlaudio.hop_length
     )
-    chord_features = np.sum(chromagram, axis=1)
+    chord_features = np.sum(chromagram, axis=1).astype(mlaudio.cache_dtype)
     
-    # 新增：和弦標籤序列
-    chord_labels = _detect_chord_labels(chromagram, mlaudio.rate)
+    # 新增：和弦序列（每幀的和弦 id，int8）
+    chord_ids = _detect_chord_ids(chromagram, mlaudio.analysis_rate)
     
     # 新增MFCC特徵
     mfcc = librosa.feature.mfcc(
         y=mlaudio.audio,
-        sr=mlaudio.rate,
+        sr=mlaudio.analysis_rate,
         n_mfcc=13,
-        hop_length=512
-    )
+        n_fft=mlaudio.n_fft,
+        hop_length=mlaudio.hop_length
+    ).astype(mlaudio.cache_dtype)
     
     return {
         'segments': segments,
         'similarity_matrix': similarity_matrix,
         'chord_features': chord_features,
-        'chord_labels': chord_labels,
-        'mfcc': mfcc
+        'chord_ids': chord_ids,
+        'mfcc': mfcc,
+        'onset_envelope': features.onset_envelope if features is not None else None,
+        'beats': features.beats if features is not None else None,
     }
 
 def _softmax(x, axis=0):
     e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
     return e_x / np.sum(e_x, axis=axis, keepdims=True)
 
-def _detect_chord_labels(chromagram, sr):
+def _chord_templates() -> Tuple[np.ndarray, List[str]]:
+    """Returns the 24 major/minor triad templates and their labels, indexed by chord id."""
     maj_template = np.array([1, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0])
     min_template = np.array([1, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0])
     templates = []
@@ -641,72 +1168,108 @@ def _detect_chord_labels(chromagram, sr):
     for i in range(12):
         templates.append(np.roll(min_template, i))
         labels.append(librosa.midi_to_note(60 + i, unicode=False)[:-1] + ':min')
-    templates = np.stack(templates)
+    return np.stack(templates), labels
+
+
+def _detect_chord_ids(chromagram, sr) -> np.ndarray:
+    """Returns the chord id (index into the `_chord_templates` labels) of each frame as an int8 array."""
+    templates, labels = _chord_templates()
     scores = np.dot(templates, chromagram)
     scores = _softmax(scores, axis=0)  # 修正：轉為機率分布
-    transition_matrix = np.ones((24, 24)) / 24
+    transition_matrix = np.ones((len(labels), len(labels))) / len(labels)
     path = librosa.sequence.viterbi(scores, transition_matrix)
-    chord_labels = [labels[i] for i in path]
-    return chord_labels
+    return path.astype(np.int8)
 
-def _evaluate_structure_similarity(
-    loop_start: int,
-    loop_end: int,
+def _evaluate_structure_similarities(
+    loop_starts: np.ndarray,
+    loop_ends: np.ndarray,
     segments: np.ndarray,
-    threshold: int = 1000
-) -> float:
-    """評估迴圈點在音樂結構上的相似度
+    threshold: float
+) -> np.ndarray:
+    """評估迴圈點在音樂結構上的相似度（所有迴圈點一次計算）
+
+    每個迴圈點與段落邊界的距離小於閾值時加 0.5 分；以 searchsorted 在排序後的邊界中
+    計算每個點附近的邊界數量，不需逐一比較。
 
     Args:
-        loop_start (int): 迴圈開始點
-        loop_end (int): 迴圈結束點
-        segments (np.ndarray): 段落邊界點陣列
-        threshold (int, optional): 判定接近段落邊界的閾值. Defaults to 1000.
+        loop_starts (np.ndarray): 迴圈開始點（幀）
+        loop_ends (np.ndarray): 迴圈結束點（幀）
+        segments (np.ndarray): 段落邊界點陣列（幀）
+        threshold (float): 判定接近段落邊界的閾值（幀）
 
     Returns:
-        float: 結構相似度分數 (0.0 到 1.0)
+        np.ndarray: 每組迴圈點的結構相似度分數 (0.0 到 1.0)
     """
-    similarity_score = 0.0
-    
-    # 檢查迴圈點是否在合適的段落邊界
-    for segment in segments:
-        if abs(loop_start - segment) < threshold:
-            similarity_score += 0.5
-        if abs(loop_end - segment) < threshold:
-            similarity_score += 0.5
-            
+    boundaries = np.sort(segments)
+
+    def boundaries_near(frames: np.ndarray) -> np.ndarray:
+        # 落在 (frame - threshold, frame + threshold) 開區間內的邊界數量
+        return np.searchsorted(boundaries, frames + threshold, side='left') - np.searchsorted(boundaries, frames - threshold, side='right')
+
+    similarity_scores = 0.5 * (boundaries_near(loop_starts) + boundaries_near(loop_ends))
     # 標準化分數到 0-1 範圍
-    return min(1.0, similarity_score)
+    return np.minimum(1.0, similarity_scores)
 
-def _evaluate_chord_progression(
-    loop_start: int,
-    loop_end: int,
-    chord_labels: list,
+def _evaluate_chord_progressions(
+    loop_starts: np.ndarray,
+    loop_ends: np.ndarray,
+    chord_ids: np.ndarray,
     window_size: int = 2
-) -> float:
-    """更強的和弦進行相似度：比較 loop_start/loop_end 前後的和弦標籤是否一致"""
-    start_chord = chord_labels[max(0, loop_start - window_size):loop_start + window_size]
-    end_chord = chord_labels[max(0, loop_end - window_size):loop_end + window_size]
-    # 只要有重疊的和弦標籤就給高分
-    if set(start_chord) & set(end_chord):
-        return 1.0
-    return 0.0
-
-def _evaluate_mfcc_similarity(
-    loop_start: int,
-    loop_end: int,
+) -> np.ndarray:
+    """更強的和弦進行相似度：比較 loop_start/loop_end 前後的和弦是否一致（所有迴圈點一次計算）
+
+    直接從 int8 和弦 id 取出各視窗內的和弦（視窗外為 -1），兩個視窗有共同的和弦就給高分；
+    額外記憶體只與迴圈點數量及視窗大小有關，與音軌長度無關。
+
+    Returns:
+        np.ndarray: 每組迴圈點的和弦分數 (0.0 或 1.0)
+    """
+    if chord_ids.size == 0:
+        return np.zeros(len(loop_starts), dtype=np.float64)
+    offsets = np.arange(-window_size, window_size)
+
+    def chords_in_window(centers: np.ndarray) -> np.ndarray:
+        frames = np.asarray(centers)[:, None] + offsets
+        inside = (frames >= 0) & (frames < chord_ids.size)
+        return np.where(inside, chord_ids[np.clip(frames, 0, chord_ids.size - 1)], -1)
+
+    start_chords = chords_in_window(loop_starts)
+    end_chords = chords_in_window(loop_ends)
+    shared = (start_chords[:, :, None] == end_chords[:, None, :]) & (start_chords[:, :, None] >= 0)
+    return shared.any(axis=(1, 2)).astype(np.float64)
+
+def _evaluate_mfcc_similarities(
+    loop_starts: np.ndarray,
+    loop_ends: np.ndarray,
     mfcc: np.ndarray,
     window_size: int = 4
-) -> float:
-    """評估迴圈點的 MFCC 音色相似度"""
-    start_window = mfcc[:, max(0, loop_start - window_size):loop_start]
-    end_window = mfcc[:, loop_end:min(mfcc.shape[1], loop_end + window_size)]
-    if start_window.shape[1] == 0 or end_window.shape[1] == 0:
-        return 0.0
-    start_vec = np.mean(start_window, axis=1)
-    end_vec = np.mean(end_window, axis=1)
-    sim = np.dot(start_vec, end_vec) / (np.linalg.norm(start_vec) * np.linalg.norm(end_vec) + 1e-8)
-    return max(0.0, sim)
+) -> np.ndarray:
+    """評估迴圈點的 MFCC 音色相似度（所有迴圈點一次計算）
+
+    比較 loop_start 之前與 loop_end 之後各 `window_size` 幀的平均 MFCC 向量的餘弦相似度。
+    平均向量由 MFCC 的累積和求出，計算量與視窗大小無關。
+
+    Returns:
+        np.ndarray: 每組迴圈點的 MFCC 相似度分數（0.0 到 1.0，任一視窗為空時為 0.0）
+    """
+    n_frames = mfcc.shape[1]
+    # 累積和以 float64 計算（float16/float32 快取長時間累加會失去精度）
+    cumulative = np.zeros((n_frames + 1, mfcc.shape[0]), dtype=np.float64)
+    np.cumsum(mfcc.T, axis=0, dtype=np.float64, out=cumulative[1:])
+
+    def window_means(window_start: np.ndarray, window_end: np.ndarray):
+        window_start = np.clip(window_start, 0, n_frames)
+        window_end = np.clip(window_end, 0, n_frames)
+        lengths = window_end - window_start
+        means = (cumulative[window_end] - cumulative[window_start]) / np.maximum(lengths, 1)[:, np.newaxis]
+        return means, lengths > 0
+
+    start_vecs, start_valid = window_means(loop_starts - window_size, loop_starts)
+    end_vecs, end_valid = window_means(loop_ends, loop_ends + window_size)
+    sims = np.einsum('ij,ij->i', start_vecs, end_vecs) / (
+        np.linalg.norm(start_vecs, axis=1) * np.linalg.norm(end_vecs, axis=1) + 1e-8
+    )
+    return np.where(start_valid & end_valid, np.maximum(0.0, sims), 0.0)
 
 @njit(cache=True)
 def nearest_zero_crossing(audio: np.ndarray, rate: int, sample_idx: int) -> int:
@@ -727,6 +1290,26 @@ def nearest_zero_crossing(audio: np.ndarray, rate: int, sample_idx: int) -> int:
     Returns:
         int: the index of the best sample point that is at a rising zero crossing point closest to the `sample_idx` provided, returns `sample_idx` if none where found
     """
+    window_size = int(max(1, rate / 100))
+    return _zero_crossing_in_window(
+        audio,
+        rate,
+        sample_idx,
+        np.empty(window_size),
+        np.empty(window_size, dtype=audio.dtype),
+    )
+
+
+@njit(cache=True)
+def _zero_crossing_in_window(
+    audio: np.ndarray,
+    rate: int,
+    sample_idx: int,
+    dist: np.ndarray,
+    one_dist: np.ndarray,
+) -> int:
+    """`nearest_zero_crossing` using the preallocated scratch buffers `dist` (float64) and `one_dist` (audio dtype),
+    both with room for at least `int(max(1, rate / 100))` samples."""
     # Re-implementation of Audacity's NearestZeroCrossing function in Python
     # https://github.com/audacity/audacity/blob/057bf4ee6f71962cd8ecc6dbccf0852695340758/src/menus/SelectMenus.cpp#L30
     # Original credit goes to the Audacity team and contributors
@@ -745,11 +1328,14 @@ def nearest_zero_crossing(audio: np.ndarray, rate: int, sample_idx: int) -> int:
     offset_correction = abs(sample_idx - offset) if sample_idx - offset < 0 else 0
 
     sample_window_length = sample_window.shape[0]
-    dist = np.zeros(sample_window_length)
+    if sample_window_length == 0:
+        return sample_idx
+    dist[:sample_window_length] = 0
 
     for channel in range(n_channels):
         prev = 2.0
-        one_dist = sample_window[..., channel].copy()
+        for i in range(sample_window_length):
+            one_dist[i] = sample_window[i, channel]
         for i in range(sample_window_length):
             fdist = np.abs(one_dist[i])
             if prev * one_dist[i] > 0:  # both same sign? No good.
@@ -763,7 +1349,7 @@ def nearest_zero_crossing(audio: np.ndarray, rate: int, sample_idx: int) -> int:
             dist[i] += one_dist[i]
             dist[i] += 0.1 * abs(i - offset + offset_correction) / (window_size / 2)
 
-    argmin = np.argmin(dist)
+    argmin = np.argmin(dist[:sample_window_length])
     minimum_dist = dist[argmin]
 
     # If we're worse than 0.2 on average, on one track, then no good.
@@ -774,3 +1360,83 @@ def nearest_zero_crossing(audio: np.ndarray, rate: int, sample_idx: int) -> int:
         return sample_idx
 
     return int(sample_idx + argmin - offset + offset_correction)
+
+
+@njit(cache=True)
+def _seam_correlation(audio: np.ndarray, loop_start: int, loop_end: int, window: int) -> float:
+    """Normalized cross-correlation (at zero lag) between the audio surrounding `loop_end` and the audio surrounding `loop_start`,
+    i.e. how similar the audio heard across the jump is to the audio it replaces."""
+    before = min(window, loop_start, loop_end)
+    after = min(window, audio.shape[0] - loop_start, audio.shape[0] - loop_end)
+    dot = 0.0
+    energy_start = 0.0
+    energy_end = 0.0
+    for i in range(-before, after):
+        for channel in range(audio.shape[1]):
+            a = audio[loop_start + i, channel]
+            b = audio[loop_end + i, channel]
+            dot += a * b
+            energy_start += a * a
+            energy_end += b * b
+    if energy_start == 0.0 or energy_end == 0.0:
+        return 0.0
+    return dot / np.sqrt(energy_start * energy_end)
+
+
+def refine_loop_points(
+    audio: np.ndarray,
+    rate: int,
+    loop_starts: np.ndarray,
+    loop_ends: np.ndarray,
+    seam_window: int = 0,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Snaps many loop points to their nearest zero crossings (see `nearest_zero_crossing`) in parallel,
+    and optionally scores the resulting seams.
+
+    Each worker thread allocates its scratch buffers once and reuses them for all the points it refines.
+
+    Args:
+        audio (np.ndarray): Numpy array containing the playback audio; must be in the shape `(samples, n_channels)`
+        rate (int): Sample rate of the provided audio
+        loop_starts (np.ndarray): Loop start of each pair in samples
+        loop_ends (np.ndarray): Loop end of each pair in samples
+        seam_window (int, optional): Number of samples on each side of the refined loop points to cross-correlate (see `LoopPair.seam_score`). Defaults to 0 (seam scores are not computed).
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: the refined loop starts, the refined loop ends and the seam scores (zeros if `seam_window` is 0)
+    """
+    return _refine_loop_points(
+        audio,
+        rate,
+        np.asarray(loop_starts, dtype=np.int64),
+        np.asarray(loop_ends, dtype=np.int64),
+        seam_window,
+        get_num_threads(),
+    )
+
+
+@njit(cache=True, parallel=True)
+def _refine_loop_points(
+    audio: np.ndarray,
+    rate: int,
+    loop_starts: np.ndarray,
+    loop_ends: np.ndarray,
+    seam_window: int,
+    n_threads: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n_pairs = loop_starts.shape[0]
+    refined_starts = np.empty(n_pairs, dtype=np.int64)
+    refined_ends = np.empty(n_pairs, dtype=np.int64)
+    seam_scores = np.zeros(n_pairs)
+    window_size = int(max(1, rate / 100))
+
+    n_chunks = max(1, min(n_pairs, n_threads))
+    for chunk in prange(n_chunks):
+        dist = np.empty(window_size)
+        one_dist = np.empty(window_size, dtype=audio.dtype)
+        for idx in range(chunk, n_pairs, n_chunks):
+            refined_starts[idx] = _zero_crossing_in_window(audio, rate, loop_starts[idx], dist, one_dist)
+            refined_ends[idx] = _zero_crossing_in_window(audio, rate, loop_ends[idx], dist, one_dist)
+            if seam_window > 0:
+                seam_scores[idx] = _seam_correlation(audio, refined_starts[idx], refined_ends[idx], seam_window)
+    return refined_starts, refined_ends, seam_scores
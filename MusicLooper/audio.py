@@ -1,13 +1,71 @@
+import copy
 import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
 
+import lazy_loader as lazy
 import librosa
 import numpy as np
 
 from exceptions import AudioLoadError
 
+# Lazy-load external libraries when they're needed
+soundfile = lazy.load("soundfile")
+
+
+@dataclass(frozen=True)
+class AnalysisProfile:
+    """Resolution of the audio analysis.
+
+    Contains:
+        max_rate: Optional[int] (sample rate the audio is resampled to for analysis if the native rate is higher; None analyzes at the native rate)
+        n_fft: int (FFT window size of the spectrograms, in analysis samples)
+        hop_length: int (hop between analysis frames, in analysis samples)
+        dtype: type (floating point type of the analysis signal, the features and their intermediates; float64 only to verify float32 results)
+        cache_dtype: Optional[type] (type of the features kept for the deferred scoring of loop pairs, e.g. float16 to halve their memory; None uses `dtype`)
+    """
+
+    max_rate: Optional[int]
+    n_fft: int = 2048
+    hop_length: int = 512
+    dtype: type = np.float32
+    cache_dtype: Optional[type] = None
+
+
+ANALYSIS_PROFILES = {
+    "fast": AnalysisProfile(max_rate=22050),
+    "balanced": AnalysisProfile(max_rate=44100),
+    "precise": AnalysisProfile(max_rate=None),
+}
+# Analyzes at the native sample rate by default, like before profiles existed
+DEFAULT_ANALYSIS_PROFILE = "precise"
+
+
+def get_analysis_profile(profile: Union[str, AnalysisProfile, None]) -> AnalysisProfile:
+    """Returns the `AnalysisProfile` named `profile` (one of `ANALYSIS_PROFILES`), or `profile` itself if it already is one.
+
+    Raises:
+        ValueError: If `profile` is not a known profile name.
+    """
+    if profile is None:
+        profile = DEFAULT_ANALYSIS_PROFILE
+    if isinstance(profile, AnalysisProfile):
+        return profile
+    try:
+        return ANALYSIS_PROFILES[profile.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Unknown analysis profile \"{profile}\". Available profiles: {', '.join(ANALYSIS_PROFILES)}."
+        ) from None
+
 
 class MLAudio:
-    """Wrapper class for loading audio files and containing the necessary audio data for PyMusicLooper."""
+    """Wrapper class for loading audio files and containing the necessary audio data for PyMusicLooper.
+
+    `audio` is the mono signal used for analysis, resampled to `analysis_rate` according to the analysis profile;
+    `playback_audio` keeps the native `rate`. Frame indices refer to the analysis frames (`hop_length` analysis samples
+    apart) and sample positions to the native-rate `playback_audio`; the conversion methods map between them exactly.
+    """
 
     total_duration: int
     filepath: str
@@ -15,15 +73,21 @@ class MLAudio:
     audio: np.ndarray
     trim_offset: int
     rate: int
+    analysis_rate: int
+    n_fft: int
+    hop_length: int
+    dtype: type
+    cache_dtype: type
     playback_audio: np.ndarray
     n_channels: int
     length: int
 
-    def __init__(self, filepath: str) -> None:
+    def __init__(self, filepath: str, analysis_profile: Union[str, AnalysisProfile, None] = None) -> None:
         """Initializes the MLAudio object and its data by loading the audio using the filepath provided.
 
         Args:
             filepath (str): path to the audio file
+            analysis_profile (str | AnalysisProfile, optional): The analysis resolution, either the name of one of `ANALYSIS_PROFILES` or an `AnalysisProfile`. Defaults to `DEFAULT_ANALYSIS_PROFILE`.
 
         Raises:
             AudioLoadError: If the file could not be loaded.
@@ -42,7 +106,10 @@ class MLAudio:
         self.filepath = filepath
         self.filename = os.path.basename(filepath)
 
-        mono_signal = librosa.core.to_mono(raw_audio)
+        self.rate = sampling_rate
+        self._set_analysis_profile(analysis_profile)
+
+        mono_signal = self._analysis_signal(librosa.core.to_mono(raw_audio))
 
         if np.min(mono_signal) == 0 and np.max(mono_signal) == 0:
             raise AudioLoadError(f"\"{filepath}\" only contains silence and cannot be analyzed.")
@@ -50,11 +117,10 @@ class MLAudio:
         # Normalize audio channels to between -1.0 and +1.0 before analysis
         mono_signal /= np.max(np.abs(mono_signal))
 
+        # The trim offset is in analysis samples
         self.audio, self.trim_offset = librosa.effects.trim(mono_signal, top_db=40)
         self.trim_offset = self.trim_offset[0]
 
-        self.rate = sampling_rate
-
         # Initialize parameters for playback
         self.playback_audio = raw_audio
         # Mono if the loaded audio is 1-D, else get the number of channels from the shape (n_channels, samples)
@@ -62,42 +128,204 @@ class MLAudio:
             1 if len(self.playback_audio.shape) == 1 else self.playback_audio.shape[0]
         )
         # Convert the audio array into one suitable for playback
-        # New shape: (samples, n_channels)
-        self.playback_audio = self.playback_audio.T if self.n_channels > 1 else self.playback_audio[:, np.newaxis]
+        # New shape: (samples, n_channels), C-contiguous so that slices of it
+        # (e.g. the loop section) can be written or streamed without copying
+        self.playback_audio = np.ascontiguousarray(
+            self.playback_audio.T if self.n_channels > 1 else self.playback_audio[:, np.newaxis]
+        )
         self.length = self.playback_audio.shape[0]
 
+    def _set_analysis_profile(self, analysis_profile: Union[str, AnalysisProfile, None]):
+        profile = get_analysis_profile(analysis_profile)
+        self.analysis_rate = self.rate if profile.max_rate is None else min(self.rate, profile.max_rate)
+        self.n_fft = profile.n_fft
+        self.hop_length = profile.hop_length
+        self.dtype = profile.dtype
+        self.cache_dtype = profile.cache_dtype or profile.dtype
+
+    def _analysis_signal(self, mono_signal: np.ndarray) -> np.ndarray:
+        """Resamples a native-rate mono signal to the analysis rate and converts it to the analysis dtype."""
+        if self.analysis_rate != self.rate:
+            mono_signal = librosa.resample(mono_signal, orig_sr=self.rate, target_sr=self.analysis_rate)
+        return mono_signal.astype(self.dtype, copy=False)
+
+    def with_dtype(self, dtype: type) -> "MLAudio":
+        """Returns a shallow copy whose analysis signal, features and caches use `dtype` (e.g. float64 to verify float32 results)."""
+        audio = copy.copy(self)
+        audio.audio = self.audio.astype(dtype)
+        audio.dtype = audio.cache_dtype = dtype
+        return audio
+
+    def track_samples(self, samples):
+        """Maps sample positions of `playback_audio` to sample positions in the audio track."""
+        return samples
+
     def apply_trim_offset(self, frame):
         return (
-            librosa.samples_to_frames(
-                librosa.frames_to_samples(frame) + self.trim_offset
-            )
+            (np.asarray(frame) * self.hop_length + self.trim_offset) // self.hop_length
             if self.trim_offset
             else frame
         )
 
     def samples_to_frames(self, samples):
-        return librosa.core.samples_to_frames(samples)
+        return np.asarray(samples) * self.analysis_rate // (self.hop_length * self.rate)
 
     def samples_to_seconds(self, samples):
         return librosa.core.samples_to_time(samples, sr=self.rate)
 
     def frames_to_samples(self, frame):
-        return librosa.core.frames_to_samples(frame)
+        # First native sample at or after the start of the frame, so that `samples_to_frames` maps it back to the same frame
+        return -(np.asarray(frame) * -(self.hop_length * self.rate) // self.analysis_rate)
 
     def seconds_to_frames(self, seconds, apply_trim_offset=False):
         if apply_trim_offset:
             seconds = seconds - librosa.core.samples_to_time(
-                self.trim_offset, sr=self.rate
+                self.trim_offset, sr=self.analysis_rate
             )
-        return librosa.core.time_to_frames(seconds, sr=self.rate)
+        return librosa.core.time_to_frames(seconds, sr=self.analysis_rate, hop_length=self.hop_length)
 
     def seconds_to_samples(self, seconds):
         return librosa.core.time_to_samples(seconds, sr=self.rate)
 
     def frames_to_ftime(self, frame: int):
-        time_sec = librosa.core.frames_to_time(frame, sr=self.rate)
+        time_sec = librosa.core.frames_to_time(frame, sr=self.analysis_rate, hop_length=self.hop_length)
         return f"{time_sec // 60:02.0f}:{time_sec % 60:06.3f}"
     
     def samples_to_ftime(self, samples: int):
         time_sec = librosa.core.samples_to_time(samples, sr=self.rate)
         return f"{time_sec // 60:02.0f}:{time_sec % 60:06.3f}"
+
+
+class WindowedMLAudio(MLAudio):
+    """An `MLAudio` holding only some windows (time ranges) of an audio track, decoded by seeking into the file.
+
+    The windows are laid out back to back in `audio` and `playback_audio`, so the analysis runs on them as if
+    they were a single (shorter) track; `total_duration` and `length` describe that decoded audio.
+    Positions in the full track are mapped to it by `seconds_to_frames(..., apply_trim_offset=True)`
+    and back by `track_samples`. Leading silence is not trimmed (`trim_offset` is always 0).
+    """
+
+    track_duration: float
+    track_length: int
+    frame_windows: np.ndarray
+    sample_windows: np.ndarray
+
+    def __init__(
+        self,
+        filepath: str,
+        windows: List[Tuple[float, float]],
+        analysis_profile: Union[str, AnalysisProfile, None] = None,
+    ) -> None:
+        """Decodes the `windows` (start and end, in seconds) of the audio file.
+        Overlapping windows are merged, and the window boundaries are aligned to the analysis frames of the track.
+
+        Args:
+            filepath (str): path to the audio file
+            windows (List[Tuple[float, float]]): the time ranges to decode, in seconds
+            analysis_profile (str | AnalysisProfile, optional): The analysis resolution, see `MLAudio`. Defaults to `DEFAULT_ANALYSIS_PROFILE`.
+
+        Raises:
+            AudioLoadError: If the file could not be opened and seeked into (e.g. formats not supported by libsndfile), or the windows contain no audio.
+        """
+        try:
+            with soundfile.SoundFile(filepath) as sf_desc:
+                if not sf_desc.seekable():
+                    raise AudioLoadError(f"{os.path.basename(filepath)} does not support seeking.")
+                self.rate = sf_desc.samplerate
+                self.track_length = sf_desc.frames
+                self._set_analysis_profile(analysis_profile)
+                self._set_windows(windows)
+                sections = []
+                for track_start, length in self.sample_windows[:, 1:]:
+                    sf_desc.seek(track_start)
+                    sections.append(sf_desc.read(length, dtype="float32", always_2d=True))
+        except AudioLoadError:
+            raise
+        except Exception as e:
+            raise AudioLoadError(f"{os.path.basename(filepath)} could not be partially loaded.") from e
+
+        if not sections:
+            raise AudioLoadError(f"No audio data could be loaded from \"{filepath}\".")
+        self.playback_audio = np.ascontiguousarray(np.concatenate(sections))
+
+        self.filepath = filepath
+        self.filename = os.path.basename(filepath)
+        self.n_channels = self.playback_audio.shape[1]
+        self.length = self.playback_audio.shape[0]
+        self.total_duration = self.length / self.rate
+        self.track_duration = self.track_length / self.rate
+        self.trim_offset = 0
+
+        # Each window is resampled separately and spans exactly its analysis frames,
+        # so that the frames of the decoded audio line up with those of the track
+        mono_signal = np.concatenate([
+            librosa.util.fix_length(
+                self._analysis_signal(librosa.core.to_mono(section.T)),
+                size=n_frames * self.hop_length,
+            )
+            for section, n_frames in zip(sections, self.frame_windows[:, 2])
+        ])
+        if np.min(mono_signal) == 0 and np.max(mono_signal) == 0:
+            raise AudioLoadError(f"\"{filepath}\" only contains silence and cannot be analyzed.")
+        mono_signal /= np.max(np.abs(mono_signal))
+        self.audio = mono_signal
+
+    def _set_windows(self, windows: List[Tuple[float, float]]):
+        """Converts the windows to merged ranges of the track's analysis frames and the matching native-rate samples.
+
+        `frame_windows` and `sample_windows` are arrays of shape (n_windows, 3) holding the
+        (decoded audio start, track start, length) of each window, in frames and in samples respectively.
+        """
+        n_track_frames = int(MLAudio.samples_to_frames(self, self.track_length))
+        ranges = []
+        for start, end in sorted(windows):
+            start = max(0, int(MLAudio.samples_to_frames(self, max(0, int(start * self.rate)))))
+            end = min(n_track_frames, int(MLAudio.samples_to_frames(self, max(0, int(end * self.rate)))) + 1)
+            if end <= start:
+                continue
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+
+        track_frames = np.array(ranges, dtype=np.int64).reshape(-1, 2)
+        track_samples = MLAudio.frames_to_samples(self, track_frames)
+        self.frame_windows = self._layout(track_frames)
+        self.sample_windows = self._layout(track_samples)
+
+    @staticmethod
+    def _layout(track_ranges: np.ndarray) -> np.ndarray:
+        lengths = track_ranges[:, 1] - track_ranges[:, 0]
+        local_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        return np.stack([local_starts, track_ranges[:, 0], lengths], axis=1)
+
+    @staticmethod
+    def _map(positions, windows: np.ndarray, from_track: bool):
+        src, dst = (1, 0) if from_track else (0, 1)
+        positions = np.asarray(positions)
+        window = np.clip(np.searchsorted(windows[:, src], positions, side="right") - 1, 0, None)
+        return positions - windows[window, src] + windows[window, dst]
+
+    def track_samples(self, samples):
+        return self._map(samples, self.sample_windows, from_track=False)
+
+    def local_samples(self, track_samples):
+        """Maps sample positions in the audio track to sample positions of the decoded audio (the inverse of `track_samples`)."""
+        return self._map(track_samples, self.sample_windows, from_track=True)
+
+    def apply_trim_offset(self, frame):
+        return frame
+
+    def samples_to_frames(self, samples):
+        track_frames = MLAudio.samples_to_frames(self, self.track_samples(samples))
+        return self._map(track_frames, self.frame_windows, from_track=True)
+
+    def frames_to_samples(self, frame):
+        track_samples = MLAudio.frames_to_samples(self, self._map(frame, self.frame_windows, from_track=False))
+        return self.local_samples(track_samples)
+
+    def seconds_to_frames(self, seconds, apply_trim_offset=False):
+        # With `apply_trim_offset`, `seconds` is a position in the track rather than in the decoded audio
+        if apply_trim_offset:
+            return self.samples_to_frames(self.local_samples(self.seconds_to_samples(seconds)))
+        return librosa.core.time_to_frames(seconds, sr=self.analysis_rate, hop_length=self.hop_length)
@@ -1,7 +1,12 @@
+import contextlib
 import functools
 import logging
 import os
+import signal
+import socket
+import sys
 import tempfile
+import threading
 import warnings
 
 import rich_click as click
@@ -15,11 +20,17 @@ rich_click_patch()
 from click_option_group import RequiredMutuallyExclusiveOptionGroup, optgroup
 from click_params import URL as UrlParamType
 
+from analysis import STRUCTURE_SEGMENTS
+from audio import ANALYSIS_PROFILES, DEFAULT_ANALYSIS_PROFILE
 from console import _COMMAND_GROUPS, _OPTION_GROUPS, rich_console
 from core import MusicLooper
+from client import JOB_TYPES, job_failed, job_request, response_output, send_request, status_request
+from daemon import DEFAULT_CACHE_SIZE, AnalysisServer, warm_up
+from results import COLUMNAR_FORMATS
 from exceptions import AudioLoadError, LoopNotFoundError
 from handler import BatchHandler, LoopExportHandler, LoopHandler
-from utils import download_audio, get_outputdir, mk_outputdir
+from tag_index import DEFAULT_INDEX_NAME, LoopTagIndex
+from utils import download_audio, get_outputdir, mk_outputdir, open_listening_socket
 
 # CLI --help styling
 click.rich_click.OPTION_GROUPS = _OPTION_GROUPS
@@ -70,6 +81,16 @@ def common_path_options(f):
     return wrapper_common_options
 
 
+def _load_beat_grid(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        with open(value) as file:
+            return tuple(sorted(float(token) for token in file.read().split()))
+    except ValueError as e:
+        raise click.BadParameter(f"\"{value}\" must only contain beat positions in seconds ({e}).")
+
+
 def common_loop_options(f):
     @click.option('--min-duration-multiplier', type=click.FloatRange(min=0.0, max=1.0, min_open=True, max_open=True), default=0.35, show_default=True, help="The minimum loop duration as a multiplier of the audio track's total duration.")
     @click.option('--min-loop-duration', type=click.FloatRange(min=0, min_open=True), default=None, help='The minimum loop duration in seconds. [dim](overrides --min-duration-multiplier if set)[/]')
@@ -77,6 +98,25 @@ def common_loop_options(f):
     @click.option('--approx-loop-position', type=click.FloatRange(min=0), nargs=2, default=None, help='The approximate desired loop start and loop end in seconds. [dim]([cyan]+/-2[/] second search window for each point)[/]')
     @click.option("--brute-force", is_flag=True, default=False, help=r"Check the entire audio track instead of just the detected beats. [dim yellow](Warning: may take several minutes to complete.)[/]")
     @click.option("--disable-pruning", is_flag=True, default=False, help="Disables filtering of the detected loop points from the initial pass.")
+    @click.option("--analysis-profile", type=click.Choice(tuple(ANALYSIS_PROFILES), case_sensitive=False), default=DEFAULT_ANALYSIS_PROFILE, show_default=True, help="Analysis resolution. [dim]fast: analyze at up to 22.05 kHz; balanced: up to 44.1 kHz; precise: at the native sample rate.[/]")
+    @click.option("--verify-precision", type=click.IntRange(min=0), default=0, metavar="N", help="Repeat the analysis in float64 and warn if any of the N best loop points differ from the float32 results.")
+    @click.option("--structure-segments", type=click.IntRange(min=1), default=STRUCTURE_SEGMENTS, show_default=True, help="Number of sections the track is segmented into; loop points near section boundaries score higher.")
+    @click.option("--beat-sync", is_flag=True, default=False, help="Search and score the loop points on features averaged between beats instead of on every frame. [dim](faster and uses less memory; the final loop points remain sample accurate)[/]")
+    @click.option("--repetition-lags", type=click.IntRange(min=0), default=0, metavar="N", help="Only search the loop lengths near the N dominant repetition lags of the track, falling back to all loop lengths if none of them loops. [dim](much faster on long tracks and with --brute-force; 0 searches all loop lengths)[/]")
+    @click.option("--duplicate-tolerance", type=click.FloatRange(min=0), default=0, metavar="SECONDS", help="Only score and list the best of the candidate loop points within this many seconds of each other, e.g. 0.1. [dim](0 keeps all of them; ignored with --disable-pruning and --approx-loop-position)[/]")
+    @click.option("--threads", type=click.IntRange(min=1), default=None, help="Number of threads used by the parallel analysis steps. [dim](default: all CPU cores; lower it when running several instances in parallel)[/]")
+    @click.option("--bpm", type=click.FloatRange(min=0, min_open=True), default=None, help="The known tempo of the track(s). Skips the tempo estimation and beat tracking: beats are placed on a grid at this tempo, aligned with the onsets.")
+    @click.option("--beat-grid", type=click.Path(exists=True, dir_okay=False), default=None, callback=_load_beat_grid, help="Text file with the known beat positions of the track in seconds (whitespace or newline separated), which skips the beat tracking entirely.")
+
+    @functools.wraps(f)
+    def wrapper_common_options(*args, **kwargs):
+        return f(*args, **kwargs)
+
+    return wrapper_common_options
+
+
+def crossfade_option(f):
+    @click.option("--crossfade-length", type=click.FloatRange(min=0), default=0, show_default=True, help="Crossfade the loop end into the loop start over this many seconds instead of jumping directly. [dim](smooths out slightly imperfect loop points)[/]")
 
     @functools.wraps(f)
     def wrapper_common_options(*args, **kwargs):
@@ -99,6 +139,7 @@ def common_export_options(f):
 @cli_main.command()
 @common_path_options
 @common_loop_options
+@crossfade_option
 def play(**kwargs):
     """Play an audio file on repeat from the terminal with the best discovered loop points, or a chosen point if interactive mode is active."""
     try:
@@ -145,7 +186,8 @@ def play(**kwargs):
 @click.option('--path', type=click.Path(exists=True), required=True, help='Path to the audio file.')
 @click.option("--tag-names", type=str, required=True, nargs=2, help="Name of the loop metadata tags to read from, e.g. --tag-names LOOP_START LOOP_END  (note: values must be integers and in sample units).")
 @click.option("--tag-offset/--no-tag-offset", is_flag=True, default=None, help="Always parse second loop metadata tag as a relative length / or as an absolute length. Default: auto-detected based on tag name.")
-def play_tagged(path, tag_names, tag_offset):
+@crossfade_option
+def play_tagged(path, tag_names, tag_offset, crossfade_length):
     """Skips loop analysis and reads the loop points directly from the tags present in the file."""
     try:
         looper = MusicLooper(path)
@@ -167,17 +209,90 @@ def play_tagged(path, tag_names, tag_offset):
         rich_console.print(f"\nPlaying with looping active from [green]{end_time}[/] back to [green]{start_time}[/]")
         rich_console.print("(Press [red]Ctrl+C[/] to stop looping.)")
 
-        looper.play_looping(loop_start, loop_end)
+        looper.play_looping(loop_start, loop_end, crossfade_length=crossfade_length)
 
     except Exception as e:
         print_exception(e)
 
 
+@cli_main.command()
+@common_path_options
+@common_loop_options
+@crossfade_option
+@click.option("--tag-names", type=str, nargs=2, default=None, help="Read the loop points from these metadata tags instead of analyzing the track, e.g. --tag-names LOOP_START LOOP_END")
+@click.option("--tag-offset/--no-tag-offset", is_flag=True, default=None, help="Always parse second loop metadata tag as a relative length / or as an absolute length. Default: auto-detected based on tag name.")
+@click.option("--format", type=click.Choice(("RAW", "OGG"), case_sensitive=False), default="RAW", show_default=True, help="RAW: headerless interleaved PCM samples (see --subtype); OGG: an Ogg/Vorbis stream.")
+@click.option("--subtype", type=click.Choice(("PCM_16", "FLOAT"), case_sensitive=False), default="PCM_16", show_default=True, help="Sample format of RAW streams.")
+@click.option("--listen", type=str, default=None, help="Serve the stream on a local socket instead of writing it to stdout: PORT or HOST:PORT for TCP, or a file path for a Unix socket.")
+@click.option("--realtime", is_flag=True, default=False, help="Pace the stream to the audio's playback speed instead of writing as fast as the reader accepts.")
+def stream(**kwargs):
+    """Stream the intro and then the loop section endlessly to stdout or a local socket, until interrupted."""
+    audio_output = sys.stdout.buffer
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    try:
+        # stdout is reserved for the audio stream, all messages are redirected to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            if kwargs.get("url", None) is not None:
+                kwargs["path"] = download_audio(kwargs["url"], tempfile.gettempdir())
+
+            if kwargs["tag_names"] is not None:
+                looper = MusicLooper(kwargs["path"])
+                loop_start, loop_end = looper.read_tags(kwargs["tag_names"][0], kwargs["tag_names"][1], kwargs["tag_offset"])
+            else:
+                handler = LoopHandler(**kwargs)
+                chosen_loop_pair = handler.choose_loop_pair(interactive_mode="PML_INTERACTIVE_MODE" in os.environ)
+                looper = handler.musiclooper
+                loop_start, loop_end = chosen_loop_pair.loop_start, chosen_loop_pair.loop_end
+
+            rich_console.print(f"Streaming \"{looper.filename}\" with looping active from [green]{looper.samples_to_ftime(loop_end)}[/] back to [green]{looper.samples_to_ftime(loop_start)}[/]")
+            stream_kwargs = dict(
+                format=kwargs["format"],
+                subtype=kwargs["subtype"],
+                crossfade_length=kwargs["crossfade_length"],
+                realtime=kwargs["realtime"],
+                stop_event=stop_event,
+            )
+            if kwargs["listen"] is None:
+                looper.stream(loop_start, loop_end, audio_output, **stream_kwargs)
+            else:
+                _serve_stream(looper, loop_start, loop_end, kwargs["listen"], **stream_kwargs)
+    except (KeyboardInterrupt, BrokenPipeError):
+        # The reader went away; point stdout to devnull to avoid another BrokenPipeError at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except YoutubeDLError:
+        # Already logged from youtube.py
+        pass
+    except (AudioLoadError, LoopNotFoundError, Exception) as e:
+        print_exception(e)
+
+
+def _serve_stream(looper: MusicLooper, loop_start: int, loop_end: int, address: str, stop_event: threading.Event, **stream_kwargs):
+    """Serves the loop stream to one client at a time; every client starts from the beginning of the track."""
+    with open_listening_socket(address) as server:
+        # Wake up periodically to check whether the stream was stopped
+        server.settimeout(1)
+        rich_console.print(f"Listening on {address} (Press [red]Ctrl+C[/] to stop streaming.)")
+        while not stop_event.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            with conn, conn.makefile("wb") as output:
+                try:
+                    looper.stream(loop_start, loop_end, output, stop_event=stop_event, **stream_kwargs)
+                except (BrokenPipeError, ConnectionResetError):
+                    logging.info("Client disconnected.")
+
+
 @cli_main.command()
 @common_path_options
 @common_loop_options
 @common_export_options
-@click.option('--format', type=click.Choice(("WAV", "FLAC", "OGG", "MP3"), case_sensitive=False), default="WAV", show_default=True, help="Audio format to use for the exported split audio files.")
+@crossfade_option
+@click.option('--format', type=click.Choice(("WAV", "FLAC", "OGG", "MP3"), case_sensitive=False), multiple=True, default=("WAV",), show_default=True, help="Audio format to use for the exported split audio files. [dim](repeat to export several formats concurrently, e.g. --format WAV --format FLAC)[/]")
+@click.option('--single-file', is_flag=True, default=False, help="Instead of splitting, export the whole track once with the loop points embedded (WAV: smpl/cue chunks; OGG/FLAC: LOOPSTART/LOOPLENGTH tags).")
 def split_audio(**kwargs):
     """Split the input audio into intro, loop and outro sections."""
     kwargs["split_audio"] = True
@@ -187,7 +302,8 @@ def split_audio(**kwargs):
 @common_path_options
 @common_loop_options
 @common_export_options
-@click.option('--format', type=click.Choice(("WAV", "FLAC", "OGG", "MP3"), case_sensitive=False), default="MP3", show_default=True, help="Audio format to use for the output audio file.")
+@crossfade_option
+@click.option('--format', type=click.Choice(("WAV", "FLAC", "OGG", "MP3"), case_sensitive=False), multiple=True, default=("MP3",), show_default=True, help="Audio format to use for the output audio file. [dim](repeat to export several formats concurrently, e.g. --format MP3 --format OGG)[/]")
 @click.option('--extended-length', type=float, required=True, help="Desired length of the extended looped track in seconds. [Must be longer than the audio's original length.]")
 @click.option('--fade-length', type=float, default=5, show_default=True, help="Desired length of the loop fade out in seconds.")
 @click.option('--disable-fade-out', is_flag=True, default=False, help="Extend the track with all its sections (intro/loop/outro) without fading out. --extended-length will be treated as an 'at least' constraint.")
@@ -200,16 +316,23 @@ def extend(**kwargs):
 @common_path_options
 @common_loop_options
 @common_export_options
-@click.option("--export-to", type=click.Choice(("STDOUT", "TXT"), case_sensitive=False), default="STDOUT", show_default=True, help="STDOUT: print the loop points of a track in samples to the terminal; TXT: export the loop points of a track in samples and append to a loop.txt file.")
+@click.option("--export-to", type=click.Choice(("STDOUT", "TXT", "NDJSON") + COLUMNAR_FORMATS, case_sensitive=False), default="STDOUT", show_default=True, help="STDOUT: print the loop points of a track in samples to the terminal; TXT: export the loop points of a track in samples and append to a loop.txt file; NDJSON: stream all the candidate loop points with their scores to stdout, one JSON object per line; NPZ/PARQUET/ARROW: export all the candidate loop points with their scores to a single columnar file (one for a whole directory), Parquet/Arrow require pyarrow. [dim](--alt-export-top N limits NDJSON/columnar exports to the top N candidates)[/]")
 @click.option("--fmt", type=click.Choice(("SAMPLES", "SECONDS", "TIME"), case_sensitive=False), default="SAMPLES", show_default=True, help="Export loop points formatted as samples (default), seconds, or time (mm:ss.sss).")
 @click.option("--alt-export-top", type=int, default=0, help="Alternative export format of the top N loop points instead of the best detected/chosen point. --alt-export-top -1 to export all points.")
 def export_points(**kwargs):
     """Export the best discovered or chosen loop points to a text file or to the terminal."""
     kwargs["to_stdout"] = kwargs["export_to"].upper() == "STDOUT"
     kwargs["to_txt"] = kwargs["export_to"].upper() == "TXT"
-    kwargs.pop("export_to", "")
-
-    run_handler(**kwargs)
+    if kwargs["export_to"].upper() in ("NDJSON",) + COLUMNAR_FORMATS:
+        kwargs["results_format"] = kwargs["export_to"].upper()
+    if kwargs.pop("export_to", "").upper() == "NDJSON":
+        # Keep stdout machine-readable: progress, log messages and reports go to stderr
+        kwargs["ndjson_file"] = sys.stdout
+        rich_console.file = sys.stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            run_handler(**kwargs)
+    else:
+        run_handler(**kwargs)
 
 
 @cli_main.command()
@@ -218,11 +341,114 @@ def export_points(**kwargs):
 @common_export_options
 @click.option('--tag-names', type=str, required=True, nargs=2, help='Name of the loop metadata tags to use, e.g. --tag-names LOOP_START LOOP_END')
 @click.option("--tag-offset/--no-tag-offset", is_flag=True, default=None, help="Always export second loop metadata tag as a relative length / or as an absolute length. Default: auto-detected based on tag name.")
+@click.option("--in-place", is_flag=True, default=False, help="Tag the input audio file(s) themselves instead of copies. Files are replaced atomically with a tagged clone (a reflink where the filesystem supports it).")
 def tag(**kwargs):
-    """Adds metadata tags of loop points to a copy of the input audio file(s)."""
+    """Adds metadata tags of loop points to a copy of the input audio file(s), or to the files themselves with --in-place."""
     run_handler(**kwargs)
 
 
+@cli_main.command()
+@click.option("--path", type=click.Path(exists=True, file_okay=False), required=True, help="Path to the music library directory to index.")
+@click.option("--db", type=click.Path(dir_okay=False), default=None, help=f"Path to the SQLite index database. [dim](default: {DEFAULT_INDEX_NAME} in --path)[/]")
+@click.option("--tag-names", type=str, nargs=2, default=("LOOPSTART", "LOOPLENGTH"), show_default=True, help="Name of the loop metadata tags to index, e.g. --tag-names LOOP_START LOOP_END")
+@click.option("--tag-offset/--no-tag-offset", is_flag=True, default=None, help="Always parse second loop metadata tag as a relative length / or as an absolute length. Default: auto-detected based on tag name.")
+@click.option("--recursive", "-r", is_flag=True, default=False, help="Process directories recursively.")
+@click.option("--workers", type=click.IntRange(min=1), default=None, help="Number of processes reading tags in parallel. [dim](default: CPU count)[/]")
+@click.option("--list", "list_mode", type=click.Choice(("NONE", "TAGGED", "UNTAGGED", "ERRORS"), case_sensitive=False), default="NONE", show_default=True, help="Print the paths of the indexed tracks with loop tags, without loop tags, or whose tags could not be read.")
+def index(path, db, tag_names, tag_offset, recursive, workers, list_mode):
+    """Indexes the loop tags of a music library, reading only the metadata; later runs rescan only new or modified files."""
+    try:
+        files = BatchHandler.get_files_in_directory(path, recursive=recursive)
+        db_path = db if db is not None else os.path.join(path, DEFAULT_INDEX_NAME)
+        with LoopTagIndex(db_path, tag_names[0], tag_names[1], tag_offset) as tag_index, Progress(
+            SpinnerColumn(),
+            *Progress.get_default_columns(),
+            TimeElapsedColumn(),
+            console=rich_console,
+            transient=True,
+        ) as progress:
+            pbar = progress.add_task("Reading tags...", total=None)
+            stats = tag_index.refresh(
+                [file for file in files if os.path.abspath(file) != tag_index.db_path],
+                max_workers=workers,
+                progress_callback=lambda done, total: progress.update(pbar, completed=done, total=total),
+                prune_root=path,
+            )
+            progress.stop()
+
+            n_tagged, n_untagged, n_errors = tag_index.counts()
+            rich_console.print(
+                f"Indexed \"{path}\": [green]{n_tagged}[/] tagged, {n_untagged} untagged, {n_errors} unreadable "
+                f"({stats.scanned} scanned, {stats.unchanged} unchanged, {stats.removed} removed)"
+            )
+
+            list_mode = list_mode.upper()
+            if list_mode == "ERRORS":
+                for track in tag_index.tracks(include_errors=True):
+                    if track.error is not None:
+                        rich_console.out(f"{track.path}\t{track.error}", highlight=False)
+            elif list_mode != "NONE":
+                for track in tag_index.tracks(tagged=list_mode == "TAGGED"):
+                    loop_points = f"{track.loop_start} {track.loop_end} " if track.is_tagged else ""
+                    rich_console.out(f"{loop_points}{track.path}", highlight=False)
+    except Exception as e:
+        print_exception(e)
+
+
+@cli_main.command()
+@click.option("--listen", type=str, required=True, help="Address to accept jobs on: PORT or HOST:PORT for TCP (localhost by default), or a file path for a Unix socket.")
+@click.option("--max-jobs", type=click.IntRange(min=1), default=1, show_default=True, help="Number of jobs run concurrently; further jobs are queued in submission order.")
+@click.option("--cache-size", type=click.IntRange(min=1), default=DEFAULT_CACHE_SIZE, show_default=True, help="Number of tracks kept decoded, with their analysis results, between jobs.")
+@click.option("--threads", type=click.IntRange(min=1), default=None, help="Number of threads used by the parallel analysis steps of each job. [dim](default: all CPU cores; with --max-jobs > 1, CPU cores / max jobs avoids oversubscription)[/]")
+def daemon(listen, max_jobs, cache_size, threads):
+    """Run a local analysis server that stays warm between jobs (analyze, refine, export, extend, tag) submitted with the submit command."""
+    server = AnalysisServer(max_jobs=max_jobs, cache_size=cache_size, threads=threads)
+    signal.signal(signal.SIGTERM, lambda *_: server.shutdown())
+    try:
+        with rich_console.status("Warming up..."):
+            warm_up()
+        rich_console.print(f"Listening on {listen} (Press [red]Ctrl+C[/] to stop the server.)")
+        server.serve(listen)
+    except KeyboardInterrupt:
+        server.shutdown()
+    except Exception as e:
+        print_exception(e)
+
+
+@cli_main.command()
+@click.option("--connect", type=str, required=True, help="Address of the analysis server (see the daemon command's --listen).")
+@click.argument("job_type", type=click.Choice(JOB_TYPES, case_sensitive=False))
+@click.option("--path", type=click.Path(exists=True, dir_okay=False), required=True, help="Path to the audio file.")
+@click.option("--param", "params", type=str, multiple=True, metavar="KEY=VALUE", help="Job parameter, with a JSON or plain string value, e.g. --param top=5 --param approx_loop_position=[12.5,80] --param format=OGG")
+@click.option("--no-wait", is_flag=True, default=False, help="Print the queued job and return immediately instead of waiting for its result.")
+def submit(connect, job_type, path, params, no_wait):
+    """Submit a job to a running analysis server and print the job status (with its result) as JSON. [dim](client.py offers the same without loading the analysis stack)[/]"""
+    try:
+        _print_server_response(send_request(connect, job_request(job_type, path, params, wait=not no_wait)))
+    except Exception as e:
+        print_exception(e)
+        sys.exit(1)
+
+
+@cli_main.command()
+@click.option("--connect", type=str, required=True, help="Address of the analysis server (see the daemon command's --listen).")
+@click.argument("job_id", type=int, required=False)
+@click.option("--wait", is_flag=True, default=False, help="Wait for the job to finish.")
+def jobs(connect, job_id, wait):
+    """Print the status of a job submitted to a running analysis server, or of all its recent jobs, as JSON."""
+    try:
+        _print_server_response(send_request(connect, status_request(job_id, wait)))
+    except Exception as e:
+        print_exception(e)
+        sys.exit(1)
+
+
+def _print_server_response(response: dict):
+    rich_console.out(response_output(response), highlight=False)
+    if job_failed(response):
+        sys.exit(1)
+
+
 def run_handler(**kwargs):
     try:
         if kwargs.get("url", None) is not None:
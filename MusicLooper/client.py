@@ -0,0 +1,123 @@
+"""Thin client for the analysis server (see `daemon.py`).
+
+Only the standard library is imported, so that submitting a job does not pay for loading the
+analysis stack. Also usable as a script, e.g.:
+    python client.py --connect /tmp/pml.sock analyze --path track.ogg --param top=5
+    python client.py --connect 8765 jobs 12 --wait
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+from typing import Dict, Sequence
+
+JOB_TYPES = ("analyze", "refine", "export", "extend", "tag")
+
+
+def open_client_socket(address: str) -> socket.socket:
+    """Connects to a socket listening on the local `address` provided.
+
+    Args:
+        address (str): "PORT" or "HOST:PORT" for a TCP socket (host defaults to 127.0.0.1), otherwise the file path of a Unix socket.
+
+    Returns:
+        socket.socket: The connected socket.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        return socket.create_connection((host or "127.0.0.1", int(port)))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(address)
+    return client
+
+
+def send_request(address: str, request: dict) -> dict:
+    """Sends a single request to the server listening on `address` and returns its response."""
+    with open_client_socket(address) as conn, conn.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        response = stream.readline()
+    if not response:
+        raise ConnectionError(f"No response from the server at {address}.")
+    return json.loads(response)
+
+
+def parse_params(params: Sequence[str]) -> Dict[str, object]:
+    """Parses KEY=VALUE job parameters; values are read as JSON if possible, otherwise as plain strings.
+
+    Raises:
+        ValueError: If a parameter is not in the KEY=VALUE format.
+    """
+    parsed = {}
+    for param in params:
+        key, sep, value = param.partition("=")
+        if not sep:
+            raise ValueError(f"\"{param}\" is not in the KEY=VALUE format.")
+        try:
+            parsed[key.replace("-", "_")] = json.loads(value)
+        except json.JSONDecodeError:
+            parsed[key.replace("-", "_")] = value
+    return parsed
+
+
+def job_request(job_type: str, path: str, params: Sequence[str] = (), wait: bool = True) -> dict:
+    return {
+        "op": "submit",
+        "type": job_type.lower(),
+        "params": {**parse_params(params), "path": os.path.abspath(path)},
+        "wait": wait,
+    }
+
+
+def status_request(job_id=None, wait: bool = False) -> dict:
+    if job_id is None:
+        return {"op": "jobs"}
+    return {"op": "wait" if wait else "status", "id": job_id}
+
+
+def response_output(response: dict) -> str:
+    """Returns the JSON printed for a response.
+
+    Raises:
+        RuntimeError: If the request failed.
+    """
+    if not response.get("ok"):
+        raise RuntimeError(response.get("error"))
+    return json.dumps(response.get("job", response.get("jobs")))
+
+
+def job_failed(response: dict) -> bool:
+    return response.get("job", {}).get("state") == "failed"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Submits jobs to a running PyMusicLooper analysis server and prints the results as JSON.")
+    parser.add_argument("--connect", required=True, help="Address of the analysis server (PORT, HOST:PORT or a Unix socket path).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for job_type in JOB_TYPES:
+        job_parser = commands.add_parser(job_type)
+        job_parser.add_argument("--path", required=True)
+        job_parser.add_argument("--param", dest="params", action="append", default=[], metavar="KEY=VALUE")
+        job_parser.add_argument("--no-wait", action="store_true")
+    jobs_parser = commands.add_parser("jobs")
+    jobs_parser.add_argument("job_id", type=int, nargs="?")
+    jobs_parser.add_argument("--wait", action="store_true")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "jobs":
+            request = status_request(args.job_id, args.wait)
+        else:
+            request = job_request(args.command, args.path, args.params, wait=not args.no_wait)
+        response = send_request(args.connect, request)
+        print(response_output(response))
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 1 if job_failed(response) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
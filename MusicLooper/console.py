@@ -12,6 +12,16 @@ _loop_options = [
     "--approx-loop-position",
     "--brute-force",
     "--disable-pruning",
+    "--analysis-profile",
+    "--verify-precision",
+    "--threads",
+    "--bpm",
+    "--beat-grid",
+    "--structure-segments",
+    "--beat-sync",
+    "--repetition-lags",
+    "--duplicate-tolerance",
+    "--crossfade-length",
 ]
 _export_options = ["--output-dir", "--format"]
 _batch_options = ["--recursive", "--flatten"]
@@ -45,10 +55,11 @@ def _option_groups(additional_basic_options=None):
 _common_option_groups = _option_groups()
 _OPTION_GROUPS = {
     "pymusiclooper play": _common_option_groups,
-    "pymusiclooper split-audio": _common_option_groups,
-    "pymusiclooper tag": _option_groups(["--tag-names", "--tag-offset"]),
+    "pymusiclooper split-audio": _option_groups(["--single-file"]),
+    "pymusiclooper tag": _option_groups(["--tag-names", "--tag-offset", "--in-place"]),
     "pymusiclooper export-points": _option_groups(["--export-to", "--alt-export-top", "--fmt"]),
     "pymusiclooper extend": _option_groups(["--extended-length", "--fade-length", "--disable-fade-out"]),
+    "pymusiclooper stream": _option_groups(["--tag-names", "--tag-offset", "--subtype", "--listen", "--realtime"]),
 }
 _COMMAND_GROUPS = {
     "pymusiclooper": [
@@ -56,7 +67,8 @@ _COMMAND_GROUPS = {
             "name": "Play Commands",
             "commands": [
                 "play",
-                "play-tagged"
+                "play-tagged",
+                "stream",
             ],
         },
         {
@@ -67,6 +79,20 @@ _COMMAND_GROUPS = {
                 "tag",
                 "extend",
             ],
-        }
+        },
+        {
+            "name": "Library Commands",
+            "commands": [
+                "index",
+            ],
+        },
+        {
+            "name": "Server Commands",
+            "commands": [
+                "daemon",
+                "submit",
+                "jobs",
+            ],
+        },
     ]
 }
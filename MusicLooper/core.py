@@ -1,17 +1,32 @@
 """Contains the core MusicLooper class that can be
 used for programmatic access to the CLI's main features."""
 
+import logging
 import os
-import shutil
+import threading
 from math import ceil
-from typing import List, Optional, Tuple, Union
+from typing import BinaryIO, Callable, List, Optional, Sequence, Tuple, Union
 
 import lazy_loader as lazy
 import numpy as np
 
-from analysis import LoopPair, find_best_loop_points # 移除 pymusiclooper.
-from audio import MLAudio
-from playback import PlaybackHandler
+from analysis import STRUCTURE_SEGMENTS, LoopPair, LoopPairList, approx_search_windows, find_best_loop_points, verify_precision # 移除 pymusiclooper.
+from audio import AnalysisProfile, MLAudio, WindowedMLAudio, get_analysis_profile
+from exceptions import AudioLoadError
+from export import (
+    EncodedStreamWriter,
+    ExportTarget,
+    RawPCMWriter,
+    encode_pcm,
+    end_tag_is_offset,
+    extended_sections,
+    read_loop_tags,
+    run_exports,
+    stream_loop,
+    write_loop_tags,
+    write_sections,
+)
+from playback import LoopSeam, PlaybackHandler, compute_loop_seam
 from memory_utils import MemoryAnalyzer
 
 # Lazy-load external libraries when they're needed
@@ -19,13 +34,60 @@ soundfile = lazy.load("soundfile")
 
 class MusicLooper:
     """High-level API access to PyMusicLooper's main functions."""
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, analysis_profile: Union[str, AnalysisProfile, None] = None):
         """Initializes the MusicLooper object with the provided audio track.
 
+        The audio is decoded on first use, so that operations which only need parts of it
+        (e.g. refining approximate loop points) do not decode the full track.
+
         Args:
             filepath (str): path to the audio track to use.
+            analysis_profile (str | AnalysisProfile, optional): The analysis resolution (sample rate, FFT size and hop), either "fast", "balanced" or "precise", or an `AnalysisProfile`. Defaults to "precise" (native sample rate).
+
+        Raises:
+            ValueError: If `analysis_profile` is not a known profile.
+        """
+        self._filepath = filepath
+        self.analysis_profile = get_analysis_profile(analysis_profile)
+        self._mlaudio = None
+        self._windowed_mlaudio = None
+        self._loop_seam = None
+
+    @property
+    def mlaudio(self) -> MLAudio:
+        """The fully decoded audio track, loaded on first access.
+
+        Raises:
+            AudioLoadError: If the file could not be loaded.
+        """
+        if self._mlaudio is None:
+            self._mlaudio = MLAudio(filepath=self._filepath, analysis_profile=self.analysis_profile)
+        return self._mlaudio
+
+    @property
+    def _timebase(self) -> MLAudio:
+        # Conversions between seconds and samples only depend on the native sample rate,
+        # which partially decoded audio provides as well
+        if self._mlaudio is None and self._windowed_mlaudio is not None:
+            return self._windowed_mlaudio
+        return self.mlaudio
+
+    def _approx_search_audio(self, approx_loop_start: float, approx_loop_end: float) -> Optional[WindowedMLAudio]:
+        """Decodes only the parts of the track needed to search around the approximate loop points.
+
+        Returns:
+            Optional[WindowedMLAudio]: the partially decoded audio, or None if the file cannot be seeked into (the full track is analyzed instead)
         """
-        self.mlaudio = MLAudio(filepath=filepath)
+        try:
+            self._windowed_mlaudio = WindowedMLAudio(
+                self._filepath,
+                approx_search_windows(approx_loop_start, approx_loop_end),
+                analysis_profile=self.analysis_profile,
+            )
+        except AudioLoadError as e:
+            logging.info(f"Partial decoding unavailable ({e}); analyzing the full track.")
+            return None
+        return self._windowed_mlaudio
 
     def find_loop_pairs(
         self,
@@ -39,6 +101,14 @@ class MusicLooper:
         score_weights: dict = None,
         memory_decision_callback=None,
         lang='zh_TW',
+        top_k: Optional[int] = None,
+        verify_precision: int = 0,
+        bpm: Optional[float] = None,
+        beat_times: Optional[Sequence[float]] = None,
+        n_segments: int = STRUCTURE_SEGMENTS,
+        beat_sync: bool = False,
+        repetition_lags: int = 0,
+        duplicate_tolerance: float = 0,
     ) -> List[LoopPair]:
         """Finds the best loop points for the track, according to the parameters specified.
 
@@ -51,6 +121,14 @@ class MusicLooper:
             brute_force (bool, optional): Checks the entire track instead of the detected beats (disclaimer: runtime may be significantly longer). Defaults to False.
             disable_pruning (bool, optional): Returns all the candidate loop points without filtering. Defaults to False.
             score_weights (dict, optional): Custom score weights for each score type.
+            top_k (int, optional): Only finalize the best `top_k` loop pairs (structure/chord/MFCC scores and zero-crossing refinement); the returned `LoopPairList` can finalize the rest on demand. Defaults to None (all loop pairs are finalized).
+            verify_precision (int, optional): If greater than 0, repeats the search with a float64 analysis and logs a warning for each of the best `verify_precision` loop pairs that differs. Defaults to 0.
+            bpm (float, optional): The known tempo of the track, which skips the tempo estimation and beat tracking. Defaults to None.
+            beat_times (Sequence[float], optional): The known beat positions of the track (in seconds), which skip the beat tracking entirely. Defaults to None.
+            n_segments (int, optional): Number of segments found by the structure analysis, which the structure score compares the loop points to. Defaults to STRUCTURE_SEGMENTS.
+            beat_sync (bool, optional): Searches and scores the candidates on features averaged between beats instead of on every frame (faster, with less memory); the loop points remain sample accurate. Defaults to False.
+            repetition_lags (int, optional): If greater than 0, only searches the loop lengths near that many dominant repetition lags of the track, which is much faster on long tracks. Defaults to 0 (all the loop lengths are searched).
+            duplicate_tolerance (float, optional): If greater than 0, only the best of the candidates around the same loop points (within this many seconds, e.g. 0.1) are scored. Ignored with approx_loop_start/approx_loop_end. Defaults to 0 (all the candidates are scored).
         
         Raises:
             LoopNotFoundError: raised in case no loops were found
@@ -58,12 +136,42 @@ class MusicLooper:
         Returns:
             List[LoopPair]: A list of `LoopPair` objects containing the loop points related data. See the `LoopPair` class for more info.
         """
+        search_kwargs = dict(
+            min_duration_multiplier=min_duration_multiplier,
+            min_loop_duration=min_loop_duration,
+            max_loop_duration=max_loop_duration,
+            approx_loop_start=approx_loop_start,
+            approx_loop_end=approx_loop_end,
+            brute_force=brute_force,
+            disable_pruning=disable_pruning,
+            score_weights=score_weights,
+            bpm=bpm,
+            beat_times=beat_times,
+            n_segments=n_segments,
+            beat_sync=beat_sync,
+            repetition_lags=repetition_lags,
+            duplicate_tolerance=duplicate_tolerance,
+        )
+
+        if approx_loop_start is not None and approx_loop_end is not None:
+            # Only the audio around the approximate loop points is decoded and analyzed
+            windowed_mlaudio = self._approx_search_audio(approx_loop_start, approx_loop_end)
+            if windowed_mlaudio is not None:
+                return self._search(windowed_mlaudio, search_kwargs, top_k, verify_precision)
+
         # === 新增：記憶體預估與決策 ===
         analyzer = MemoryAnalyzer(lang=lang)
         audio_length_sec = self.mlaudio.total_duration
         sample_rate = self.mlaudio.rate
         n_channels = self.mlaudio.n_channels
-        mem_info = analyzer.estimate_memory_requirement(audio_length_sec, sample_rate, n_channels)
+        mem_info = analyzer.estimate_memory_requirement(
+            audio_length_sec,
+            sample_rate,
+            n_channels,
+            dtype_bytes=np.dtype(self.mlaudio.dtype).itemsize,
+            analysis_rate=self.mlaudio.analysis_rate,
+            hop_length=self.mlaudio.hop_length,
+        )
         strategy = analyzer.recommend_strategy(mem_info)
         
         if strategy['risk_level'] in ["高", "中"]:
@@ -78,31 +186,43 @@ class MusicLooper:
                 return ["SMART_BATCH_ANALYSIS"]
         
         # === 原本的完整分析 ===
-        return find_best_loop_points(
-            mlaudio=self.mlaudio,
-            min_duration_multiplier=min_duration_multiplier,
-            min_loop_duration=min_loop_duration,
-            max_loop_duration=max_loop_duration,
-            approx_loop_start=approx_loop_start,
-            approx_loop_end=approx_loop_end,
-            brute_force=brute_force,
-            disable_pruning=disable_pruning,
-            score_weights=score_weights
-        )
+        return self._search(self.mlaudio, search_kwargs, top_k, verify_precision)
+
+    @staticmethod
+    def _search(mlaudio: MLAudio, search_kwargs: dict, top_k: Optional[int], n_verify: int) -> LoopPairList:
+        loop_pairs = find_best_loop_points(mlaudio=mlaudio, top_k=top_k, **search_kwargs)
+        if n_verify > 0:
+            report = verify_precision(mlaudio, loop_pairs, top_n=n_verify, **search_kwargs)
+            if report.matches:
+                logging.info(
+                    f"Precision check passed: the top {report.top_n} loop points match a float64 analysis"
+                    f" (max score difference {report.max_score_difference:.2e})."
+                )
+            else:
+                for rank, points, reference_points in report.mismatches:
+                    logging.warning(
+                        f"Precision check: loop pair #{rank + 1} is {points}, but {reference_points} with a float64 analysis."
+                    )
+        return loop_pairs
 
     @property
     def filename(self) -> str:
-        return self.mlaudio.filename
+        return os.path.basename(self._filepath)
 
     @property
     def filepath(self) -> str:
-        return self.mlaudio.filepath
+        return self._filepath
+
+    @property
+    def samplerate(self) -> int:
+        """The native sample rate of the track."""
+        return self._timebase.rate
 
     def samples_to_frames(self, samples: int) -> int:
         return self.mlaudio.samples_to_frames(samples)
     
     def samples_to_seconds(self, samples: int) -> float:
-        return self.mlaudio.samples_to_seconds(samples)
+        return self._timebase.samples_to_seconds(samples)
 
     def frames_to_samples(self, frame: int) -> int:
         return self.mlaudio.frames_to_samples(frame)
@@ -111,21 +231,47 @@ class MusicLooper:
         return self.mlaudio.seconds_to_frames(seconds)
 
     def seconds_to_samples(self, seconds: float) -> int:
-        return self.mlaudio.seconds_to_samples(seconds)
+        return self._timebase.seconds_to_samples(seconds)
 
     def frames_to_ftime(self, frame: int) -> str:
         return self.mlaudio.frames_to_ftime(frame)
     
     def samples_to_ftime(self, samples: int) -> str:
-        return self.mlaudio.samples_to_ftime(samples)
+        return self._timebase.samples_to_ftime(samples)
+
+    def loop_seam(self, loop_start: int, loop_end: int, crossfade_length: float) -> Optional[LoopSeam]:
+        """Returns the precomputed crossfaded seam for the loop points specified.
+        The seam of the last requested loop selection is cached and reused.
+
+        Args:
+            loop_start (int): Loop start in samples.
+            loop_end (int): Loop end in samples.
+            crossfade_length (float): Length of the crossfade in seconds.
+
+        Returns:
+            Optional[LoopSeam]: The seam, or None if `crossfade_length` is 0.
+        """
+        n_samples = min(
+            self.mlaudio.seconds_to_samples(crossfade_length),
+            loop_start,
+            loop_end - loop_start,
+        )
+        if n_samples <= 0:
+            return None
+        if self._loop_seam is None or not self._loop_seam.matches(loop_start, loop_end, n_samples):
+            self._loop_seam = compute_loop_seam(
+                self.mlaudio.playback_audio, loop_start, loop_end, n_samples
+            )
+        return self._loop_seam
 
-    def play_looping(self, loop_start: int, loop_end: int, start_from: int = 0):
+    def play_looping(self, loop_start: int, loop_end: int, start_from: int = 0, crossfade_length: float = 0):
         """Plays an audio file with a loop active at the points specified
 
         Args:
             loop_start (int): Index of the loop start (in samples)
             loop_end (int): Index of the loop end (in samples)
             start_from (int, optional): Index of the sample point to start from. Defaults to 0.
+            crossfade_length (float, optional): Crossfade the loop end into the loop start over this many seconds. Defaults to 0 (hard jump).
         """
         playback_handler = PlaybackHandler()
         playback_handler.play_looping(
@@ -135,118 +281,118 @@ class MusicLooper:
             loop_start,
             loop_end,
             start_from,
+            seam=self.loop_seam(loop_start, loop_end, crossfade_length),
         )
 
-    def export(
+    def _output_path(self, output_dir: Optional[str]) -> str:
+        if output_dir is not None:
+            return os.path.join(output_dir, self.mlaudio.filename)
+        return os.path.abspath(self.mlaudio.filepath)
+
+    def _split_targets(
         self,
         loop_start: int,
         loop_end: int,
-        format: str = "WAV",
-        output_dir: Optional[str] = None
-    ):
-        """Exports the audio into three files: intro, loop and outro.
-
-        Args:
-            loop_start (int): Loop start in samples.
-            loop_end (int): Loop end in samples.
-            format (str, optional): Audio format of the exported files (formats available depend on the `soundfile` library). Defaults to "WAV".
-            output_dir (str, optional): Path to the output directory. Defaults to the same diretcory as the source audio file.
-        """
-        if output_dir is not None:
-            out_path = os.path.join(output_dir, self.mlaudio.filename)
-        else:
-            out_path = os.path.abspath(self.mlaudio.filepath)
-
-        soundfile.write(
-            f"{out_path}-intro.{format.lower()}",
-            self.mlaudio.playback_audio[:loop_start],
-            self.mlaudio.rate,
-            format=format,
-        )
-        soundfile.write(
-            f"{out_path}-loop.{format.lower()}",
-            self.mlaudio.playback_audio[loop_start:loop_end],
-            self.mlaudio.rate,
-            format=format,
+        format: str,
+        output_dir: Optional[str],
+        crossfade_length: float = 0,
+    ) -> List[ExportTarget]:
+        out_path = self._output_path(output_dir)
+        playback_audio = self.mlaudio.playback_audio
+        seam = self.loop_seam(loop_start, loop_end, crossfade_length)
+        loop_sections = (
+            [playback_audio[loop_start:loop_end]]
+            if seam is None
+            else list(seam.loop_sections(playback_audio))
         )
-        soundfile.write(
-            f"{out_path}-outro.{format.lower()}",
-            self.mlaudio.playback_audio[loop_end:],
-            self.mlaudio.rate,
-            format=format,
+        return [
+            ExportTarget(f"{out_path}-intro.{format.lower()}", format, [playback_audio[:loop_start]]),
+            ExportTarget(f"{out_path}-loop.{format.lower()}", format, loop_sections),
+            ExportTarget(f"{out_path}-outro.{format.lower()}", format, [playback_audio[loop_end:]]),
+        ]
+
+    def _looped_target(
+        self,
+        loop_start: int,
+        loop_end: int,
+        format: str,
+        output_dir: Optional[str],
+    ) -> ExportTarget:
+        return ExportTarget(
+            f"{self._output_path(output_dir)}-looped.{format.lower()}",
+            format,
+            [self.mlaudio.playback_audio],
+            loop_points=(loop_start, loop_end),
         )
 
-    def extend(
+    def _extended_layout(
         self,
         loop_start: int,
         loop_end: int,
         extended_length: float,
         fade_length: float = 5,
         disable_fade_out: bool = False,
-        format: str = "WAV",
-        output_dir: Optional[str] = None,
-    ) -> str:
-        """Extends the audio by looping to at least the specified length.
-        Returns the path to the extended audio file. 
-
-        Args:
-            loop_start (int): Loop start in samples.
-            loop_end (int): Loop end in samples.
-            extended_length (float): Desired length of the extended audio in seconds.
-            fade_length (float, optional): Desired length of the extended audio's fade out in seconds.
-            disable_fade_out (bool, optional): Disable fading out from the loop section, and instead, includes the audio outro section . If `True`, `extended_length` will be treated as an 'at least' constraint.
-            format (str, optional): Audio format of the exported files (formats available depend on the `soundfile` library). Defaults to "WAV".
-            output_dir (str, optional): Path to the output directory. Defaults to the same directory as the source audio file.
-        """
-        if output_dir is not None:
-            out_path = os.path.join(output_dir, self.mlaudio.filename)
-        else:
-            out_path = os.path.abspath(self.mlaudio.filepath)
-
+        crossfade_length: float = 0,
+    ) -> Tuple[List[np.ndarray], int]:
+        """Returns the sections (views of the playback audio) of the extended track and the number of samples to fade out."""
         if extended_length < self.mlaudio.total_duration:
             raise ValueError(
                 "Extended length must be greater than the audio's original length."
             )
 
-        intro = self.mlaudio.playback_audio[:loop_start]
-        loop = self.mlaudio.playback_audio[loop_start:loop_end]
-        outro = self.mlaudio.playback_audio[loop_end:]
+        intro_length = loop_start
+        loop_length = loop_end - loop_start
+        outro_length = self.mlaudio.length - loop_end
 
-        loop_extended_length = self.mlaudio.seconds_to_samples(extended_length) - intro.shape[0]
+        loop_extended_length = self.mlaudio.seconds_to_samples(extended_length) - intro_length
 
         # If the outro will be included, account for its length when calculating the new loop duration
         if disable_fade_out:
-            loop_extended_length -= outro.shape[0]
+            loop_extended_length -= outro_length
 
-        loop_factor = loop_extended_length / loop.shape[0]
+        loop_factor = loop_extended_length / loop_length
         left_over_multiplier = loop_factor - int(loop_factor)
-        extend_end_idx = loop_start + int(
-            (loop_end - loop_start) * left_over_multiplier
-        )
 
-        # Modify the extended track's final loop section based on the fade out parameter
-        final_loop = self.mlaudio.playback_audio[loop_start:extend_end_idx].copy()
+        # The extended track's final loop section is either a full pass followed by the outro,
+        # or a partial pass that gets faded out
         if disable_fade_out:
-            final_loop = loop
+            final_loop_length = loop_length
+            samples_to_fade = 0
         else:
+            final_loop_length = int(loop_length * left_over_multiplier)
             samples_to_fade = min(
-                self.mlaudio.seconds_to_samples(fade_length), final_loop.shape[0]
-            )
-            final_loop[-samples_to_fade:] = (
-                final_loop[-samples_to_fade:]
-                * np.linspace(1, 0, samples_to_fade)[:, np.newaxis]
+                self.mlaudio.seconds_to_samples(fade_length), final_loop_length
             )
 
-        # Format extended file name with its duration suffixed
-        extended_loop_length = final_loop.shape[0] + (
-            loop.shape[0] * (int(loop_factor))
+        sections = extended_sections(
+            self.mlaudio.playback_audio,
+            loop_start,
+            loop_end,
+            n_loops=int(loop_factor),
+            final_loop_length=final_loop_length,
+            include_outro=disable_fade_out,
+            seam=self.loop_seam(loop_start, loop_end, crossfade_length),
         )
-        extended_audio_length = (
-            intro.shape[0]
-            + extended_loop_length
-            + (outro.shape[0] if disable_fade_out else 0)
+        return sections, samples_to_fade
+
+    def _extended_target(
+        self,
+        loop_start: int,
+        loop_end: int,
+        extended_length: float,
+        fade_length: float = 5,
+        disable_fade_out: bool = False,
+        format: str = "WAV",
+        output_dir: Optional[str] = None,
+        crossfade_length: float = 0,
+    ) -> ExportTarget:
+        sections, samples_to_fade = self._extended_layout(
+            loop_start, loop_end, extended_length, fade_length, disable_fade_out, crossfade_length
         )
-        total_length_seconds = self.mlaudio.samples_to_seconds(extended_audio_length)
+        target = ExportTarget("", format, sections, fade_out_length=samples_to_fade)
+
+        # Format extended file name with its duration suffixed
+        total_length_seconds = self.mlaudio.samples_to_seconds(target.length)
         duration_sec = ceil(total_length_seconds%60)
         duration_mins = int(total_length_seconds//60)
         if duration_sec == 60:
@@ -255,26 +401,186 @@ class MusicLooper:
         extended_audio_length_fmt = (
             f"{duration_mins:d}m{duration_sec:02d}s"
         )
-        output_file_path = (
-            f"{out_path}-extended-{extended_audio_length_fmt}.{format.lower()}"
+        target.path = (
+            f"{self._output_path(output_dir)}-extended-{extended_audio_length_fmt}.{format.lower()}"
+        )
+        return target
+
+    def export(
+        self,
+        loop_start: int,
+        loop_end: int,
+        format: str = "WAV",
+        output_dir: Optional[str] = None,
+        crossfade_length: float = 0,
+        single_file: bool = False,
+    ):
+        """Exports the audio into three files: intro, loop and outro.
+        If `single_file` is set, the whole track is instead written once with the loop points embedded in it.
+
+        Args:
+            loop_start (int): Loop start in samples.
+            loop_end (int): Loop end in samples.
+            format (str, optional): Audio format of the exported files (formats available depend on the `soundfile` library). Defaults to "WAV".
+            output_dir (str, optional): Path to the output directory. Defaults to the same diretcory as the source audio file.
+            crossfade_length (float, optional): Bake a crossfade of this many seconds into the end of the loop section. Not applicable to `single_file` exports. Defaults to 0.
+            single_file (bool, optional): Export a single `-looped` file carrying `smpl`/`cue` chunks (WAV) or LOOPSTART/LOOPLENGTH tags (other formats). Defaults to False.
+        """
+        targets = (
+            [self._looped_target(loop_start, loop_end, format, output_dir)]
+            if single_file
+            else self._split_targets(loop_start, loop_end, format, output_dir, crossfade_length)
         )
+        run_exports(targets, self.mlaudio.rate, self.mlaudio.n_channels)
+
+    def extend(
+        self,
+        loop_start: int,
+        loop_end: int,
+        extended_length: float,
+        fade_length: float = 5,
+        disable_fade_out: bool = False,
+        format: str = "WAV",
+        output_dir: Optional[str] = None,
+        crossfade_length: float = 0,
+        output: Optional[Union[str, BinaryIO]] = None,
+    ) -> Union[str, BinaryIO]:
+        """Extends the audio by looping to at least the specified length.
+        Returns the path to the extended audio file (or `output` if it is a file-like object).
 
+        Args:
+            loop_start (int): Loop start in samples.
+            loop_end (int): Loop end in samples.
+            extended_length (float): Desired length of the extended audio in seconds.
+            fade_length (float, optional): Desired length of the extended audio's fade out in seconds.
+            disable_fade_out (bool, optional): Disable fading out from the loop section, and instead, includes the audio outro section . If `True`, `extended_length` will be treated as an 'at least' constraint.
+            format (str, optional): Audio format of the exported files (formats available depend on the `soundfile` library). Defaults to "WAV".
+            output_dir (str, optional): Path to the output directory. Defaults to the same directory as the source audio file.
+            crossfade_length (float, optional): Crossfade every loop repetition into the next one over this many seconds. Defaults to 0.
+            output (Union[str, BinaryIO], optional): Path or file-like object (e.g. a pipe) to stream the extended audio to instead of the default file in `output_dir`. Non-seekable outputs require a streamable format (e.g. OGG, FLAC, MP3). Defaults to None.
+        """
+        if output is None:
+            target = self._extended_target(
+                loop_start, loop_end, extended_length, fade_length,
+                disable_fade_out, format, output_dir, crossfade_length,
+            )
+            return run_exports([target], self.mlaudio.rate, self.mlaudio.n_channels)[0]
+
+        sections, samples_to_fade = self._extended_layout(
+            loop_start, loop_end, extended_length, fade_length, disable_fade_out, crossfade_length
+        )
         # Export with buffered write logic to avoid storing the entire extended audio in-memory
         with soundfile.SoundFile(
-            output_file_path,
+            output,
             mode="w",
             samplerate=self.mlaudio.rate,
             channels=self.mlaudio.n_channels,
             format=format,
         ) as sf:
-            dtype = str(self.mlaudio.playback_audio.dtype)
-            sf.buffer_write(intro.tobytes(order="C"), dtype)
-            for _ in range(int(loop_factor)):
-                sf.buffer_write(loop.tobytes(order="C"), dtype)
-            sf.buffer_write(final_loop.tobytes(order="C"), dtype)
-            if disable_fade_out:
-                sf.buffer_write(outro.tobytes(order="C"), dtype)
-        return output_file_path
+            write_sections(sf, sections, fade_out_length=samples_to_fade)
+        return output
+
+    def export_all(
+        self,
+        loop_start: int,
+        loop_end: int,
+        formats: Sequence[str] = ("WAV",),
+        split: bool = True,
+        single_file: bool = False,
+        extended_length: Optional[float] = None,
+        fade_length: float = 5,
+        disable_fade_out: bool = False,
+        output_dir: Optional[str] = None,
+        crossfade_length: float = 0,
+        max_workers: Optional[int] = None,
+        progress_callback: Optional[Callable[[str, int, int], None]] = None,
+    ) -> List[str]:
+        """Exports the split sections and/or the extended track in every format requested, encoding the files concurrently.
+        Returns the paths of the exported files.
+
+        Args:
+            loop_start (int): Loop start in samples.
+            loop_end (int): Loop end in samples.
+            formats (Sequence[str], optional): Audio formats to export (formats available depend on the `soundfile` library). Defaults to ("WAV",).
+            split (bool, optional): Export the intro, loop and outro sections (see `export`). Defaults to True.
+            single_file (bool, optional): Instead of splitting, export the whole track once with the loop points embedded (see `export`). Defaults to False.
+            extended_length (float, optional): If specified, also export an extended track of this length in seconds (see `extend`). Defaults to None.
+            fade_length (float, optional): Length of the extended track's fade out in seconds. Defaults to 5.
+            disable_fade_out (bool, optional): Include the outro in the extended track instead of fading out. Defaults to False.
+            output_dir (str, optional): Path to the output directory. Defaults to the same directory as the source audio file.
+            crossfade_length (float, optional): Crossfade length of the loop seam in seconds. Defaults to 0.
+            max_workers (int, optional): Maximum number of files encoded at the same time. Defaults to one per file (capped by the CPU count).
+            progress_callback (Callable[[str, int, int], None], optional): Called from the worker threads with (file path, samples written, total samples). Defaults to None.
+        """
+        targets = []
+        for format in formats:
+            if split and single_file:
+                targets.append(self._looped_target(loop_start, loop_end, format, output_dir))
+            elif split:
+                targets.extend(self._split_targets(loop_start, loop_end, format, output_dir, crossfade_length))
+            if extended_length:
+                targets.append(
+                    self._extended_target(
+                        loop_start, loop_end, extended_length, fade_length,
+                        disable_fade_out, format, output_dir, crossfade_length,
+                    )
+                )
+        return run_exports(
+            targets,
+            self.mlaudio.rate,
+            self.mlaudio.n_channels,
+            max_workers=max_workers,
+            progress_callback=(
+                (lambda target, n_written, total: progress_callback(target.path, n_written, total))
+                if progress_callback is not None
+                else None
+            ),
+        )
+
+    def stream(
+        self,
+        loop_start: int,
+        loop_end: int,
+        output: BinaryIO,
+        format: str = "RAW",
+        subtype: str = "PCM_16",
+        crossfade_length: float = 0,
+        realtime: bool = False,
+        stop_event: Optional[threading.Event] = None,
+    ) -> int:
+        """Streams the intro and then the loop section endlessly to a binary file object (e.g. stdout, a pipe or a socket).
+        Returns once `stop_event` is set, with the number of completed loops.
+
+        Args:
+            loop_start (int): Loop start in samples.
+            loop_end (int): Loop end in samples.
+            output (BinaryIO): The binary file object to write to.
+            format (str, optional): "RAW" for headerless interleaved PCM, or a streamable format supported by the `soundfile` library (e.g. "OGG"). Defaults to "RAW".
+            subtype (str, optional): Sample type of RAW streams, "PCM_16" or "FLOAT". Defaults to "PCM_16".
+            crossfade_length (float, optional): Crossfade the loop end into the loop start over this many seconds. Defaults to 0.
+            realtime (bool, optional): Pace the output to the audio's playback speed instead of writing as fast as the output accepts. Defaults to False.
+            stop_event (threading.Event, optional): Event that stops the stream once set. Defaults to None (streams until the output is closed).
+        """
+        seam = self.loop_seam(loop_start, loop_end, crossfade_length)
+        samplerate = self.mlaudio.rate if realtime else None
+
+        if format.upper() == "RAW":
+            # Convert the streamed region once, so that every pass is written without further processing
+            audio = encode_pcm(self.mlaudio.playback_audio[:loop_end], subtype)
+            if seam is not None:
+                seam = LoopSeam(loop_start, loop_end, encode_pcm(seam.audio, subtype))
+            return stream_loop(
+                RawPCMWriter(output), audio, loop_start, loop_end,
+                seam=seam, stop_event=stop_event, samplerate=samplerate,
+            )
+
+        with EncodedStreamWriter(
+            output, self.mlaudio.rate, self.mlaudio.n_channels, format
+        ) as sf:
+            return stream_loop(
+                sf, self.mlaudio.playback_audio, loop_start, loop_end,
+                seam=seam, stop_event=stop_event, samplerate=samplerate,
+            )
 
     def export_txt(
         self,
@@ -295,10 +601,10 @@ class MusicLooper:
         if output_dir is not None:
             out_path = os.path.join(output_dir, f"{txt_name}.txt")
         else:
-            out_path = os.path.join(os.path.dirname(self.mlaudio.filepath), f"{txt_name}.txt")
+            out_path = os.path.join(os.path.dirname(self.filepath), f"{txt_name}.txt")
 
         with open(out_path, "a") as file:
-            file.write(f"{loop_start} {loop_end} {self.mlaudio.filename}\n")
+            file.write(f"{loop_start} {loop_end} {self.filename}\n")
 
 
     def _end_tag_is_offset(
@@ -306,12 +612,7 @@ class MusicLooper:
         loop_end_tag: str,
         is_offset: Optional[bool],
     ) -> bool:
-        if is_offset is not None:
-            return is_offset
-
-        upper_loop_end_tag = loop_end_tag.upper()
-
-        return "LEN" in upper_loop_end_tag or "OFFSET" in upper_loop_end_tag
+        return end_tag_is_offset(loop_end_tag, is_offset)
 
 
     def export_tags(
@@ -321,9 +622,11 @@ class MusicLooper:
         loop_start_tag: str,
         loop_end_tag: str,
         is_offset: Optional[bool] = None,
-        output_dir: Optional[str] = None
-    ) -> Tuple[str]:
-        """Adds metadata tags of loop points to a copy of the source audio file.
+        output_dir: Optional[str] = None,
+        in_place: bool = False,
+    ) -> Tuple[str, str, str]:
+        """Adds metadata tags of loop points to a copy of the source audio file, or to the file itself.
+        Returns the tagged file path and the written tag values.
 
         Args:
             loop_start (int): Loop start in samples.
@@ -332,30 +635,18 @@ class MusicLooper:
             loop_end_tag (str): Name of the loop_end metadata tag.
             is_offset (bool, optional): Export second tag as relative length / absolute end. Defaults to auto-detecting based on tag name.
             output_dir (str, optional): Path to the output directory. Defaults to the same diretcory as the source audio file.
+            in_place (bool, optional): Tag the source file itself (atomically, through a temporary clone) instead of a `-tagged` copy. Defaults to False.
         """
-        # Workaround for taglib import issues on Apple silicon devices
-        # Import taglib only when needed to isolate ImportErrors
-        import taglib
-            
-        if output_dir is None:
-            output_dir = os.path.abspath(self.mlaudio.filepath)
-
-        track_name, file_extension = os.path.splitext(self.mlaudio.filename)
-
-        exported_file_path = os.path.join(
-            output_dir, f"{track_name}-tagged{file_extension}"
+        return write_loop_tags(
+            self.filepath,
+            loop_start,
+            loop_end,
+            loop_start_tag,
+            loop_end_tag,
+            is_offset=is_offset,
+            in_place=in_place,
+            output_dir=output_dir,
         )
-        shutil.copyfile(self.mlaudio.filepath, exported_file_path)
-
-        # Handle LOOPLENGTH tag
-        if self._end_tag_is_offset(loop_end_tag, is_offset):
-            loop_end = loop_end - loop_start
-
-        with taglib.File(exported_file_path, save_on_exit=True) as audio_file:
-            audio_file.tags[loop_start_tag] = [str(loop_start)]
-            audio_file.tags[loop_end_tag] = [str(loop_end)]
-
-        return str(loop_start), str(loop_end)
 
 
     def read_tags(self, loop_start_tag: str, loop_end_tag: str, is_offset: Optional[bool] = None) -> Tuple[int, int]:
@@ -369,32 +660,4 @@ class MusicLooper:
         Returns:
             Tuple[int, int]: A tuple containing (loop_start, loop_end)
         """
-        # Workaround for taglib import issues on Apple silicon devices
-        # Import taglib only when needed to isolate ImportErrors
-        import taglib
-
-        loop_start = None
-        loop_end = None
-
-        with taglib.File(self.filepath) as audio_file:
-            if loop_start_tag not in audio_file.tags:
-                raise ValueError(f"The tag \"{loop_start_tag}\" is not present in the metadata of \"{self.filename}\".")
-            if loop_end_tag not in audio_file.tags:
-                raise ValueError(f"The tag \"{loop_end_tag}\" is not present in the metadata of \"{self.filename}\".")
-            try:
-                loop_start = int(audio_file.tags[loop_start_tag][0])
-                loop_end = int(audio_file.tags[loop_end_tag][0])
-            except Exception as e:
-                raise TypeError(
-                    "One of the tags provided has invalid (non-integer or empty) values"
-                ) from e
-
-        # Re-order the loop points in case
-        real_loop_start = min(loop_start, loop_end)
-        real_loop_end = max(loop_start, loop_end)
-
-        # Handle LOOPLENGTH tag
-        if self._end_tag_is_offset(loop_end_tag, is_offset):
-            real_loop_end = real_loop_start + real_loop_end
-
-        return real_loop_start, real_loop_end
+        return read_loop_tags(self.filepath, loop_start_tag, loop_end_tag, is_offset)
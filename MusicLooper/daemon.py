@@ -0,0 +1,382 @@
+"""Long-lived local analysis server that keeps the MusicLooper stack warm between jobs.
+
+Starting the CLI for every track pays for the interpreter startup, the imports and the numba JIT
+(or cache loading) each time. The server pays for them once, keeps recently used tracks decoded
+along with their analysis results, and runs the jobs submitted to it from a queue with a
+concurrency limit.
+
+Clients (see `client.py`) talk to the server over a Unix socket or a local TCP port (see
+`utils.open_listening_socket`) with newline-delimited JSON: every request line gets exactly one
+response line. Requests:
+    {"op": "submit", "type": "analyze", "params": {"path": ...}, "wait": false} -> {"ok": true, "job": {...}}
+    {"op": "status", "id": 1} / {"op": "wait", "id": 1, "timeout": null} -> {"ok": true, "job": {...}}
+    {"op": "jobs"} -> {"ok": true, "jobs": [...]}
+    {"op": "ping"} / {"op": "shutdown"} -> {"ok": true}
+Errors are reported as {"ok": false, "error": "..."}.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numba
+import numpy as np
+from numba import config as numba_config
+
+from analysis import LoopPair, LoopPairList, _find_candidate_pairs, refine_loop_points, set_analysis_threads
+from audio import get_analysis_profile
+from core import MusicLooper
+from handler import LoopHandler
+from client import JOB_TYPES
+from utils import open_listening_socket, remove_unix_socket
+
+# Number of tracks kept decoded (with their analysis results) between jobs
+DEFAULT_CACHE_SIZE = 8
+# Number of finished jobs whose status can still be queried
+JOB_HISTORY_SIZE = 1000
+# Threading layer of the parallel analysis kernels, which jobs launch from worker threads (possibly several at once):
+# the workqueue layer aborts on concurrent launches, and the TBB layer hangs at exit after launches off the main thread
+THREADING_LAYER = "omp"
+
+# Job parameters selecting the loop pairs, passed on to `LoopHandler`
+_SEARCH_PARAMS = (
+    "min_duration_multiplier",
+    "min_loop_duration",
+    "max_loop_duration",
+    "approx_loop_position",
+    "brute_force",
+    "disable_pruning",
+    "bpm",
+    "beat_grid",
+    "structure_segments",
+    "beat_sync",
+    "repetition_lags",
+    "duplicate_tolerance",
+)
+
+
+@dataclasses.dataclass
+class Job:
+    id: int
+    type: str
+    params: dict
+    state: str = "queued"
+    result: Any = None
+    error: Optional[str] = None
+    submitted: float = dataclasses.field(default_factory=time.time)
+    finished: Optional[float] = None
+    done: threading.Event = dataclasses.field(default_factory=threading.Event, repr=False)
+
+    def to_dict(self) -> dict:
+        status = {"id": self.id, "type": self.type, "state": self.state}
+        if self.state == "done":
+            status["result"] = self.result
+        elif self.state == "failed":
+            status["error"] = self.error
+        return status
+
+
+@dataclasses.dataclass
+class _CachedTrack:
+    looper: MusicLooper
+    signature: tuple
+    # Jobs on the same track run one at a time, as loop pair lists are finalized in place
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+    loop_pairs: Dict[tuple, List[LoopPair]] = dataclasses.field(default_factory=dict)
+
+
+def select_threading_layer():
+    """Selects `THREADING_LAYER` for the parallel analysis kernels; must be called before any of them runs.
+
+    Raises:
+        RuntimeError: If the threading layer is not available, or another one is already in use.
+    """
+    try:
+        layer = numba.threading_layer()
+    except ValueError:
+        # No parallel kernel has run yet
+        layer = None
+    if layer is not None and layer != THREADING_LAYER:
+        raise RuntimeError(f"The analysis server requires numba's \"{THREADING_LAYER}\" threading layer, but \"{layer}\" is already in use.")
+    try:
+        from numba.np.ufunc import omppool  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError(f"The analysis server requires numba's OpenMP (\"{THREADING_LAYER}\") threading layer, which is not available: {e}") from e
+    numba_config.THREADING_LAYER = THREADING_LAYER
+
+
+def warm_up():
+    """Compiles (or loads from the cache) the numba kernels used by the analysis, so that the first job does not pay for it."""
+    for dtype in (np.float32, np.float64):
+        features = np.ones((12, 8), dtype=dtype)
+        _find_candidate_pairs(features, features, np.arange(8), 1, 8)
+    refine_loop_points(np.zeros((4096, 2), dtype=np.float32), 44100, [1024], [3072], seam_window=16)
+
+
+def loop_pair_to_dict(pair: LoopPair) -> dict:
+    """Returns the public fields of `pair` as JSON-serializable values."""
+    return {
+        field.name: getattr(pair, field.name).item() if isinstance(getattr(pair, field.name), np.generic) else getattr(pair, field.name)
+        for field in dataclasses.fields(pair)
+        if not field.name.startswith("_")
+    }
+
+
+class AnalysisServer:
+    """Runs analysis/export jobs on a pool of worker threads, reusing decoded tracks and their analysis results."""
+
+    def __init__(self, max_jobs: int = 1, cache_size: int = DEFAULT_CACHE_SIZE, threads: Optional[int] = None):
+        """
+        Args:
+            max_jobs (int, optional): Number of jobs that run concurrently; further jobs are queued in submission order. Defaults to 1.
+            cache_size (int, optional): Number of tracks kept decoded between jobs. Defaults to DEFAULT_CACHE_SIZE.
+            threads (int, optional): Number of threads used by the parallel analysis kernels of each job. Defaults to None (all available threads).
+
+        Raises:
+            RuntimeError: If the threading layer required by the jobs is not available (see `select_threading_layer`).
+        """
+        select_threading_layer()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_jobs,
+            thread_name_prefix="pml-job",
+            # The thread count of numba is set per calling thread
+            initializer=set_analysis_threads,
+            initargs=(threads,),
+        )
+        self.cache_size = cache_size
+        self.stop_event = threading.Event()
+        self._jobs: "OrderedDict[int, Job]" = OrderedDict()
+        self._tracks: "OrderedDict[tuple, _CachedTrack]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._runners: Dict[str, Callable[[dict], Any]] = {
+            "analyze": self._analyze,
+            "refine": self._refine,
+            "export": self._export,
+            "extend": self._extend,
+            "tag": self._tag,
+        }
+
+    def submit(self, job_type: str, params: dict) -> Job:
+        """Queues a job and returns it immediately.
+
+        Raises:
+            ValueError: If `job_type` is unknown or the job has no "path" parameter.
+        """
+        if job_type not in self._runners:
+            raise ValueError(f"Unknown job type \"{job_type}\". Available job types: {', '.join(JOB_TYPES)}.")
+        if not params.get("path"):
+            raise ValueError("Job parameter \"path\" is required.")
+        with self._lock:
+            job = Job(id=self._next_id, type=job_type, params=params)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._prune_jobs()
+        self.executor.submit(self._run_job, job)
+        return job
+
+    def job(self, job_id: int) -> Job:
+        with self._lock:
+            if job_id not in self._jobs:
+                raise KeyError(f"Unknown job id {job_id}.")
+            return self._jobs[job_id]
+
+    def jobs(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def shutdown(self):
+        """Stops accepting jobs and cancels the queued ones; `serve` returns once the running jobs are finished."""
+        self.stop_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def handle_request(self, request: dict) -> dict:
+        """Executes a single protocol request and returns its response."""
+        try:
+            op = request.get("op")
+            if op == "submit":
+                job = self.submit(request.get("type"), dict(request.get("params") or {}))
+                if request.get("wait", False):
+                    job.done.wait()
+                return {"ok": True, "job": job.to_dict()}
+            if op == "status":
+                return {"ok": True, "job": self.job(int(request["id"])).to_dict()}
+            if op == "wait":
+                job = self.job(int(request["id"]))
+                job.done.wait(request.get("timeout"))
+                return {"ok": True, "job": job.to_dict()}
+            if op == "jobs":
+                return {"ok": True, "jobs": [job.to_dict() for job in self.jobs()]}
+            if op == "ping":
+                return {"ok": True}
+            if op == "shutdown":
+                self.shutdown()
+                return {"ok": True}
+            raise ValueError(f"Unknown request op \"{op}\".")
+        except Exception as e:
+            return {"ok": False, "error": str(e) or type(e).__name__}
+
+    def serve(self, address: str):
+        """Accepts clients on `address` until `shutdown` is called (or a "shutdown" request is received); each client connection is handled on its own thread."""
+        try:
+            with open_listening_socket(address, backlog=socket.SOMAXCONN) as server:
+                # Wake up periodically to check whether the server was shut down
+                server.settimeout(1)
+                while not self.stop_event.is_set():
+                    try:
+                        conn, _ = server.accept()
+                    except socket.timeout:
+                        continue
+                    conn.settimeout(None)
+                    threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+        finally:
+            self.stop_event.set()
+            # Queued jobs are cancelled, and the running ones are finished before returning
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        if not address.rpartition(":")[2].isdigit():
+            remove_unix_socket(address)
+
+    def _handle_connection(self, conn: socket.socket):
+        with conn, conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+            try:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        response = {"ok": False, "error": f"Invalid request: {e}"}
+                    else:
+                        response = self.handle_request(request)
+                    writer.write(json.dumps(response).encode() + b"\n")
+                    writer.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                logging.info("Client disconnected.")
+
+    def _prune_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done.is_set()]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+            del self._jobs[job_id]
+
+    def _run_job(self, job: Job):
+        job.state = "running"
+        start_time = time.perf_counter()
+        try:
+            job.result = self._runners[job.type](job.params)
+            job.state = "done"
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.state = "failed"
+            logging.error(f"Job {job.id} ({job.type} \"{job.params.get('path')}\") failed: {job.error}")
+        job.finished = time.time()
+        logging.info(f"Job {job.id} ({job.type}) {job.state} in {time.perf_counter() - start_time:.3f}s")
+        job.done.set()
+
+    def _track(self, params: dict) -> _CachedTrack:
+        """Returns the cached track of the job, reloading it if the file changed since it was cached."""
+        path = os.path.abspath(params["path"])
+        profile = get_analysis_profile(params.get("analysis_profile"))
+        stat = os.stat(path)
+        key = (path, profile)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            track = self._tracks.get(key)
+            if track is None or track.signature != signature:
+                track = _CachedTrack(MusicLooper(path, analysis_profile=profile), signature)
+                self._tracks[key] = track
+            self._tracks.move_to_end(key)
+            while len(self._tracks) > self.cache_size:
+                self._tracks.popitem(last=False)
+        return track
+
+    def _loop_pairs(self, track: _CachedTrack, params: dict, count: int) -> List[LoopPair]:
+        """Returns the best `count` loop pairs of the track for the search parameters of the job; the caller must hold `track.lock`."""
+        search = {name: params[name] for name in _SEARCH_PARAMS if params.get(name) is not None}
+        search.setdefault("min_duration_multiplier", 0.35)
+        key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in search.items()))
+        if key not in track.loop_pairs:
+            handler = LoopHandler(path=track.looper.filepath, musiclooper=track.looper, **search)
+            track.loop_pairs[key] = handler.get_all_loop_pairs()
+        loop_pairs = track.loop_pairs[key]
+        if isinstance(loop_pairs, LoopPairList):
+            loop_pairs.finalize(count)
+        return loop_pairs[:count]
+
+    def _selected_loop(self, track: _CachedTrack, params: dict):
+        """Returns the (loop_start, loop_end) given in the job parameters, or those of the loop pair ranked `rank` (default: the best)."""
+        if params.get("loop_start") is not None and params.get("loop_end") is not None:
+            return int(params["loop_start"]), int(params["loop_end"])
+        rank = int(params.get("rank", 0))
+        loop_pairs = self._loop_pairs(track, params, rank + 1)
+        if rank >= len(loop_pairs):
+            raise ValueError(f"Only {len(loop_pairs)} loop pairs were found; cannot select rank {rank}.")
+        return loop_pairs[rank].loop_start, loop_pairs[rank].loop_end
+
+    def _analyze(self, params: dict) -> dict:
+        track = self._track(params)
+        with track.lock:
+            loop_pairs = self._loop_pairs(track, params, int(params.get("top", 1)))
+        return {"path": track.looper.filepath, "loop_pairs": [loop_pair_to_dict(pair) for pair in loop_pairs]}
+
+    def _refine(self, params: dict) -> dict:
+        if params.get("approx_loop_position") is None:
+            raise ValueError("Job parameter \"approx_loop_position\" ([start, end] in seconds) is required to refine loop points.")
+        return self._analyze(params)
+
+    def _export(self, params: dict) -> dict:
+        track = self._track(params)
+        with track.lock:
+            loop_start, loop_end = self._selected_loop(track, params)
+            formats = params.get("format", "WAV")
+            files = track.looper.export_all(
+                loop_start,
+                loop_end,
+                formats=[formats] if isinstance(formats, str) else formats,
+                single_file=params.get("single_file", False),
+                output_dir=params.get("output_dir"),
+                crossfade_length=params.get("crossfade_length", 0),
+            )
+        return {"loop_start": loop_start, "loop_end": loop_end, "files": files}
+
+    def _extend(self, params: dict) -> dict:
+        if params.get("extended_length") is None:
+            raise ValueError("Job parameter \"extended_length\" (in seconds) is required.")
+        track = self._track(params)
+        with track.lock:
+            loop_start, loop_end = self._selected_loop(track, params)
+            formats = params.get("format", "MP3")
+            files = track.looper.export_all(
+                loop_start,
+                loop_end,
+                formats=[formats] if isinstance(formats, str) else formats,
+                split=False,
+                extended_length=params["extended_length"],
+                fade_length=params.get("fade_length", 5),
+                disable_fade_out=params.get("disable_fade_out", False),
+                output_dir=params.get("output_dir"),
+                crossfade_length=params.get("crossfade_length", 0),
+            )
+        return {"loop_start": loop_start, "loop_end": loop_end, "files": files}
+
+    def _tag(self, params: dict) -> dict:
+        loop_start_tag, loop_end_tag = params.get("tag_names") or ("LOOPSTART", "LOOPLENGTH")
+        track = self._track(params)
+        with track.lock:
+            loop_start, loop_end = self._selected_loop(track, params)
+            path, loop_start_value, loop_end_value = track.looper.export_tags(
+                loop_start,
+                loop_end,
+                loop_start_tag,
+                loop_end_tag,
+                is_offset=params.get("tag_offset"),
+                output_dir=params.get("output_dir"),
+                in_place=params.get("in_place", False),
+            )
+        return {"path": path, loop_start_tag: loop_start_value, loop_end_tag: loop_end_value}
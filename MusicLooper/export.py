@@ -0,0 +1,608 @@
+"""Buffered writers used to export (potentially very long) looped audio
+without materializing it in memory."""
+
+import io
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, List, Optional, Sequence, Tuple
+
+import lazy_loader as lazy
+import numpy as np
+
+from playback import LoopSeam
+
+# Lazy-load external libraries when they're needed
+soundfile = lazy.load("soundfile")
+
+# Number of samples processed per block when a section has to be modified (e.g. faded) before writing
+CHUNK_SIZE = 65536
+
+# Sample types supported for headerless PCM streams
+RAW_SUBTYPES = {"PCM_16": np.int16, "FLOAT": np.float32}
+
+
+def extended_sections(
+    playback_audio: np.ndarray,
+    loop_start: int,
+    loop_end: int,
+    n_loops: int,
+    final_loop_length: int,
+    include_outro: bool = False,
+    seam: Optional[LoopSeam] = None,
+) -> List[np.ndarray]:
+    """Lays out an extended track as a list of views into `playback_audio`; nothing is copied.
+
+    Args:
+        playback_audio (np.ndarray): The playback audio in the shape `(samples, n_channels)`
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples
+        n_loops (int): Number of full passes through the loop following the intro
+        final_loop_length (int): Length (in samples) of the final, partial pass through the loop
+        include_outro (bool, optional): Whether the outro follows the final pass. Defaults to False.
+        seam (LoopSeam, optional): Crossfaded seam used by every pass that is followed by another pass through the loop. Defaults to None.
+
+    Returns:
+        List[np.ndarray]: the sections to write, in order
+    """
+    loop = playback_audio[loop_start:loop_end]
+    repeated_loop = [loop] if seam is None else list(seam.loop_sections(playback_audio))
+
+    sections = [playback_audio[:loop_start]]
+    for _ in range(n_loops):
+        sections.extend(repeated_loop)
+
+    # The final pass flows into the outro (if any) instead of wrapping around,
+    # so it is taken from the source audio rather than the seam
+    final_sections = [loop] if include_outro else repeated_loop
+    remaining = final_loop_length
+    for section in final_sections:
+        if remaining <= 0:
+            break
+        sections.append(section[:remaining])
+        remaining -= section.shape[0]
+
+    if include_outro:
+        sections.append(playback_audio[loop_end:])
+    return [section for section in sections if section.shape[0] > 0]
+
+
+def write_sections(
+    sf,
+    sections: Sequence[np.ndarray],
+    fade_out_length: int = 0,
+    chunk_size: int = CHUNK_SIZE,
+    progress_callback: Optional[Callable[[int], None]] = None,
+):
+    """Writes `sections` back to back, linearly fading out the last `fade_out_length` samples.
+
+    Contiguous sections are handed to the writer as-is, so repeating the same section does not copy it.
+    The fade out is applied block by block into a fixed-size scratch buffer.
+
+    Args:
+        sf: The destination, an object with a `soundfile.SoundFile`-compatible `buffer_write(data, dtype)` method
+        sections (Sequence[np.ndarray]): The audio sections in the shape `(samples, n_channels)`
+        fade_out_length (int, optional): Number of samples at the end to fade out. Defaults to 0.
+        chunk_size (int, optional): Block size (in samples) used while fading. Defaults to `CHUNK_SIZE`.
+        progress_callback (Callable[[int], None], optional): Called with the total number of samples written so far. If specified, sections are written in blocks of `chunk_size` samples (still without copying). Defaults to None.
+    """
+    total_length = sum(section.shape[0] for section in sections)
+    fade_out_length = min(fade_out_length, total_length)
+    fade_start = total_length - fade_out_length
+
+    scratch = None
+    position = 0
+    for section in sections:
+        dtype = str(section.dtype)
+        section_length = section.shape[0]
+        if not section.flags.c_contiguous:
+            section = np.ascontiguousarray(section)
+
+        n_unfaded = min(section_length, max(0, fade_start - position))
+        unfaded_block_size = chunk_size if progress_callback is not None else max(1, n_unfaded)
+        for block_start in range(0, n_unfaded, unfaded_block_size):
+            block = section[block_start:min(n_unfaded, block_start + unfaded_block_size)]
+            sf.buffer_write(block, dtype)
+            position += block.shape[0]
+            if progress_callback is not None:
+                progress_callback(position)
+        if n_unfaded == section_length:
+            continue
+
+        if scratch is None:
+            scratch = np.empty((chunk_size, section.shape[1]), dtype=section.dtype)
+            gain = np.empty(chunk_size, dtype=section.dtype)
+            ramp = np.arange(chunk_size, dtype=section.dtype)
+            # Equivalent to np.linspace(1, 0, fade_out_length)
+            step = 1 / (fade_out_length - 1) if fade_out_length > 1 else 1
+
+        for block_start in range(n_unfaded, section_length, chunk_size):
+            n = min(chunk_size, section_length - block_start)
+            np.add(ramp[:n], position - fade_start, out=gain[:n])
+            gain[:n] *= -step
+            gain[:n] += 1
+            np.multiply(section[block_start:block_start + n], gain[:n, np.newaxis], out=scratch[:n])
+            sf.buffer_write(scratch[:n], dtype)
+            position += n
+            if progress_callback is not None:
+                progress_callback(position)
+
+
+@dataclass
+class ExportTarget:
+    """A single output file, described as views into the source audio."""
+
+    path: str
+    format: str
+    sections: List[np.ndarray] = field(repr=False)
+    fade_out_length: int = 0
+    # (loop_start, loop_end) in samples to embed in the file, see `embed_loop_points`
+    loop_points: Optional[Tuple[int, int]] = None
+
+    @property
+    def length(self) -> int:
+        return sum(section.shape[0] for section in self.sections)
+
+
+def run_exports(
+    targets: Sequence[ExportTarget],
+    samplerate: int,
+    channels: int,
+    max_workers: Optional[int] = None,
+    progress_callback: Optional[Callable[[ExportTarget, int, int], None]] = None,
+) -> List[str]:
+    """Encodes all `targets` concurrently in a thread pool.
+
+    Every target only references (read-only) views of the same source audio, so no audio is copied
+    between workers; the encoders release the GIL, so the total time approaches that of the slowest target.
+
+    Args:
+        targets (Sequence[ExportTarget]): The files to write
+        samplerate (int): Sample rate of the audio
+        channels (int): Number of channels of the audio
+        max_workers (int, optional): Maximum number of files encoded at the same time. Defaults to one per target (capped by the CPU count).
+        progress_callback (Callable[[ExportTarget, int, int], None], optional): Called from the worker threads with (target, samples written, total samples). Defaults to None.
+
+    Returns:
+        List[str]: the paths of the written files, in the order of `targets`
+    """
+    if not targets:
+        return []
+
+    def export_target(target: ExportTarget) -> str:
+        total_length = target.length
+        file_progress = (
+            (lambda n_written: progress_callback(target, n_written, total_length))
+            if progress_callback is not None
+            else None
+        )
+        with soundfile.SoundFile(
+            target.path,
+            mode="w",
+            samplerate=samplerate,
+            channels=channels,
+            format=target.format,
+        ) as sf:
+            write_sections(sf, target.sections, fade_out_length=target.fade_out_length, progress_callback=file_progress)
+        if target.loop_points is not None:
+            embed_loop_points(target.path, target.format, *target.loop_points, samplerate=samplerate)
+        if file_progress is not None:
+            file_progress(total_length)
+        return target.path
+
+    if max_workers is None:
+        max_workers = min(len(targets), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(export_target, targets))
+
+
+def wav_loop_chunks(loop_start: int, loop_end: int, samplerate: int) -> bytes:
+    """Builds the RIFF `smpl` and `cue ` chunks describing a forward loop over `[loop_start, loop_end)`.
+
+    Args:
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples (exclusive)
+        samplerate (int): Sample rate of the audio
+
+    Returns:
+        bytes: the encoded chunks, ready to be appended to a WAV file
+    """
+    # smpl: manufacturer, product, sample period (ns), MIDI unity note, pitch fraction,
+    # SMPTE format, SMPTE offset, number of loops, sampler data size; followed by one loop:
+    # cue point id, type (0 = forward), start, end (inclusive), fraction, play count (0 = infinite)
+    smpl = struct.pack(
+        "<9I6I",
+        0, 0, round(1e9 / samplerate), 60, 0, 0, 0, 1, 0,
+        1, 0, loop_start, loop_end - 1, 0, 0,
+    )
+    # cue: one cue point at each end of the loop, as (id, position, chunk id, chunk start, block start, sample offset)
+    cue = struct.pack("<I", 2) + b"".join(
+        struct.pack("<II4sIII", cue_id, position, b"data", 0, 0, position)
+        for cue_id, position in ((1, loop_start), (2, loop_end))
+    )
+    return (
+        b"smpl" + struct.pack("<I", len(smpl)) + smpl
+        + b"cue " + struct.pack("<I", len(cue)) + cue
+    )
+
+
+def embed_loop_points(path: str, format: str, loop_start: int, loop_end: int, samplerate: int):
+    """Embeds loop points into an exported audio file.
+
+    WAV files get `smpl`/`cue ` chunks appended (the audio data is not rewritten);
+    other formats get LOOPSTART/LOOPLENGTH tags, as read by game engines for OGG/FLAC.
+
+    Args:
+        path (str): Path to the exported file
+        format (str): Format of the exported file
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples
+        samplerate (int): Sample rate of the audio
+    """
+    if format.upper() == "WAV":
+        with open(path, "r+b") as f:
+            f.seek(0, io.SEEK_END)
+            # RIFF chunks are word-aligned
+            if f.tell() % 2:
+                f.write(b"\0")
+            f.write(wav_loop_chunks(loop_start, loop_end, samplerate))
+            riff_size = f.tell() - 8
+            f.seek(4)
+            f.write(struct.pack("<I", riff_size))
+        return
+
+    # Workaround for taglib import issues on Apple silicon devices
+    # Import taglib only when needed to isolate ImportErrors
+    import taglib
+
+    with taglib.File(path, save_on_exit=True) as audio_file:
+        audio_file.tags["LOOPSTART"] = [str(loop_start)]
+        audio_file.tags["LOOPLENGTH"] = [str(loop_end - loop_start)]
+
+
+# Linux ioctl that shares the data blocks of a file with another one (btrfs, XFS, bcachefs...)
+FICLONE = 0x40049409
+
+
+def clone_file(src: str, dst: str) -> bool:
+    """Copies `src` to `dst` as a reflink (copy-on-write clone) where the filesystem supports it,
+    falling back to a regular copy otherwise.
+
+    Returns:
+        bool: whether the file was cloned without copying its data
+    """
+    try:
+        import fcntl
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (ImportError, OSError):
+        shutil.copyfile(src, dst)
+        return False
+
+
+def end_tag_is_offset(loop_end_tag: str, is_offset: Optional[bool] = None) -> bool:
+    """Whether the loop end tag holds the loop length rather than the loop end; auto-detected from the tag name if `is_offset` is None."""
+    if is_offset is not None:
+        return is_offset
+
+    upper_loop_end_tag = loop_end_tag.upper()
+
+    return "LEN" in upper_loop_end_tag or "OFFSET" in upper_loop_end_tag
+
+
+def read_loop_tags(
+    path: str,
+    loop_start_tag: str,
+    loop_end_tag: str,
+    is_offset: Optional[bool] = None,
+) -> Tuple[int, int]:
+    """Reads the loop points stored in the metadata tags of an audio file, without decoding its audio.
+
+    Args:
+        path (str): Path to the audio file
+        loop_start_tag (str): The name of the metadata tag containing the loop_start value
+        loop_end_tag (str): The name of the metadata tag containing the loop_end value
+        is_offset (bool, optional): Parse second tag as relative length / absolute end. Defaults to auto-detecting based on tag name.
+
+    Raises:
+        ValueError: if one of the tags is not present
+        TypeError: if one of the tags has an invalid (non-integer or empty) value
+
+    Returns:
+        Tuple[int, int]: A tuple containing (loop_start, loop_end)
+    """
+    # Workaround for taglib import issues on Apple silicon devices
+    # Import taglib only when needed to isolate ImportErrors
+    import taglib
+
+    filename = os.path.basename(path)
+    with taglib.File(path) as audio_file:
+        if loop_start_tag not in audio_file.tags:
+            raise ValueError(f"The tag \"{loop_start_tag}\" is not present in the metadata of \"{filename}\".")
+        if loop_end_tag not in audio_file.tags:
+            raise ValueError(f"The tag \"{loop_end_tag}\" is not present in the metadata of \"{filename}\".")
+        try:
+            loop_start = int(audio_file.tags[loop_start_tag][0])
+            loop_end = int(audio_file.tags[loop_end_tag][0])
+        except Exception as e:
+            raise TypeError(
+                "One of the tags provided has invalid (non-integer or empty) values"
+            ) from e
+
+    # Re-order the loop points in case
+    real_loop_start = min(loop_start, loop_end)
+    real_loop_end = max(loop_start, loop_end)
+
+    # Handle LOOPLENGTH tag
+    if end_tag_is_offset(loop_end_tag, is_offset):
+        real_loop_end = real_loop_start + real_loop_end
+
+    return real_loop_start, real_loop_end
+
+
+def write_loop_tags(
+    path: str,
+    loop_start: int,
+    loop_end: int,
+    loop_start_tag: str,
+    loop_end_tag: str,
+    is_offset: Optional[bool] = None,
+    in_place: bool = False,
+    output_dir: Optional[str] = None,
+) -> Tuple[str, str, str]:
+    """Adds metadata tags of loop points to an audio file, or to a `-tagged` copy of it.
+
+    In-place tagging never modifies the original file directly: a clone of it is tagged and then
+    atomically renamed over it. Copies are reflinked where the filesystem supports it, so
+    that on copy-on-write filesystems tagging costs about as much as writing the metadata itself.
+
+    Args:
+        path (str): Path to the audio file
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples
+        loop_start_tag (str): Name of the loop_start metadata tag
+        loop_end_tag (str): Name of the loop_end metadata tag
+        is_offset (bool, optional): Export second tag as relative length / absolute end. Defaults to auto-detecting based on tag name.
+        in_place (bool, optional): Tag `path` itself instead of a copy. Defaults to False.
+        output_dir (str, optional): Directory of the `-tagged` copy. Defaults to the directory of `path`. Ignored if `in_place` is set.
+
+    Returns:
+        Tuple[str, str, str]: the tagged file path and the written loop_start and loop_end tag values
+    """
+    # Workaround for taglib import issues on Apple silicon devices
+    # Import taglib only when needed to isolate ImportErrors
+    import taglib
+
+    path = os.path.abspath(path)
+    track_name, file_extension = os.path.splitext(os.path.basename(path))
+    if in_place:
+        tagged_file_path = path
+        # Keep the temporary file on the same filesystem (for an atomic rename) and with
+        # the same extension (taglib detects the file type from it)
+        fd, working_path = tempfile.mkstemp(
+            prefix=f".{track_name}.", suffix=file_extension, dir=os.path.dirname(path)
+        )
+        os.close(fd)
+    else:
+        if output_dir is None:
+            output_dir = os.path.dirname(path)
+        tagged_file_path = os.path.join(output_dir, f"{track_name}-tagged{file_extension}")
+        working_path = tagged_file_path
+
+    # Handle LOOPLENGTH tag
+    if end_tag_is_offset(loop_end_tag, is_offset):
+        loop_end = loop_end - loop_start
+
+    try:
+        clone_file(path, working_path)
+        with taglib.File(working_path, save_on_exit=True) as audio_file:
+            audio_file.tags[loop_start_tag] = [str(loop_start)]
+            audio_file.tags[loop_end_tag] = [str(loop_end)]
+        if in_place:
+            shutil.copymode(path, working_path)
+            os.replace(working_path, tagged_file_path)
+    except BaseException:
+        if in_place and os.path.exists(working_path):
+            os.remove(working_path)
+        raise
+
+    return tagged_file_path, str(loop_start), str(loop_end)
+
+
+def tag_files(
+    jobs: Sequence[Tuple[str, int, int]],
+    loop_start_tag: str,
+    loop_end_tag: str,
+    is_offset: Optional[bool] = None,
+    in_place: bool = False,
+    output_dirs: Optional[Sequence[Optional[str]]] = None,
+    max_workers: Optional[int] = None,
+    progress_callback: Optional[Callable[[str], None]] = None,
+) -> List[Optional[Tuple[str, str, str]]]:
+    """Tags many files concurrently (see `write_loop_tags`).
+
+    The work is dominated by file I/O, which releases the GIL, so a thread pool is used.
+    A failure is logged and does not stop the other files from being tagged.
+
+    Args:
+        jobs (Sequence[Tuple[str, int, int]]): The (path, loop_start, loop_end) of every file to tag
+        loop_start_tag (str): Name of the loop_start metadata tag
+        loop_end_tag (str): Name of the loop_end metadata tag
+        is_offset (bool, optional): Export second tag as relative length / absolute end. Defaults to auto-detecting based on tag name.
+        in_place (bool, optional): Tag the files themselves instead of copies. Defaults to False.
+        output_dirs (Sequence[Optional[str]], optional): Output directory of each job's copy. Defaults to the directory of each file.
+        max_workers (int, optional): Maximum number of files tagged at the same time. Defaults to `ThreadPoolExecutor`'s default.
+        progress_callback (Callable[[str], None], optional): Called with the path of every processed file. Defaults to None.
+
+    Returns:
+        List[Optional[Tuple[str, str, str]]]: the result of `write_loop_tags` for every job, in order, or None if it failed
+    """
+    if output_dirs is None:
+        output_dirs = [None] * len(jobs)
+
+    def tag_job(job: Tuple[str, int, int], output_dir: Optional[str]) -> Optional[Tuple[str, str, str]]:
+        path, loop_start, loop_end = job
+        try:
+            return write_loop_tags(
+                path, loop_start, loop_end, loop_start_tag, loop_end_tag,
+                is_offset=is_offset, in_place=in_place, output_dir=output_dir,
+            )
+        except Exception as e:
+            logging.error(f"Failed to tag \"{path}\": {e}")
+            return None
+        finally:
+            if progress_callback is not None:
+                progress_callback(path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(tag_job, jobs, output_dirs))
+
+
+def encode_pcm(audio: np.ndarray, subtype: str = "PCM_16") -> np.ndarray:
+    """Converts float audio in [-1.0, 1.0] to the sample type of a headerless PCM `subtype`."""
+    dtype = RAW_SUBTYPES[subtype.upper()]
+    if np.issubdtype(dtype, np.integer):
+        scale = np.iinfo(dtype).max
+        return np.ascontiguousarray(np.clip(audio * scale, -scale - 1, scale).astype(dtype))
+    return np.ascontiguousarray(audio, dtype=dtype)
+
+
+class RawPCMWriter:
+    """Writes headerless interleaved PCM samples to a binary file object.
+    Exposes the same `buffer_write` method as `soundfile.SoundFile`, so it can be used with the writers in this module."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+
+    def buffer_write(self, data: np.ndarray, dtype: str):
+        self.file.write(memoryview(data).cast("B"))
+        self.file.flush()
+
+
+class NonSeekableOutput(io.RawIOBase):
+    """Wraps a pipe or socket file object for `soundfile`.
+
+    libsndfile probes the output position when opening a virtual file; this reports the number
+    of bytes written so far so that streamable formats (e.g. OGG) can be encoded to non-seekable outputs.
+    Write errors are stored in `error` instead of being raised, since libsndfile ignores exceptions raised in its callbacks.
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.position = 0
+        self.error = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.error is not None:
+            return 0
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except OSError as e:
+            self.error = e
+            return 0
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        target = offset if whence == io.SEEK_SET else self.position + offset
+        if target != self.position:
+            raise io.UnsupportedOperation("The output stream is not seekable.")
+        return self.position
+
+
+class EncodedStreamWriter:
+    """Encodes audio with `soundfile` into a non-seekable binary file object (e.g. a pipe or a socket).
+    Raises the underlying write error (e.g. `BrokenPipeError`) once the output is closed by the reader."""
+
+    def __init__(self, file: BinaryIO, samplerate: int, channels: int, format: str):
+        self.output = NonSeekableOutput(file)
+        self.sf = soundfile.SoundFile(
+            self.output, mode="w", samplerate=samplerate, channels=channels, format=format
+        )
+
+    def buffer_write(self, data: np.ndarray, dtype: str):
+        self.sf.buffer_write(data, dtype)
+        if self.output.error is not None:
+            raise self.output.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.sf.close()
+
+
+def stream_loop(
+    sf,
+    playback_audio: np.ndarray,
+    loop_start: int,
+    loop_end: int,
+    seam: Optional[LoopSeam] = None,
+    stop_event: Optional[threading.Event] = None,
+    samplerate: Optional[int] = None,
+    block_size: int = CHUNK_SIZE,
+) -> int:
+    """Writes the intro followed by the loop section repeated endlessly, until `stop_event` is set.
+
+    Only views of `playback_audio` (and the seam) are written, so memory use stays constant
+    regardless of how long the stream runs.
+
+    Args:
+        sf: The destination, an object with a `soundfile.SoundFile`-compatible `buffer_write(data, dtype)` method
+        playback_audio (np.ndarray): The audio to stream in the shape `(samples, n_channels)`; only `[:loop_end]` is used
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples
+        seam (LoopSeam, optional): Crossfaded seam to use at the end of every pass through the loop. Defaults to None.
+        stop_event (threading.Event, optional): Stops the stream after the current block once set. Defaults to None (runs until the output is closed).
+        samplerate (int, optional): If specified, paces the writes to real time at this rate (writing at most one second ahead). Defaults to None (as fast as the output accepts).
+        block_size (int, optional): Maximum number of samples per write. Defaults to `CHUNK_SIZE`.
+
+    Returns:
+        int: the number of completed passes through the loop
+    """
+    intro = playback_audio[:loop_start]
+    loop_sections = [playback_audio[loop_start:loop_end]] if seam is None else list(seam.loop_sections(playback_audio))
+    loop_sections = [section for section in loop_sections if section.shape[0] > 0]
+    dtype = str(playback_audio.dtype)
+    if samplerate:
+        # Small blocks keep the paced output smooth and the stream responsive to `stop_event`
+        block_size = min(block_size, max(1, samplerate // 10))
+
+    n_written = 0
+    stream_start = time.perf_counter()
+
+    def write_blocks(section: np.ndarray) -> bool:
+        nonlocal n_written
+        for block_start in range(0, section.shape[0], block_size):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            block = section[block_start:block_start + block_size]
+            sf.buffer_write(block, dtype)
+            n_written += block.shape[0]
+            if samplerate:
+                ahead = n_written / samplerate - (time.perf_counter() - stream_start)
+                if ahead > 1:
+                    time.sleep(ahead - 1)
+        return True
+
+    if not write_blocks(intro) or not loop_sections:
+        return 0
+    loop_counter = 0
+    while all(write_blocks(section) for section in loop_sections):
+        loop_counter += 1
+    return loop_counter
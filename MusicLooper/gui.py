@@ -10,6 +10,7 @@ from typing import Dict
 import base64
 import shutil
 import json
+import numpy as np
 
 # 設定 FFmpeg 路徑
 ffmpeg_path = os.path.join(os.path.dirname(__file__), "ffmpeg", "bin")
@@ -244,19 +245,16 @@ class MainWindow(QMainWindow):
         for cb in self.score_checkboxes.values():
             cb.stateChanged.connect(self.update_scores_and_table)
         
-        # 結果列表 - 添加選擇功能
-        self.results = QTableWidget()
-        self.results.setColumnCount(4)
-        self.results.setHorizontalHeaderLabels(self.tr["columns"])
-        self.results.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)  # 整行選擇
-        self.results.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)     # 單行選擇
+        # 結果列表 - 以 numpy 陣列為資料來源的模型，只繪製可見的列
+        self.results_model = LoopTableModel(self.tr["columns"], self)
+        self.results = QTableView()
+        self.results.setModel(self.results_model)
+        self.results.setSelectionBehavior(QTableView.SelectionBehavior.SelectRows)  # 整行選擇
+        self.results.setSelectionMode(QTableView.SelectionMode.SingleSelection)     # 單行選擇
         
         # 顯示垂直標題(從0開始)
         self.results.verticalHeader().setVisible(True)
         
-        # 啟用排序功能
-        self.results.setSortingEnabled(True)
-        
         # 設定每個欄位的寬度
         self.results.setColumnWidth(0, 65)  # 起點
         self.results.setColumnWidth(1, 65)  # 終點
@@ -268,11 +266,11 @@ class MainWindow(QMainWindow):
         # 設定垂直標題的對齊方式
         self.results.verticalHeader().setDefaultAlignment(Qt.AlignmentFlag.AlignCenter)
         
-        # 設定表格的排序指示器方向
+        # 啟用排序功能（由模型以 argsort 排序）
         self.results.setSortingEnabled(True)
         
         # 添加選擇變更事件處理
-        self.results.itemSelectionChanged.connect(self.on_selection_changed)
+        self.results.selectionModel().selectionChanged.connect(self.on_selection_changed)
         
         # 播放控制區
         playback_group = QGroupBox(self.tr["playback_group"])
@@ -444,37 +442,23 @@ class MainWindow(QMainWindow):
         # 防呆：只處理 LoopPair 物件
         loops = getattr(self, 'all_loops', [])
         if not loops or not hasattr(loops[0], 'score'):
-            self.results.setRowCount(0)
+            self.results_model.set_loops([], 1)
             return
-        # 重新加權分數
-        for loop in loops:
-            loop.score = (
-                score_weights['original'] * getattr(loop, 'original_score', 0) +
-                score_weights['structure'] * getattr(loop, 'structure_score', 0) +
-                score_weights['chord'] * getattr(loop, 'chord_score', 0) +
-                score_weights['mfcc'] * getattr(loop, 'mfcc_score', 0)
-            )
-        # 重新排序
-        sorted_loops = sorted(enumerate(loops), key=lambda x: x[1].score, reverse=True)
-        self.results.setSortingEnabled(False)
-        try:
-            self.results.setRowCount(len(sorted_loops))
-            for rank, (original_index, loop) in enumerate(sorted_loops):
-                start_time = self.music_looper.samples_to_seconds(loop.loop_start)
-                end_time = self.music_looper.samples_to_seconds(loop.loop_end)
-                duration = end_time - start_time
-                items = [
-                    NumericTableItem(f"{start_time:.2f}"),
-                    NumericTableItem(f"{end_time:.2f}"),
-                    NumericTableItem(f"{duration:.2f}"),
-                    NumericTableItem(f"{loop.score:.2%}")
-                ]
-                for col, item in enumerate(items):
-                    self.results.setItem(rank, col, item)
-                self.results.setVerticalHeaderItem(rank, QTableWidgetItem(str(rank)))
-        finally:
-            self.results.setSortingEnabled(True)
-            self.results.viewport().update()
+        if self.results_model.loops is not loops:
+            self.results_model.set_loops(loops, self.music_looper.mlaudio.rate)
+        # 重新加權分數並重新排序（向量化）
+        self.results_model.reweight(score_weights)
+        # 清除欄位排序指示，回到依分數排序
+        self.results.horizontalHeader().setSortIndicator(-1, Qt.SortOrder.DescendingOrder)
+
+    def selected_loop(self):
+        """回傳目前選擇的列的 (列號, 迴圈起點, 迴圈終點)，迴圈點以樣本為單位；未選擇時回傳 None"""
+        selected = self.results.selectionModel().selectedRows()
+        if not selected:
+            return None
+        row = selected[0].row()
+        loop_start, loop_end = self.results_model.loop_points(row)
+        return row, loop_start, loop_end
 
     def format_time(self, seconds):
         """將秒數格式化為 mm:ss 格式"""
@@ -495,18 +479,14 @@ class MainWindow(QMainWindow):
         if not self.music_looper:
             return
             
-        selected = self.results.selectedItems()
+        selected = self.selected_loop()
         if not selected:
             return
             
-        row = selected[0].row()
-        start_seconds = float(self.results.item(row, 0).text())
-        end_seconds = float(self.results.item(row, 1).text())
-        duration = end_seconds - start_seconds
+        _, start_samples, end_samples = selected
         
         # 計算新的播放位置
-        position = start_seconds + (duration * self.time_slider.value() / 100)
-        new_start_samples = self.music_looper.seconds_to_samples(position)
+        new_start_samples = start_samples + int((end_samples - start_samples) * self.time_slider.value() / 100)
         
         # 如果之前在播放就繼續播放
         if self.slider_was_playing:
@@ -515,8 +495,8 @@ class MainWindow(QMainWindow):
                 self.music_looper.mlaudio.playback_audio,
                 self.music_looper.mlaudio.rate,
                 self.music_looper.mlaudio.n_channels,
-                self.music_looper.seconds_to_samples(start_seconds),
-                self.music_looper.seconds_to_samples(end_seconds),
+                start_samples,
+                end_samples,
                 start_from=new_start_samples,
                 progress_callback=self.update_progress
             )
@@ -535,16 +515,14 @@ class MainWindow(QMainWindow):
             if self.time_slider.isSliderDown():
                 return
                 
-            selected = self.results.selectedItems()
+            selected = self.selected_loop()
             if not selected:
                 return
                 
-            row = selected[0].row()
-            start_seconds = float(self.results.item(row, 0).text())
-            end_seconds = float(self.results.item(row, 1).text())
+            _, start_samples, end_samples = selected
             
-            current_time = (frame - self.music_looper.seconds_to_samples(start_seconds)) / self.music_looper.mlaudio.rate
-            total_time = end_seconds - start_seconds
+            current_time = (frame - start_samples) / self.music_looper.mlaudio.rate
+            total_time = (end_samples - start_samples) / self.music_looper.mlaudio.rate
             
             if current_time >= 0:
                 # 使用 blockSignals 避免重複觸發事件
@@ -572,7 +550,7 @@ class MainWindow(QMainWindow):
             self.show_error(self.tr["analyze_first"])
             return
                 
-        selected = self.results.selectedItems()
+        selected = self.selected_loop()
         if not selected:
             self.show_error(self.tr["select_loop"])
             return
@@ -581,24 +559,18 @@ class MainWindow(QMainWindow):
             # 開始播放時切換為暫停圖示
             pause_icon = self.style().standardIcon(QStyle.StandardPixmap.SP_MediaPause)
             self.play_btn.setIcon(pause_icon)
-            row = selected[0].row()
+            row, start_samples, end_samples = selected
             # 更新視窗標題顯示當前播放的音樂ID
             self.setWindowTitle(f"MusicLooper - PLAY#{row}")
             
-            start_seconds = float(self.results.item(row, 0).text())
-            end_seconds = float(self.results.item(row, 1).text())
-            
             try:
-                start_samples = self.music_looper.seconds_to_samples(start_seconds)
-                end_samples = self.music_looper.seconds_to_samples(end_seconds)
-                
                 # 播放音訊並設定初始音量
                 volume = self.volume_slider.value() / 100.0
                 self.playback_handler.set_volume(volume)
                 
                 # 設置初始時間標籤
                 self.current_time_label.setText("00:00")
-                duration = end_seconds - start_seconds
+                duration = (end_samples - start_samples) / self.music_looper.mlaudio.rate
                 self.total_time_label.setText(self.format_time(duration))
                 
                 # 使用新的進度回調
@@ -731,7 +703,7 @@ class MainWindow(QMainWindow):
             self.show_error(self.tr["analyze_first"])
             return
             
-        selected = self.results.selectedItems()
+        selected = self.selected_loop()
         if not selected:
             self.show_error(self.tr["select_loop_export"])
             return
@@ -766,36 +738,30 @@ class MainWindow(QMainWindow):
             progress.setWindowTitle(self.tr["processing"])
             progress.setWindowModality(Qt.WindowModality.WindowModal)
             progress.setMinimumDuration(0)
-            
+            progress.setValue(0)
+
             # 取得選擇的迴圈點
-            row = selected[0].row()
-            start_seconds = float(self.results.item(row, 0).text())
-            end_seconds = float(self.results.item(row, 1).text())
-            
-            start_samples = self.music_looper.seconds_to_samples(start_seconds)
-            end_samples = self.music_looper.seconds_to_samples(end_seconds)
-            
-            # 更新進度
-            progress.setValue(30)
-            QApplication.processEvents()
-            
-            # 導出音樂
-            try:
-                self.music_looper.export(
-                    start_samples,
-                    end_samples,
-                    format=format,
-                    output_dir=output_dir
-                )
-                
+            _, start_samples, end_samples = selected
+
+            # 在背景執行緒導出音樂，避免介面凍結
+            def on_finished(paths):
                 progress.setValue(100)
+                progress.close()
                 # 使用翻譯後的訊息格式
-                success_msg = self.tr["export_success"].format(output_dir)
-                self.show_success(success_msg)
-                
-            except Exception as e:
-                self.show_error(self.tr["export_failed"].format(str(e)))
-                
+                self.show_success(self.tr["export_success"].format(output_dir))
+
+            def on_failed(message):
+                progress.close()
+                self.show_error(self.tr["export_failed"].format(message))
+
+            self.export_worker = ExportWorker(
+                self.music_looper, start_samples, end_samples, [format], output_dir, self
+            )
+            self.export_worker.progress.connect(progress.setValue)
+            self.export_worker.exported.connect(on_finished)
+            self.export_worker.failed.connect(on_failed)
+            self.export_worker.start()
+
         except Exception as e:
             self.show_error(str(e))
 
@@ -814,27 +780,24 @@ class MainWindow(QMainWindow):
             
         super().closeEvent(event)
 
-    def on_selection_changed(self):
+    def on_selection_changed(self, selected=None, deselected=None):
         """處理表格選擇變更"""
         # 如果正在播放,則停止播放
         if self.playback_handler and self.playback_handler.is_playing:
             self.stop_playback()
         
         # 取得選擇項目
-        selected = self.results.selectedItems()
+        selected = self.selected_loop()
         if selected:
             # 取得起始時間
-            row = selected[0].row()
+            row, start_samples, end_samples = selected
             
             # 取得該行的垂直標題(score排序後的編號)
-            score_rank = self.results.verticalHeaderItem(row).text()
-            
-            start_seconds = float(self.results.item(row, 0).text())
-            end_seconds = float(self.results.item(row, 1).text())
+            score_rank = self.results_model.score_rank(row)
             
             # 更新時間標籤
             self.current_time_label.setText("00:00")
-            duration = end_seconds - start_seconds
+            duration = (end_samples - start_samples) / self.music_looper.mlaudio.rate
             self.total_time_label.setText(self.format_time(duration))
             
             # 重置時間滑動條位置為起點
@@ -842,9 +805,6 @@ class MainWindow(QMainWindow):
             
             # 自動從起點開始播放
             try:
-                start_samples = self.music_looper.seconds_to_samples(start_seconds)
-                end_samples = self.music_looper.seconds_to_samples(end_seconds)
-                
                 # 設定音量並播放
                 volume = self.volume_slider.value() / 100.0
                 self.playback_handler.set_volume(volume)
@@ -875,32 +835,164 @@ class MainWindow(QMainWindow):
     def show_success(self, message: str):
         QMessageBox.information(self, self.tr["success"], message)
 
-    def update_row_numbers(self, logical_index=None, order=None):
-        """更新表格的行號，永遠使用分數決定編號"""
-        # 根據分數重新編號
-        items = []
-        for row in range(self.results.rowCount()):
-            score = float(self.results.item(row, 3).text().rstrip('%'))
-            items.append((row, score))
-        
-        # 根據分數排序
-        items.sort(key=lambda x: x[1], reverse=True)
-        
-        # 更新行號
-        for rank, (row, _) in enumerate(items):
-            self.results.setVerticalHeaderItem(row, QTableWidgetItem(str(rank)))
+class ExportWorker(QThread):
+    """在背景執行緒匯出音訊（各檔案由 MusicLooper.export_all 並行編碼），並回報整體進度"""
+    progress = pyqtSignal(int)
+    exported = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, music_looper, loop_start, loop_end, formats, output_dir, parent=None):
+        super().__init__(parent)
+        self.music_looper = music_looper
+        self.loop_start = loop_start
+        self.loop_end = loop_end
+        self.formats = formats
+        self.output_dir = output_dir
+
+    def run(self):
+        written = {}
+        totals = {}
+
+        # 由匯出執行緒池呼叫，signal 會自動排入介面執行緒
+        def on_progress(path, n_written, total):
+            written[path] = n_written
+            totals[path] = total
+            self.progress.emit(int(99 * sum(written.values()) / max(1, sum(totals.values()))))
 
-# 新增自定義的 TableWidgetItem 類來處理數值排序
-class NumericTableItem(QTableWidgetItem):
-    def __lt__(self, other):
         try:
-            # 移除百分比符號並轉換為浮點數
-            self_value = float(self.text().rstrip('%'))
-            other_value = float(other.text().rstrip('%'))
-            # 反轉比較結果
-            return self_value > other_value  # 改為 > 符號
-        except ValueError:
-            return super().__lt__(other)
+            paths = self.music_looper.export_all(
+                self.loop_start,
+                self.loop_end,
+                formats=self.formats,
+                output_dir=self.output_dir,
+                progress_callback=on_progress,
+            )
+            self.exported.emit(paths)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class LoopTableModel(QAbstractTableModel):
+    """以 numpy 陣列保存所有候選迴圈點的表格模型
+
+    分數的重新加權為向量化的內積、排序使用 argsort，
+    顯示文字只在檢視要求時（可見的列）才產生。
+    """
+
+    # 各分數欄位，順序與 reweight 的權重向量一致
+    SCORE_COMPONENTS = ('original', 'structure', 'chord', 'mfcc')
+
+    def __init__(self, columns, parent=None):
+        super().__init__(parent)
+        self.columns = columns
+        self.loops = []
+        self.rate = 1
+        self.loop_starts = np.zeros(0, dtype=np.int64)
+        self.loop_ends = np.zeros(0, dtype=np.int64)
+        self.components = np.zeros((0, len(self.SCORE_COMPONENTS)))
+        self.scores = np.zeros(0)
+        # order[row] = 顯示在第 row 列的候選索引；ranks[i] = 候選 i 的分數名次
+        self.order = np.zeros(0, dtype=np.int64)
+        self.ranks = np.zeros(0, dtype=np.int64)
+        self.sort_column = None
+        self.sort_order = Qt.SortOrder.AscendingOrder
+
+    def set_loops(self, loops, rate):
+        """載入候選迴圈點（LoopPair 列表）"""
+        self.beginResetModel()
+        self.loops = loops
+        self.rate = rate
+        self.loop_starts = np.array([loop.loop_start for loop in loops], dtype=np.int64)
+        self.loop_ends = np.array([loop.loop_end for loop in loops], dtype=np.int64)
+        self.components = np.array(
+            [[getattr(loop, f'{key}_score', 0) for key in self.SCORE_COMPONENTS] for loop in loops],
+            dtype=np.float64,
+        ).reshape(len(loops), len(self.SCORE_COMPONENTS))
+        self.scores = self.components[:, 0].copy()
+        self.ranks = np.arange(len(loops), dtype=np.int64)
+        self.order = np.arange(len(loops), dtype=np.int64)
+        self.sort_column = None
+        self.endResetModel()
+
+    def reweight(self, score_weights):
+        """以新的權重重新計算分數，並依分數重新排序"""
+        weights = np.array([score_weights.get(key, 0.0) for key in self.SCORE_COMPONENTS])
+        self.scores = self.components @ weights
+        for loop, score in zip(self.loops, self.scores.tolist()):
+            loop.score = score
+        by_score = np.argsort(-self.scores, kind='stable')
+        self.ranks = np.empty_like(by_score)
+        self.ranks[by_score] = np.arange(by_score.size)
+        self._set_order(by_score)
+        self.sort_column = None
+
+    def loop_points(self, row):
+        """回傳第 row 列的 (loop_start, loop_end)，以樣本為單位"""
+        idx = self.order[row]
+        return int(self.loop_starts[idx]), int(self.loop_ends[idx])
+
+    def score_rank(self, row):
+        """回傳第 row 列依分數排序的名次"""
+        return int(self.ranks[self.order[row]])
+
+    def _column_values(self, column):
+        if column == 0:
+            return self.loop_starts
+        if column == 1:
+            return self.loop_ends
+        if column == 2:
+            return self.loop_ends - self.loop_starts
+        return self.scores
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.order.size
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != Qt.ItemDataRole.DisplayRole:
+            return None
+        idx = self.order[index.row()]
+        column = index.column()
+        if column == 3:
+            return f"{self.scores[idx]:.2%}"
+        return f"{self._column_values(column)[idx] / self.rate:.2f}"
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal:
+            return self.columns[section] if section < len(self.columns) else None
+        # 永遠使用分數決定編號
+        return str(self.score_rank(section)) if section < self.order.size else None
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        if self.order.size == 0:
+            return
+        if column < 0:
+            # 沒有排序欄位時依分數名次排列
+            new_order = np.argsort(self.ranks, kind='stable')
+        else:
+            # 沿用原本表格的反向比較：遞增排序時大的值在前
+            values = self._column_values(column)
+            new_order = np.argsort(-values if order == Qt.SortOrder.AscendingOrder else values, kind='stable')
+        self._set_order(new_order)
+        self.sort_column = column if column >= 0 else None
+        self.sort_order = order
+
+    def _set_order(self, new_order):
+        """更新列的排列，並讓選擇等持久索引跟著候選移動"""
+        self.layoutAboutToBeChanged.emit()
+        old_indexes = self.persistentIndexList()
+        candidates = [self.order[index.row()] for index in old_indexes]
+        self.order = new_order
+        rows = np.empty_like(new_order)
+        rows[new_order] = np.arange(new_order.size)
+        self.changePersistentIndexList(
+            old_indexes,
+            [self.index(int(rows[idx]), index.column()) for idx, index in zip(candidates, old_indexes)],
+        )
+        self.layoutChanged.emit()
 
 def main():
     try:
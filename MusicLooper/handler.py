@@ -1,16 +1,19 @@
+import copy
 import logging
 import os
 import sys
-from typing import List, Optional, Tuple, Literal
+from typing import IO, List, Literal, Optional, Sequence, Tuple, Union
 
 from rich.progress import MofNCompleteColumn, Progress, SpinnerColumn, TimeElapsedColumn
 from rich.table import Table
 
-from analysis import LoopPair 
+from analysis import STRUCTURE_SEGMENTS, LoopPair, LoopPairList, set_analysis_threads
 from console import rich_console
 from core import MusicLooper
 from exceptions import AudioLoadError, LoopNotFoundError
+from export import tag_files
 from memory_utils import MemoryAnalyzer
+from results import COLUMNAR_FORMATS, CandidateTable, results_filename, write_ndjson
 
 
 class LoopHandler:
@@ -24,6 +27,17 @@ class LoopHandler:
         approx_loop_position: Optional[tuple] = None,
         brute_force: bool = False,
         disable_pruning: bool = False,
+        crossfade_length: float = 0,
+        analysis_profile: Optional[str] = None,
+        verify_precision: int = 0,
+        bpm: Optional[float] = None,
+        beat_grid: Optional[Sequence[float]] = None,
+        structure_segments: int = STRUCTURE_SEGMENTS,
+        beat_sync: bool = False,
+        repetition_lags: int = 0,
+        duplicate_tolerance: float = 0,
+        threads: Optional[int] = None,
+        musiclooper: Optional[MusicLooper] = None,
         **kwargs,
     ):
         if approx_loop_position is not None:
@@ -33,8 +47,27 @@ class LoopHandler:
             self.approx_loop_start = None
             self.approx_loop_end = None
 
-        self._musiclooper = MusicLooper(filepath=path)
+        # An already loaded track (e.g. cached by the analysis server) can be reused
+        self._musiclooper = (
+            musiclooper
+            if musiclooper is not None
+            else MusicLooper(filepath=path, analysis_profile=analysis_profile)
+        )
         self.gui_min_duration_multiplier = min_duration_multiplier # 儲存來自GUI的設定
+        self.crossfade_length = crossfade_length
+        # Known tempo / beat positions (in seconds) of the track, which skip the beat tracking
+        self.bpm = bpm
+        self.beat_grid = beat_grid
+        self.structure_segments = structure_segments
+        # Search/score the candidates on beat-synchronous features instead of every frame
+        self.beat_sync = beat_sync
+        # Only search the loop lengths near the dominant repetition lags of the track (0 searches all of them)
+        self.repetition_lags = repetition_lags
+        # Grid size (in seconds) of the suppression of near-duplicate candidates before scoring (0 keeps all of them)
+        self.duplicate_tolerance = duplicate_tolerance
+
+        # Threads of the parallel analysis kernels (all available threads by default)
+        set_analysis_threads(threads)
 
         logging.info(f"Loaded \"{path}\". Analyzing...")
 
@@ -46,6 +79,15 @@ class LoopHandler:
             approx_loop_end=self.approx_loop_end,
             brute_force=brute_force,
             disable_pruning=disable_pruning,
+            # Only the chosen loop pair is needed unless more are displayed/exported, which finalize them on demand
+            top_k=1,
+            verify_precision=verify_precision,
+            bpm=bpm,
+            beat_times=beat_grid,
+            n_segments=structure_segments,
+            beat_sync=beat_sync,
+            repetition_lags=repetition_lags,
+            duplicate_tolerance=duplicate_tolerance,
         )
         # 檢查是否需要啟用特殊分析模式
         if isinstance(loop_pairs_result, list) and len(loop_pairs_result) == 1:
@@ -70,6 +112,11 @@ class LoopHandler:
         """
         return self.loop_pair_list
 
+    def finalize_loop_pairs(self, count: Optional[int] = None):
+        """Computes the deferred scores and refined loop points of the first `count` loop pairs (all of them if None)."""
+        if isinstance(self.loop_pair_list, LoopPairList):
+            self.loop_pair_list.finalize(count)
+
     @property
     def musiclooper(self) -> MusicLooper:
         """Returns the handler's `MusicLooper` instance."""
@@ -79,18 +126,20 @@ class LoopHandler:
         return samples if in_samples else self.musiclooper.samples_to_ftime(samples)
 
     def play_looping(self, loop_start: int, loop_end: int):
-        self.musiclooper.play_looping(loop_start, loop_end)
+        self.musiclooper.play_looping(loop_start, loop_end, crossfade_length=self.crossfade_length)
 
     def choose_loop_pair(self, interactive_mode=False):
         index = 0
         if self.loop_pair_list and interactive_mode:
             index = self.interactive_handler()
 
+        self.finalize_loop_pairs(index + 1)
         return self.loop_pair_list[index]
 
     def interactive_handler(self, show_top=25):
         preview_looper = self.musiclooper
         total_candidates = len(self.loop_pair_list)
+        self.finalize_loop_pairs(show_top)
         more_prompt_message = "\nEnter 'more' to display additional loop points, 'all' to display all of them, or 'reset' to display the default amount." if show_top < total_candidates else ""
         rich_console.print()
         table = Table(title=f"Discovered loop points ({min(show_top, total_candidates)}/{total_candidates} displayed)", caption=more_prompt_message)
@@ -157,13 +206,14 @@ class LoopHandler:
                     raise IndexError
 
                 if preview:
+                    self.finalize_loop_pairs(idx + 1)
                     rich_console.print(f"Previewing loop [cyan]#{idx}[/] | (Press [red]Ctrl+C[/] to stop looping):")
                     loop_start = self.loop_pair_list[idx].loop_start
                     loop_end = self.loop_pair_list[idx].loop_end
                     # start preview 5 seconds before the looping point
                     offset = preview_looper.seconds_to_samples(5)
                     preview_offset = loop_end - offset if loop_end - offset > 0 else 0
-                    preview_looper.play_looping(loop_start, loop_end, start_from=preview_offset)
+                    preview_looper.play_looping(loop_start, loop_end, start_from=preview_offset, crossfade_length=self.crossfade_length)
                     return get_user_input()
                 else:
                     return idx
@@ -215,10 +265,11 @@ class LoopHandler:
             logging.info("[系統] 智能模式：由於參數設置，跳過降採樣直接進行 original_score_only 分析...")
             return self.original_score_only_analysis(mlaudio)
         
-        downsampled_audio_data = librosa.resample(mlaudio.audio, orig_sr=mlaudio.rate, target_sr=mlaudio.rate // downsample_factor)
-        global_mlaudio = type(mlaudio)(mlaudio.filepath)
+        downsampled_audio_data = librosa.resample(mlaudio.audio, orig_sr=mlaudio.analysis_rate, target_sr=mlaudio.analysis_rate // downsample_factor)
+        # 低解析度分析只改變分析取樣率，播放音訊與原生取樣率不變
+        global_mlaudio = copy.copy(mlaudio)
         global_mlaudio.audio = downsampled_audio_data
-        global_mlaudio.rate = mlaudio.rate // downsample_factor
+        global_mlaudio.analysis_rate = mlaudio.analysis_rate // downsample_factor
         global_mlaudio.total_duration = mlaudio.total_duration / downsample_factor
         if mlaudio.audio.ndim == 1:
             global_mlaudio.n_channels = 1
@@ -242,6 +293,12 @@ class LoopHandler:
             raw_global_pairs = find_best_loop_points(
                 global_mlaudio,
                 min_duration_multiplier=effective_multiplier_for_global,
+                bpm=self.bpm,
+                beat_times=self.beat_grid,
+                n_segments=self.structure_segments,
+                beat_sync=self.beat_sync,
+                repetition_lags=self.repetition_lags,
+                duplicate_tolerance=self.duplicate_tolerance,
             )
             logging.info(f"[系統] 智能模式：find_best_loop_points (全局低解析度) 返回了 {len(raw_global_pairs)} 個原始候選點。")
             
@@ -292,7 +349,8 @@ class LoopHandler:
         import logging
         logging.info("[系統] 啟動只計算 original_score 的分析...")
         
-        chroma, power_db, bpm, beats = _analyze_audio(mlaudio)
+        features = _analyze_audio(mlaudio, bpm=self.bpm, beat_times=self.beat_grid)
+        chroma, power_db, beats = features.chroma, features.power_db, features.beats
         
         # 使用 self.gui_min_duration_multiplier
         min_loop_duration_frames = int(self.gui_min_duration_multiplier * chroma.shape[-1])
@@ -360,17 +418,33 @@ class LoopExportHandler(LoopHandler):
         brute_force: bool = False,
         disable_pruning: bool = False,
         split_audio: bool = False,
-        format: Literal["WAV", "FLAC", "OGG", "MP3"] = "WAV",
+        single_file: bool = False,
+        format: Union[str, Sequence[str]] = "WAV",
         to_txt: bool = False,
         to_stdout: bool = False,
+        results_format: Optional[str] = None,
+        candidate_table: Optional[CandidateTable] = None,
+        ndjson_file: Optional[IO[str]] = None,
         fmt: Literal["SAMPLES", "SECONDS", "TIME"] = "SAMPLES",
         alt_export_top: int = 0,
         tag_names: Optional[Tuple[str, str]] = None,
         tag_offset: Optional[bool] = None,
+        in_place: bool = False,
+        tag_jobs: Optional[list] = None,
         batch_mode: bool = False,
         extended_length: float = 0,
         fade_length: float = 0,
         disable_fade_out: bool = False,
+        crossfade_length: float = 0,
+        analysis_profile: Optional[str] = None,
+        verify_precision: int = 0,
+        bpm: Optional[float] = None,
+        beat_grid: Optional[Sequence[float]] = None,
+        structure_segments: int = STRUCTURE_SEGMENTS,
+        beat_sync: bool = False,
+        repetition_lags: int = 0,
+        duplicate_tolerance: float = 0,
+        threads: Optional[int] = None,
         **kwargs,
     ):
         # LoopExportHandler 的 super().__init__ 會將 min_duration_multiplier 傳給 LoopHandler.__init__
@@ -383,16 +457,36 @@ class LoopExportHandler(LoopHandler):
             approx_loop_position=approx_loop_position,
             brute_force=brute_force,
             disable_pruning=disable_pruning,
+            crossfade_length=crossfade_length,
+            analysis_profile=analysis_profile,
+            verify_precision=verify_precision,
+            bpm=bpm,
+            beat_grid=beat_grid,
+            structure_segments=structure_segments,
+            beat_sync=beat_sync,
+            repetition_lags=repetition_lags,
+            duplicate_tolerance=duplicate_tolerance,
+            threads=threads,
         )
         self.output_directory = output_dir
         self.split_audio = split_audio
-        self.format = format
+        self.single_file = single_file
+        # One or more of "WAV", "FLAC", "OGG", "MP3"; all formats are encoded concurrently
+        self.formats = (format,) if isinstance(format, str) else tuple(format)
         self.to_txt = to_txt
         self.to_stdout = to_stdout
+        # "NDJSON" (streamed to stdout) or one of `COLUMNAR_FORMATS`; exports all candidates with their scores
+        self.results_format = results_format.upper() if results_format is not None else None
+        # If provided (by BatchHandler), candidates are collected here and written to a single file later
+        self.candidate_table = candidate_table
+        self.ndjson_file = ndjson_file
         self.fmt = fmt.lower()
         self.alt_export_top = alt_export_top
         self.tag_names = tag_names
         self.tag_offset = tag_offset
+        self.in_place = in_place
+        # If provided (by BatchHandler), loop points to tag are collected here and written in bulk later
+        self.tag_jobs = tag_jobs
         self.batch_mode = batch_mode
         self.extended_length = extended_length
         self.disable_fade_out = disable_fade_out
@@ -412,7 +506,10 @@ class LoopExportHandler(LoopHandler):
         if self.to_stdout:
             self.stdout_export_runner(loop_start, loop_end)
 
-        if not os.path.exists(self.output_directory) and (self.tag_names or self.to_txt or self.split_audio or self.extended_length):
+        if self.results_format == "NDJSON":
+            self.results_export_runner()
+
+        if not os.path.exists(self.output_directory) and (self.tag_names or self.to_txt or self.split_audio or self.extended_length or self.results_format in COLUMNAR_FORMATS):
             try:
                 os.makedirs(self.output_directory, exist_ok=True)
             except OSError as e:
@@ -425,6 +522,9 @@ class LoopExportHandler(LoopHandler):
         if self.to_txt:
             self.txt_export_runner(loop_start, loop_end)
 
+        if self.results_format in COLUMNAR_FORMATS:
+            self.results_export_runner()
+
         if self.split_audio:
             self.split_audio_runner(loop_start, loop_end)
 
@@ -433,13 +533,16 @@ class LoopExportHandler(LoopHandler):
 
     def split_audio_runner(self, loop_start: int, loop_end: int):
         try:
-            self.musiclooper.export(
+            self.musiclooper.export_all(
                 loop_start,
                 loop_end,
-                format=self.format,
-                output_dir=self.output_directory
+                formats=self.formats,
+                single_file=self.single_file,
+                output_dir=self.output_directory,
+                crossfade_length=self.crossfade_length,
             )
-            message = f"Successfully exported \"{self.musiclooper.filename}\" intro/loop/outro sections to \"{self.output_directory}\""
+            sections = "track with embedded loop points" if self.single_file else "intro/loop/outro sections"
+            message = f"Successfully exported \"{self.musiclooper.filename}\" {sections} ({', '.join(self.formats)}) to \"{self.output_directory}\""
             if self.batch_mode:
                 logging.info(message)
             else:
@@ -459,19 +562,27 @@ class LoopExportHandler(LoopHandler):
                 console=rich_console,
                 transient=True,
             )
-            progress.add_task(f"Exporting an extended version of {self.musiclooper.filename}...", total=None)
+            # One progress bar per exported file, updated from the export worker threads
+            tasks = {}
+            def update_progress(path, n_written, total):
+                if path not in tasks:
+                    tasks[path] = progress.add_task(f"Exporting {os.path.basename(path)}...", total=total)
+                progress.update(tasks[path], completed=n_written)
             progress.start()
         try:
-            output_path = self.musiclooper.extend(
+            output_paths = self.musiclooper.export_all(
                 loop_start,
                 loop_end,
-                format=self.format,
+                formats=self.formats,
+                split=False,
                 output_dir=self.output_directory,
                 extended_length=self.extended_length,
                 disable_fade_out=self.disable_fade_out,
                 fade_length=self.fade_length,
+                crossfade_length=self.crossfade_length,
+                progress_callback=None if self.batch_mode else update_progress,
             )
-            message = f'Successfully exported an extended version of "{self.musiclooper.filename}" to "{output_path}"'
+            message = f'Successfully exported an extended version of "{self.musiclooper.filename}" to ' + ", ".join(f'"{path}"' for path in output_paths)
             if self.batch_mode:
                 logging.info(message)
             else:
@@ -512,6 +623,7 @@ class LoopExportHandler(LoopHandler):
             )
 
     def alt_export_runner(self, mode: Literal["STDOUT", "TXT"]):
+        self.finalize_loop_pairs(None if self.alt_export_top < 0 else self.alt_export_top)
         pair_list_slice = (
             self.loop_pair_list
             if self.alt_export_top < 0
@@ -537,7 +649,39 @@ class LoopExportHandler(LoopHandler):
                 logging.error(f"写入备选循环点到 TXT 文件 {out_path} 失败: {e}")
 
 
-    def tag_runner(self, loop_start: int, loop_end: int):        
+    def results_export_runner(self):
+        # --alt-export-top N limits the export to the top N candidates
+        count = self.alt_export_top if self.alt_export_top > 0 else None
+        self.finalize_loop_pairs(count)
+        loop_pairs = self.loop_pair_list[:count]
+        samplerate = self.musiclooper.samplerate
+
+        if self.results_format == "NDJSON":
+            write_ndjson(self.ndjson_file or sys.stdout, self.musiclooper.filepath, loop_pairs, samplerate)
+        elif self.candidate_table is not None:
+            self.candidate_table.add(self.musiclooper.filepath, loop_pairs, samplerate)
+        else:
+            table = CandidateTable()
+            table.add(self.musiclooper.filepath, loop_pairs, samplerate)
+            out_path = os.path.join(
+                self.output_directory, results_filename(f"{self.musiclooper.filename}.candidates", self.results_format)
+            )
+            try:
+                table.write(out_path, self.results_format)
+            except (ImportError, OSError) as e:
+                logging.error(f"寫入迴圈點候選結果 \"{out_path}\" 失敗: {e}")
+                return
+            message = f'Successfully exported {len(loop_pairs)} loop point candidates of "{self.musiclooper.filename}" to "{out_path}"'
+            if self.batch_mode:
+                logging.info(message)
+            else:
+                rich_console.print(message)
+
+    def tag_runner(self, loop_start: int, loop_end: int):
+        if self.tag_jobs is not None:
+            self.tag_jobs.append(((self.musiclooper.filepath, loop_start, loop_end), self.output_directory))
+            return
+
         loop_start_tag, loop_end_tag = self.tag_names
         try:
             tagged_file_path, actual_loop_start, actual_loop_end = self.musiclooper.export_tags( #接收回傳值
@@ -547,8 +691,10 @@ class LoopExportHandler(LoopHandler):
                 loop_end_tag,
                 is_offset=self.tag_offset,
                 output_dir=self.output_directory,
+                in_place=self.in_place,
             )
-            message = f"Exported {loop_start_tag}: {self._fmt(actual_loop_start)} and {loop_end_tag}: {self._fmt(actual_loop_end)} of \"{self.musiclooper.filename}\" to a copy in \"{tagged_file_path}\"" # 使用回傳的檔名和時間
+            destination = "in place" if self.in_place else f"to a copy in \"{tagged_file_path}\""
+            message = f"Exported {loop_start_tag}: {self._fmt(int(actual_loop_start))} and {loop_end_tag}: {self._fmt(int(actual_loop_end))} of \"{self.musiclooper.filename}\" {destination}" # 使用回傳的檔名和時間
             if self.batch_mode:
                 logging.info(message)
             else:
@@ -606,6 +752,11 @@ class BatchHandler:
             console=rich_console,
         ) as progress:
             pbar = progress.add_task("Processing...", total=len(files))
+            # Tags are written in bulk once all files are analyzed
+            tag_jobs = [] if self.kwargs.get("tag_names") is not None else None
+            # Columnar results of all files are written to a single file once all files are analyzed
+            results_format = (self.kwargs.get("results_format") or "").upper()
+            candidate_table = CandidateTable() if results_format in COLUMNAR_FORMATS else None
             for file_idx, file_path in enumerate(files):
                 progress.update(
                     pbar,
@@ -618,10 +769,47 @@ class BatchHandler:
                 task_kwargs = {
                     **self.kwargs, 
                     "path": file_path,
-                    "output_dir": self.output_directory if self.flatten else output_dirs[file_idx]
+                    "output_dir": self.output_directory if self.flatten else output_dirs[file_idx],
+                    "tag_jobs": tag_jobs,
+                    "candidate_table": candidate_table,
                 }
                 self._batch_export_helper(**task_kwargs)
 
+            if tag_jobs:
+                self._bulk_tag(tag_jobs, progress)
+
+        if candidate_table is not None:
+            self._write_candidate_table(candidate_table, results_format)
+
+    def _write_candidate_table(self, candidate_table: CandidateTable, results_format: str):
+        os.makedirs(self.output_directory, exist_ok=True)
+        out_path = os.path.join(self.output_directory, results_filename("candidates", results_format))
+        try:
+            candidate_table.write(out_path, results_format)
+        except (ImportError, OSError) as e:
+            logging.error(f"寫入迴圈點候選結果 \"{out_path}\" 失敗: {e}")
+            return
+        rich_console.print(
+            f'Successfully exported {len(candidate_table)} loop point candidates of {len(candidate_table.tracks)} files to "{out_path}"'
+        )
+
+    def _bulk_tag(self, tag_jobs: list, progress: Progress):
+        loop_start_tag, loop_end_tag = self.kwargs["tag_names"]
+        in_place = self.kwargs.get("in_place", False)
+        pbar = progress.add_task("Tagging...", total=len(tag_jobs))
+        results = tag_files(
+            [job for job, _ in tag_jobs],
+            loop_start_tag,
+            loop_end_tag,
+            is_offset=self.kwargs.get("tag_offset"),
+            in_place=in_place,
+            output_dirs=[output_dir for _, output_dir in tag_jobs],
+            progress_callback=lambda path: progress.update(pbar, advance=1),
+        )
+        n_tagged = sum(result is not None for result in results)
+        destination = "in place" if in_place else "to tagged copies"
+        logging.info(f"Tagged {n_tagged}/{len(tag_jobs)} files {destination}.")
+
     @staticmethod
     def clone_file_tree_structure(in_files: List[str], output_directory: str) -> List[str]:
         if not in_files: #處理in_files為空列表的情況
@@ -20,27 +20,38 @@ class MemoryAnalyzer:
         with open(lang_path, 'r', encoding='utf-8') as f:
             return json.load(f)
 
-    def estimate_memory_requirement(self, audio_length_sec: float, sample_rate: int, n_channels: int = 1, dtype_bytes: int = 4) -> dict:
+    def estimate_memory_requirement(
+        self,
+        audio_length_sec: float,
+        sample_rate: int,
+        n_channels: int = 1,
+        dtype_bytes: int = 4,
+        analysis_rate: int = None,
+        hop_length: int = 512,
+    ) -> dict:
         """更精確估算音樂分析所需的記憶體 (MB)
         Args:
             audio_length_sec (float): 音樂長度（秒）
             sample_rate (int): 採樣率
             n_channels (int): 聲道數
             dtype_bytes (int): 單一樣本的位元組數，float32為4
+            analysis_rate (int, optional): 分析取樣率（見 AnalysisProfile），預設與 sample_rate 相同
+            hop_length (int, optional): 分析幀的間距（分析樣本數）
         Returns:
             dict: 包含記憶體需求的詳細資訊
         """
         # 參數
-        hop_length = 512
+        if analysis_rate is None:
+            analysis_rate = sample_rate
         n_mels = 128
         n_chroma = 12
         n_mfcc = 13
-        # 預設float32
-        dtype_bytes = 4
         # frame數
-        n_frames = int(audio_length_sec * sample_rate / hop_length)
-        # 原始音訊
+        n_frames = int(audio_length_sec * analysis_rate / hop_length)
+        # 原始音訊（播放用）與單聲道分析音訊
         audio_samples = int(audio_length_sec * sample_rate * n_channels)
+        if analysis_rate != sample_rate:
+            audio_samples += int(audio_length_sec * analysis_rate)
         audio_memory = audio_samples * dtype_bytes
         # 梅爾頻譜圖
         mel_memory = n_mels * n_frames * dtype_bytes
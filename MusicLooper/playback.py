@@ -1,7 +1,65 @@
 import logging
+from dataclasses import dataclass
+from typing import Optional
+
 import numpy as np
 import sounddevice as sd
 
+
+@dataclass
+class LoopSeam:
+    """Precomputed crossfade for the loop_end -> loop_start transition.
+
+    `audio` replaces the last `length` samples before `loop_end`: it fades the loop end out
+    while fading in the audio that leads into `loop_start`, so jumping back to `loop_start`
+    right after it continues the faded-in signal without a discontinuity.
+    """
+
+    loop_start: int
+    loop_end: int
+    audio: np.ndarray
+
+    @property
+    def length(self) -> int:
+        return self.audio.shape[0]
+
+    @property
+    def start(self) -> int:
+        """Index (in samples) of the playback audio where the seam takes over."""
+        return self.loop_end - self.length
+
+    def matches(self, loop_start: int, loop_end: int, length: int) -> bool:
+        return (self.loop_start, self.loop_end, self.length) == (loop_start, loop_end, length)
+
+    def loop_sections(self, playback_audio: np.ndarray):
+        """Returns the (body, seam) views that make up one seamless pass through the loop."""
+        return playback_audio[self.loop_start:self.start], self.audio
+
+
+def compute_loop_seam(
+    playback_audio: np.ndarray,
+    loop_start: int,
+    loop_end: int,
+    crossfade_length: int,
+) -> LoopSeam:
+    """Precomputes the crossfaded seam of a loop selection.
+
+    Args:
+        playback_audio (np.ndarray): The playback audio in the shape `(samples, n_channels)`
+        loop_start (int): Loop start in samples
+        loop_end (int): Loop end in samples
+        crossfade_length (int): Crossfade length in samples. Clipped to the loop length and to the audio available before `loop_start`.
+
+    Returns:
+        LoopSeam: the precomputed seam
+    """
+    n_samples = int(max(0, min(crossfade_length, loop_start, loop_end - loop_start)))
+    fade_in = np.linspace(0, 1, n_samples, dtype=playback_audio.dtype)[:, np.newaxis]
+    seam = playback_audio[loop_end - n_samples:loop_end] * (1 - fade_in)
+    seam += playback_audio[loop_start - n_samples:loop_start] * fade_in
+    return LoopSeam(loop_start=loop_start, loop_end=loop_end, audio=seam)
+
+
 class PlaybackHandler:
     def __init__(self) -> None:
         self.stream = None
@@ -10,6 +68,7 @@ class PlaybackHandler:
         self.loop_counter = 0
         self.current_frame = 0
         self.volume = 0.1  # 預設音量為 10%
+        self.seam = None
 
     def set_volume(self, volume: float):
         """設定音量 (0.0 - 1.0)"""
@@ -23,48 +82,45 @@ class PlaybackHandler:
         loop_start: int,
         loop_end: int,
         start_from=0,
-        progress_callback=None
+        progress_callback=None,
+        seam: Optional[LoopSeam] = None,
     ) -> None:
+        """Starts looping playback of `playback_data` between `loop_start` and `loop_end` (in samples).
+
+        If a `seam` precomputed for the same loop points is provided, it is played in place of the
+        audio right before `loop_end`, crossfading into `loop_start`. The seam is only copied into the
+        output buffer, so the per-block cost does not depend on the crossfade length.
+        """
         self.playback_data = playback_data
-        self.loop_start = loop_start 
+        self.loop_start = loop_start
         self.loop_end = loop_end
         self.current_frame = start_from
         self.is_playing = True
         self.loop_counter = 0
+        self.seam = seam if seam is not None and seam.length > 0 else None
 
         def callback(outdata, frames, time, status):
             if status:
                 logging.error(status)
-            
+
             if self.is_paused:
                 outdata.fill(0)
                 return
-            
-            chunksize = min(len(self.playback_data) - self.current_frame, frames)
-
-            if self.is_playing and self.current_frame + frames > self.loop_end:
-                pre_loop_index = self.loop_end - self.current_frame
-                remaining_frames = frames - (self.loop_end - self.current_frame)
-                adjusted_next_frame_idx = self.loop_start + remaining_frames
-                
-                # 調整音量
-                outdata[:pre_loop_index] = self.playback_data[self.current_frame:self.loop_end] * self.volume
-                outdata[pre_loop_index:frames] = self.playback_data[self.loop_start:adjusted_next_frame_idx] * self.volume
-                
-                self.current_frame = adjusted_next_frame_idx
-                self.loop_counter += 1
-                if progress_callback:
-                    progress_callback(self.current_frame, self.loop_counter)
-            else:
+
+            filled = 0
+            while filled < frames:
+                chunk = self._next_chunk(frames - filled)
+                if chunk.shape[0] == 0:
+                    break
                 # 調整音量
-                outdata[:chunksize] = self.playback_data[self.current_frame:self.current_frame + chunksize] * self.volume
-                
-                self.current_frame += chunksize
-                if progress_callback:
-                    progress_callback(self.current_frame, self.loop_counter)
-                if chunksize < frames:
-                    outdata[chunksize:] = 0
-                    raise sd.CallbackStop()
+                np.multiply(chunk, self.volume, out=outdata[filled:filled + chunk.shape[0]])
+                filled += chunk.shape[0]
+
+            if progress_callback:
+                progress_callback(self.current_frame, self.loop_counter)
+            if filled < frames:
+                outdata[filled:] = 0
+                raise sd.CallbackStop()
 
         self.stream = sd.OutputStream(
             samplerate=samplerate,
@@ -73,10 +129,31 @@ class PlaybackHandler:
         )
         self.stream.start()
 
+    def _next_chunk(self, max_frames: int) -> np.ndarray:
+        """Returns a view of the next (at most) `max_frames` samples to play and advances the playhead."""
+        position = self.current_frame
+        if not self.is_playing or position >= self.loop_end or self.loop_end <= self.loop_start:
+            chunk = self.playback_data[position:position + max_frames]
+            self.current_frame += chunk.shape[0]
+            return chunk
+
+        if self.seam is not None and position >= self.seam.start:
+            seam_position = position - self.seam.start
+            chunk = self.seam.audio[seam_position:seam_position + max_frames]
+        else:
+            section_end = self.seam.start if self.seam is not None else self.loop_end
+            chunk = self.playback_data[position:min(section_end, position + max_frames)]
+
+        self.current_frame += chunk.shape[0]
+        if self.current_frame >= self.loop_end:
+            self.current_frame = self.loop_start
+            self.loop_counter += 1
+        return chunk
+
     def pause(self):
         self.is_paused = True
-        
-    def resume(self): 
+
+    def resume(self):
         self.is_paused = False
 
     def stop(self):
@@ -86,4 +163,4 @@ class PlaybackHandler:
         self.is_playing = False
         self.is_paused = False
         self.current_frame = 0
-        self.loop_counter = 0
\ No newline at end of file
+        self.loop_counter = 0
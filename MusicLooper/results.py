@@ -0,0 +1,146 @@
+"""Columnar export of the loop pair candidates of one or many tracks.
+
+All the candidates of a run (e.g. a whole batch) are collected in a single table, with one column
+per field, and written once to a single file:
+    NPZ: one numpy array per column (`np.load` reads the columns lazily, one at a time)
+    PARQUET: compressed, with per-column statistics that readers use to filter rows (requires pyarrow)
+    ARROW: Arrow IPC file, which can be memory-mapped without parsing (requires pyarrow)
+Candidates can also be streamed to stdout as NDJSON (one JSON object per line) with `write_ndjson`.
+"""
+
+import json
+import os
+from typing import IO, Dict, List, Sequence
+
+import numpy as np
+
+from analysis import LoopPair
+
+COLUMNAR_FORMATS = ("NPZ", "PARQUET", "ARROW")
+
+_FILE_EXTENSIONS = {"NPZ": "npz", "PARQUET": "parquet", "ARROW": "arrow"}
+
+# (column name, dtype) of the per-candidate columns; "track" indexes the table's track paths
+CANDIDATE_COLUMNS = (
+    ("track", np.int32),
+    ("rank", np.int32),
+    ("loop_start", np.int64),
+    ("loop_end", np.int64),
+    ("loop_start_seconds", np.float64),
+    ("loop_end_seconds", np.float64),
+    ("score", np.float64),
+    ("note_distance", np.float64),
+    ("loudness_difference", np.float64),
+    ("structure_score", np.float64),
+    ("chord_score", np.float64),
+    ("mfcc_score", np.float64),
+    ("original_score", np.float64),
+    ("seam_score", np.float64),
+)
+
+# Columns read directly from the `LoopPair` fields of the same name
+_PAIR_FIELDS = tuple(name for name, _ in CANDIDATE_COLUMNS if name not in ("track", "rank", "loop_start_seconds", "loop_end_seconds"))
+
+
+def results_filename(name: str, format: str) -> str:
+    """Returns the file name of a results table named `name` exported in `format`."""
+    return f"{name}.{_FILE_EXTENSIONS[format.upper()]}"
+
+
+def pair_columns(loop_pairs: Sequence[LoopPair], samplerate: int) -> Dict[str, np.ndarray]:
+    """Returns the columns of `loop_pairs` (in their current order), without the "track" column."""
+    columns = {
+        name: np.fromiter((getattr(pair, name) for pair in loop_pairs), dtype=dtype, count=len(loop_pairs))
+        for name, dtype in CANDIDATE_COLUMNS
+        if name in _PAIR_FIELDS
+    }
+    columns["rank"] = np.arange(len(loop_pairs), dtype=np.int32)
+    columns["loop_start_seconds"] = columns["loop_start"] / samplerate
+    columns["loop_end_seconds"] = columns["loop_end"] / samplerate
+    return {name: columns[name] for name, _ in CANDIDATE_COLUMNS if name in columns}
+
+
+class CandidateTable:
+    """Collects the loop pair candidates of several tracks and writes them to a single columnar file."""
+
+    def __init__(self):
+        self.tracks: List[str] = []
+        self.samplerates: List[int] = []
+        self._chunks: List[Dict[str, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return sum(len(chunk["rank"]) for chunk in self._chunks)
+
+    def add(self, path: str, loop_pairs: Sequence[LoopPair], samplerate: int):
+        """Appends the candidates of the track at `path`, ranked in their current order."""
+        columns = pair_columns(loop_pairs, samplerate)
+        columns["track"] = np.full(len(loop_pairs), len(self.tracks), dtype=np.int32)
+        self.tracks.append(os.path.abspath(path))
+        self.samplerates.append(samplerate)
+        self._chunks.append(columns)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Returns the per-candidate columns of the whole table."""
+        return {
+            name: np.concatenate([chunk[name] for chunk in self._chunks]) if self._chunks else np.empty(0, dtype=dtype)
+            for name, dtype in CANDIDATE_COLUMNS
+        }
+
+    def write(self, path: str, format: str = "NPZ"):
+        """Writes the table to `path`.
+
+        The NPZ file also holds the "tracks" (paths) and "samplerates" arrays, indexed by the "track" column.
+        In the Parquet and Arrow files, the "track" column is dictionary-encoded with the track paths instead,
+        and the sample rates are kept in a "samplerate" column.
+
+        Raises:
+            ValueError: If `format` is not one of `COLUMNAR_FORMATS`.
+            ImportError: If writing Parquet or Arrow files and pyarrow is not installed.
+        """
+        format = format.upper()
+        if format not in COLUMNAR_FORMATS:
+            raise ValueError(f"Unsupported results format \"{format}\". Supported formats: {', '.join(COLUMNAR_FORMATS)}.")
+
+        columns = self.columns()
+        if format == "NPZ":
+            # Uncompressed, so that each column is read from the archive without decompression
+            np.savez(
+                path,
+                tracks=np.array(self.tracks, dtype=str),
+                samplerates=np.array(self.samplerates, dtype=np.int32),
+                **columns,
+            )
+            return
+
+        # Import pyarrow only when needed, as it is an optional dependency
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError(f"Exporting {format} files requires pyarrow (pip install pyarrow).") from e
+
+        track_ids = columns.pop("track")
+        table = pa.table(
+            {
+                "track": pa.DictionaryArray.from_arrays(track_ids, pa.array(self.tracks, type=pa.string())),
+                "samplerate": pa.array(np.array(self.samplerates, dtype=np.int32)[track_ids]),
+                **columns,
+            }
+        )
+        if format == "PARQUET":
+            import pyarrow.parquet as pq
+
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def write_ndjson(file: IO[str], path: str, loop_pairs: Sequence[LoopPair], samplerate: int):
+    """Writes the candidates of the track at `path` to `file` as NDJSON, one candidate per line."""
+    columns = pair_columns(loop_pairs, samplerate)
+    track = {"track": os.path.abspath(path), "samplerate": samplerate}
+    names = list(columns)
+    # tolist() converts the whole columns to Python scalars at once
+    rows = zip(*(columns[name].tolist() for name in names))
+    file.writelines(json.dumps({**track, **dict(zip(names, row))}) + "\n" for row in rows)
+    file.flush()
@@ -0,0 +1,223 @@
+"""Library-wide index of the loop points stored in audio metadata tags.
+
+Only the metadata of the files is read (no audio is decoded), files are scanned
+in parallel worker processes, and the results are kept in a local SQLite database
+so that later refreshes only rescan files whose modification time or size changed.
+"""
+
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from export import read_loop_tags
+
+# Default file name of the index database, created in the indexed directory
+DEFAULT_INDEX_NAME = ".pymusiclooper-tags.sqlite"
+
+# Files handed to a worker process at once; amortizes the inter-process overhead of tiny metadata reads
+SCAN_CHUNK_SIZE = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    loop_start INTEGER,
+    loop_end INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+@dataclass
+class IndexedTrack:
+    path: str
+    loop_start: Optional[int]
+    loop_end: Optional[int]
+    error: Optional[str] = None
+
+    @property
+    def is_tagged(self) -> bool:
+        return self.loop_start is not None
+
+
+@dataclass
+class RefreshStats:
+    scanned: int = 0
+    unchanged: int = 0
+    removed: int = 0
+
+
+def _scan_file(args: Tuple[str, str, str, Optional[bool]]) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """Reads the loop tags of a single file; runs in a worker process."""
+    path, loop_start_tag, loop_end_tag, is_offset = args
+    try:
+        loop_start, loop_end = read_loop_tags(path, loop_start_tag, loop_end_tag, is_offset)
+        return loop_start, loop_end, None
+    except ValueError:
+        # Missing tags: a valid, untagged track
+        return None, None, None
+    except Exception as e:
+        return None, None, str(e) or type(e).__name__
+
+
+class LoopTagIndex:
+    """SQLite-backed index of the loop tags of every file in a directory tree."""
+
+    def __init__(
+        self,
+        db_path: str,
+        loop_start_tag: str = "LOOPSTART",
+        loop_end_tag: str = "LOOPLENGTH",
+        is_offset: Optional[bool] = None,
+    ):
+        """Opens (or creates) the index database.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            loop_start_tag (str, optional): Name of the loop_start metadata tag. Defaults to "LOOPSTART".
+            loop_end_tag (str, optional): Name of the loop_end metadata tag. Defaults to "LOOPLENGTH".
+            is_offset (bool, optional): Parse second tag as relative length / absolute end. Defaults to auto-detecting based on tag name.
+        """
+        self.db_path = os.path.abspath(db_path)
+        self.loop_start_tag = loop_start_tag
+        self.loop_end_tag = loop_end_tag
+        self.is_offset = is_offset
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.executescript(_SCHEMA)
+
+        # Indexed values depend on the tag names, so a different configuration invalidates the whole index
+        tag_config = f"{loop_start_tag}\t{loop_end_tag}\t{is_offset}"
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'tags'").fetchone()
+        if row is None or row[0] != tag_config:
+            with self.connection:
+                self.connection.execute("DELETE FROM tracks")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES ('tags', ?)", (tag_config,)
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(
+        self,
+        paths: List[str],
+        max_workers: Optional[int] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        prune_root: Optional[str] = None,
+    ) -> RefreshStats:
+        """Brings the index up to date with `paths`, rescanning only new files and files whose modification time or size changed.
+
+        Args:
+            paths (List[str]): The audio files to index.
+            max_workers (int, optional): Number of worker processes reading the tags. Defaults to the CPU count; 1 scans in the current process.
+            progress_callback (Callable[[int, int], None], optional): Called with (files scanned, files to scan) as the scan progresses. Defaults to None.
+            prune_root (str, optional): If specified, indexed files under this directory that are not in `paths` are removed from the index. Defaults to None.
+
+        Returns:
+            RefreshStats: the number of scanned, unchanged and removed files
+        """
+        stats = RefreshStats()
+        indexed = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self.connection.execute("SELECT path, mtime_ns, size FROM tracks")
+        }
+
+        to_scan = []
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if indexed.pop(path, None) == signature:
+                stats.unchanged += 1
+            else:
+                to_scan.append((path, signature))
+
+        if prune_root is not None:
+            prune_root = os.path.join(os.path.abspath(prune_root), "")
+            removed = [(path,) for path in indexed if path.startswith(prune_root)]
+            with self.connection:
+                self.connection.executemany("DELETE FROM tracks WHERE path = ?", removed)
+            stats.removed = len(removed)
+
+        if not to_scan:
+            return stats
+
+        jobs = [(path, self.loop_start_tag, self.loop_end_tag, self.is_offset) for path, _ in to_scan]
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        max_workers = min(max_workers, len(jobs))
+
+        with self.connection, (ProcessPoolExecutor(max_workers=max_workers) if max_workers > 1 else _InlineExecutor()) as executor:
+            results = executor.map(_scan_file, jobs, chunksize=SCAN_CHUNK_SIZE)
+            for (path, (mtime_ns, size)), (loop_start, loop_end, error) in zip(to_scan, results):
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO tracks (path, mtime_ns, size, loop_start, loop_end, error) VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, mtime_ns, size, loop_start, loop_end, error),
+                )
+                stats.scanned += 1
+                if progress_callback is not None:
+                    progress_callback(stats.scanned, len(to_scan))
+        return stats
+
+    def tracks(self, tagged: Optional[bool] = None, include_errors: bool = False) -> Iterator[IndexedTrack]:
+        """Iterates over the indexed tracks, sorted by path.
+
+        Args:
+            tagged (bool, optional): Only tracks with (True) or without (False) loop tags. Defaults to None (all tracks).
+            include_errors (bool, optional): Include files whose tags could not be read (e.g. non-audio files). Defaults to False.
+        """
+        conditions = [] if include_errors else ["error IS NULL"]
+        if tagged is not None:
+            conditions.append("loop_start IS NOT NULL" if tagged else "loop_start IS NULL")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        for row in self.connection.execute(
+            f"SELECT path, loop_start, loop_end, error FROM tracks {where} ORDER BY path"
+        ):
+            yield IndexedTrack(*row)
+
+    def lookup(self, path: str) -> Optional[IndexedTrack]:
+        """Returns the indexed entry of `path`, or None if it is not indexed."""
+        row = self.connection.execute(
+            "SELECT path, loop_start, loop_end, error FROM tracks WHERE path = ?",
+            (os.path.abspath(path),),
+        ).fetchone()
+        return IndexedTrack(*row) if row is not None else None
+
+    def counts(self) -> Tuple[int, int, int]:
+        """Returns the number of (tagged, untagged, unreadable) indexed files."""
+        return self.connection.execute(
+            """SELECT
+                COALESCE(SUM(error IS NULL AND loop_start IS NOT NULL), 0),
+                COALESCE(SUM(error IS NULL AND loop_start IS NULL), 0),
+                COALESCE(SUM(error IS NOT NULL), 0)
+            FROM tracks"""
+        ).fetchone()
+
+
+class _InlineExecutor:
+    """Runs `map` in the current process, with the same interface as `ProcessPoolExecutor`."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def map(self, fn, iterable, chunksize=1):
+        return map(fn, iterable)
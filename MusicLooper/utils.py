@@ -1,5 +1,7 @@
 """General utility functions."""
 import os
+import socket
+import stat
 from typing import Optional
 
 from youtube import YoutubeDownloader
@@ -37,6 +39,47 @@ def mk_outputdir(path: str, output_dir: Optional[str] = None) -> str:
     return output_dir_to_use
 
 
+def remove_unix_socket(address: str):
+    """Removes the Unix socket file at `address`, if any.
+
+    Raises:
+        FileExistsError: If `address` is an existing file that is not a socket.
+    """
+    try:
+        mode = os.lstat(address).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"\"{address}\" already exists and is not a socket.")
+    os.remove(address)
+
+
+def open_listening_socket(address: str, backlog: int = 1) -> socket.socket:
+    """Creates a socket listening on the local `address` provided.
+
+    Args:
+        address (str): "PORT" or "HOST:PORT" for a TCP socket (host defaults to 127.0.0.1), otherwise the file path of a Unix socket.
+        backlog (int, optional): Number of pending connections queued by the system. Defaults to 1.
+
+    Returns:
+        socket.socket: The listening socket.
+
+    Raises:
+        FileExistsError: If `address` is the path of an existing file that is not a socket.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or "127.0.0.1", int(port)))
+    else:
+        remove_unix_socket(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    server.listen(backlog)
+    return server
+
+
 def download_audio(url, output_path, progress_callback=None, cancel_check=None):
     """下載 YouTube 音訊
     